@@ -0,0 +1,116 @@
+"""Recall and latency of the IVF index against exact search.
+
+Builds a UserVectorIndex from synthetic clustered embeddings (no Cohere
+calls) and compares IVF search with an exact scan for each corpus size.
+The IVF index is loaded from an EmbeddingStore that has compacted the
+documents' segments into its memory-mapped base file, as it would be for a
+large user in production.
+
+    python benchmarks/ann_benchmark.py --sizes 20000 50000 --nprobe 4 8 16
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("COHERE_API_KEY", "benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+from src import app as chatty
+
+logging.getLogger().setLevel(logging.WARNING)
+
+# Every (STORE_MAX_SEGMENTS + 1)th segment compacts the store, so after this
+# many documents every row is in the base file and none in the index's tail
+DOCUMENTS = 3 * (chatty.STORE_MAX_SEGMENTS + 1)
+
+def clustered_vectors(rng, count, dims, clusters):
+    centers = rng.standard_normal((clusters, dims))
+    vectors = centers[rng.integers(0, clusters, count)] + 0.8 * rng.standard_normal((count, dims))
+    return chatty.normalize_embeddings(vectors)
+
+
+def build_index(vectors, storage, docs=DOCUMENTS):
+    index = chatty.UserVectorIndex(storage=storage)
+    for doc, rows in enumerate(np.array_split(np.arange(len(vectors)), docs)):
+        metadata = [{"doc_id": f"doc-{doc}", "chunk_index": i, "text": "", "filename": f"doc-{doc}.txt"}
+                    for i in range(len(rows))]
+        index.add_vectors(f"doc-{doc}", vectors[rows], metadata)
+    return index
+
+
+def build_store_index(vectors, storage, path, docs=DOCUMENTS):
+    """Like build_index, but through store segments; more than STORE_MAX_SEGMENTS documents get compacted"""
+    store = chatty.EmbeddingStore(path)
+    for doc, rows in enumerate(np.array_split(np.arange(len(vectors)), docs)):
+        metadata = [{"doc_id": f"doc-{doc}", "chunk_index": i, "text": "", "filename": f"doc-{doc}.txt"}
+                    for i in range(len(rows))]
+        store.add_segment(f"doc-{doc}", f"doc-{doc}.txt", np.ascontiguousarray(vectors[rows], dtype=np.float32), metadata)
+    index = chatty.UserVectorIndex(storage=storage)
+    index.sync(store)
+    assert index.size == 0, "expected a fully compacted store"
+    return index
+
+
+def run_queries(index, queries, top_k):
+    results = []
+    latencies = []
+    modes = set()
+    for query in queries:
+        info = {}
+        start = time.perf_counter()
+        found = index.search(query, top_k=top_k, threshold=-1.0, search_info=info)
+        latencies.append(time.perf_counter() - start)
+        modes.add(info.get("mode"))
+        results.append({(chunk["doc_id"], chunk["chunk_index"]) for chunk in found})
+    return results, np.array(latencies) * 1000, modes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20000, 50000])
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=chatty.MAX_RELEVANT_CHUNKS)
+    parser.add_argument("--storage", default="float", choices=["float", "int8", "binary"])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    report = []
+    for size in args.sizes:
+        vectors = clustered_vectors(rng, size, args.dims, clusters=max(size // 200, 10))
+        queries = vectors[rng.choice(size, args.queries, replace=False)] + 0.05 * rng.standard_normal((args.queries, args.dims))
+
+        chatty.ANN_MIN_CHUNKS = size + 1
+        exact_index = build_index(vectors, args.storage)
+        exact, exact_ms, _ = run_queries(exact_index, queries, args.top_k)
+        report.append({"size": size, "mode": "exact", "nprobe": None, "recall": 1.0,
+                       "p50_ms": round(float(np.percentile(exact_ms, 50)), 3),
+                       "p95_ms": round(float(np.percentile(exact_ms, 95)), 3)})
+
+        chatty.ANN_MIN_CHUNKS = 0
+        store_path = tempfile.mkdtemp(prefix="chatty-ann-")
+        ivf_index = build_store_index(vectors, args.storage, store_path)
+        for nprobe in args.nprobe:
+            chatty.IVF_NPROBE = nprobe
+            found, ivf_ms, modes = run_queries(ivf_index, queries, args.top_k)
+            recall = np.mean([len(a & b) / len(a) for a, b in zip(exact, found) if a])
+            report.append({"size": size, "mode": "/".join(sorted(modes)), "nprobe": nprobe,
+                           "lists": len(ivf_index.centroids), "recall": round(float(recall), 4),
+                           "p50_ms": round(float(np.percentile(ivf_ms, 50)), 3),
+                           "p95_ms": round(float(np.percentile(ivf_ms, 95)), 3)})
+        shutil.rmtree(store_path, True)
+
+    for row in report:
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Local stand-in for cohere.ClientV2, for benchmarks that must not call the API.
+
+Embeddings are deterministic: every word maps to a fixed random vector and a
+text embeds to the normalized sum of its words, so texts that share words
+are similar and semantic search returns sensible hits. Chat replies wait
+for a configurable time to first token, then produce tokens at a fixed rate.
+
+    from benchmarks.fake_cohere import FakeClientV2
+    chatty.co = FakeClientV2(ttft=0.2, token_latency=0.01)
+
+FakeAsyncClientV2 wraps one for src/asgi.py, which calls cohere.AsyncClientV2.
+"""
+import asyncio
+import hashlib
+import re
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+
+class FakeClientV2:
+    def __init__(self, dims=1024, embed_latency=0.05, per_text_latency=0.0002,
+                 ttft=0.3, token_latency=0.02, tokens=50):
+        self.dims = dims
+        self.embed_latency = embed_latency
+        self.per_text_latency = per_text_latency
+        self.ttft = ttft
+        self.token_latency = token_latency
+        self.tokens = tokens
+        self.calls = {"embed": 0, "embedded_texts": 0, "chat": 0, "chat_stream": 0}
+        self.word_vectors = {}
+
+    def word_vector(self, word):
+        vector = self.word_vectors.get(word)
+        if vector is None:
+            seed = int.from_bytes(hashlib.sha256(word.encode("utf-8")).digest()[:8], "little")
+            vector = self.word_vectors.setdefault(
+                word, np.random.default_rng(seed).standard_normal(self.dims).astype(np.float32))
+        return vector
+
+    def vector(self, text):
+        vector = np.zeros(self.dims, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            vector += self.word_vector(word)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed(self, texts, model=None, input_type=None, embedding_types=None, **kwargs):
+        self.calls["embed"] += 1
+        self.calls["embedded_texts"] += len(texts)
+        time.sleep(self.embed_latency + self.per_text_latency * len(texts))
+        return SimpleNamespace(embeddings=SimpleNamespace(float_=[self.vector(text) for text in texts]))
+
+    def usage(self, messages):
+        input_tokens = sum(len(message["content"]) for message in messages) // 4
+        return SimpleNamespace(tokens=SimpleNamespace(input_tokens=input_tokens, output_tokens=self.tokens),
+                               billed_units=None)
+
+    def reply_tokens(self, messages, count):
+        words = re.findall(r"\w+", messages[-1]["content"]) or ["ok"]
+        return [f"{words[i % len(words)]} " for i in range(count)]
+
+    def chat(self, model=None, messages=None, max_tokens=None, **kwargs):
+        self.calls["chat"] += 1
+        count = min(self.tokens, max_tokens or self.tokens)
+        time.sleep(self.ttft + self.token_latency * count)
+        text = "".join(self.reply_tokens(messages, count))
+        return SimpleNamespace(message=SimpleNamespace(content=[SimpleNamespace(text=text)]),
+                               usage=self.usage(messages))
+
+    def chat_stream(self, model=None, messages=None, **kwargs):
+        self.calls["chat_stream"] += 1
+        time.sleep(self.ttft)
+        for token in self.reply_tokens(messages, self.tokens):
+            yield SimpleNamespace(type="content-delta", delta=SimpleNamespace(
+                message=SimpleNamespace(content=SimpleNamespace(text=token))))
+            time.sleep(self.token_latency)
+        yield SimpleNamespace(type="message-end", delta=SimpleNamespace(usage=self.usage(messages)))
+
+
+class FakeAsyncClientV2:
+    """Async counterpart of a FakeClientV2, sharing its vectors, latencies and call counts"""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    async def embed(self, texts, model=None, input_type=None, embedding_types=None, **kwargs):
+        fake = self.fake
+        fake.calls["embed"] += 1
+        fake.calls["embedded_texts"] += len(texts)
+        await asyncio.sleep(fake.embed_latency + fake.per_text_latency * len(texts))
+        return SimpleNamespace(embeddings=SimpleNamespace(float_=[fake.vector(text) for text in texts]))
+
+    async def chat(self, model=None, messages=None, max_tokens=None, **kwargs):
+        fake = self.fake
+        fake.calls["chat"] += 1
+        count = min(fake.tokens, max_tokens or fake.tokens)
+        await asyncio.sleep(fake.ttft + fake.token_latency * count)
+        text = "".join(fake.reply_tokens(messages, count))
+        return SimpleNamespace(message=SimpleNamespace(content=[SimpleNamespace(text=text)]),
+                               usage=fake.usage(messages))
+
+    async def chat_stream(self, model=None, messages=None, **kwargs):
+        fake = self.fake
+        fake.calls["chat_stream"] += 1
+        await asyncio.sleep(fake.ttft)
+        for token in fake.reply_tokens(messages, fake.tokens):
+            yield SimpleNamespace(type="content-delta", delta=SimpleNamespace(
+                message=SimpleNamespace(content=SimpleNamespace(text=token))))
+            await asyncio.sleep(fake.token_latency)
+        yield SimpleNamespace(type="message-end", delta=SimpleNamespace(usage=fake.usage(messages)))
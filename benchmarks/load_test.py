@@ -0,0 +1,88 @@
+"""Concurrent /chat-stream load test against a running server.
+
+Opens --concurrency streams at once, --requests in total, and reports time
+to first event, total stream time and throughput. Run it once against each
+deployment to compare them:
+
+    gunicorn src.app:app --bind=0.0.0.0:5000 --workers 2 --threads 8
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 --concurrency 200
+
+    uvicorn src.asgi:app --host 0.0.0.0 --port 8000 --workers 2
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --concurrency 200
+
+Every request is a real chat call, so point it at a test API key.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import numpy as np
+
+
+async def one_stream(client, url, user_id, message):
+    started = time.perf_counter()
+    first_event = None
+    async with client.stream("POST", f"{url}/chat-stream?protocol=delta",
+                             json={"user_id": user_id, "message": message}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.startswith("data:") and first_event is None:
+                first_event = time.perf_counter() - started
+            if line.startswith("event: done") or line.startswith("event: error"):
+                break
+    return first_event, time.perf_counter() - started
+
+
+async def run(url, requests, concurrency, message):
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    results = []
+    errors = 0
+
+    async with httpx.AsyncClient(timeout=httpx.Timeout(600.0), limits=limits) as client:
+        async def worker(i):
+            nonlocal errors
+            async with semaphore:
+                try:
+                    results.append(await one_stream(client, url, f"load-{i % concurrency}", message))
+                except Exception:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(requests)))
+        elapsed = time.perf_counter() - started
+
+    first = np.array([r[0] for r in results if r[0] is not None]) * 1000
+    total = np.array([r[1] for r in results]) * 1000
+
+    def percentiles(values):
+        if not len(values):
+            return None
+        return {f"p{p}": round(float(np.percentile(values, p)), 1) for p in (50, 95, 99)}
+
+    return {
+        "url": url,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "streams_per_second": round(len(results) / elapsed, 2),
+        "first_event_ms": percentiles(first),
+        "total_ms": percentiles(total)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--message", default="Write two sentences about load testing.")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.url.rstrip("/"), args.requests, args.concurrency, args.message))))
+
+
+if __name__ == "__main__":
+    main()
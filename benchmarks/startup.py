@@ -0,0 +1,123 @@
+"""Cold start benchmark: import time and first-request latency of the Flask app.
+
+Every run starts a fresh interpreter in a throwaway working directory,
+imports src.app, builds an app with create_app and sends the first
+/health, /upload and /search requests through Flask's test client, with
+benchmarks/fake_cohere.py standing in for the Cohere API. The child also
+reports which heavy optional modules the import pulled in, which should be
+none until a request needs them.
+
+Prints one JSON line per run and a summary line with the median and worst
+of each timing, tagged with the git commit like benchmarks/suite.py:
+
+    python benchmarks/startup.py --runs 10 --output startup.jsonl
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HEAVY_MODULES = ("cohere", "PyPDF2", "docx", "sklearn")
+TIMINGS = ("import_ms", "create_app_ms", "first_health_ms", "first_upload_ms", "first_search_ms")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def child():
+    """Measure one cold start; runs in its own interpreter and prints a JSON row"""
+    sys.path.insert(0, ROOT)
+    started = time.perf_counter()
+    from src import app as chatty
+    row = {"import_ms": elapsed_ms(started), "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules]}
+
+    started = time.perf_counter()
+    app = chatty.create_app()
+    row["create_app_ms"] = elapsed_ms(started)
+
+    from benchmarks.fake_cohere import FakeClientV2
+    chatty.co = FakeClientV2(dims=256, embed_latency=0, per_text_latency=0, ttft=0, token_latency=0)
+    client = app.test_client()
+
+    started = time.perf_counter()
+    ok = client.get("/health").status_code == 200
+    row["first_health_ms"] = elapsed_ms(started)
+
+    started = time.perf_counter()
+    ok = client.post("/upload", data={
+        "user_id": "startup",
+        "wait": "true",
+        "file": (io.BytesIO(b"The refund policy allows returns within 30 days. " * 40), "policy.txt")
+    }).status_code == 200 and ok
+    row["first_upload_ms"] = elapsed_ms(started)
+
+    started = time.perf_counter()
+    ok = client.post("/search", json={"user_id": "startup", "query": "refund policy"}).status_code == 200 and ok
+    row["first_search_ms"] = elapsed_ms(started)
+
+    row["ok"] = ok
+    row["heavy_modules_after_requests"] = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(json.dumps(row))
+
+
+def run_child():
+    workdir = tempfile.mkdtemp(prefix="chatty-startup-")
+    env = dict(os.environ, COHERE_API_KEY=os.environ.get("COHERE_API_KEY", "benchmark"), LOG_LEVEL="WARNING")
+    try:
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], cwd=workdir, env=env,
+                                capture_output=True, text=True, check=True)
+    finally:
+        shutil.rmtree(workdir, True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to start")
+    parser.add_argument("--output", help="append the JSON lines to this file as well")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child()
+
+    commit = git_commit()
+    rows = [{"scenario": "meta", "python": platform.python_version(), "config": {"runs": args.runs}}]
+    runs = [run_child() for _ in range(args.runs)]
+    rows += [dict(run, scenario="startup_run", run=i) for i, run in enumerate(runs)]
+    summary = {"scenario": "startup", "runs": len(runs), "errors": sum(not run["ok"] for run in runs)}
+    for timing in TIMINGS:
+        values = [run[timing] for run in runs]
+        summary[f"{timing}_p50"] = round(statistics.median(values), 2)
+        summary[f"{timing}_max"] = max(values)
+    summary["heavy_modules"] = sorted({name for run in runs for name in run["heavy_modules"]})
+    rows.append(summary)
+
+    output = open(args.output, "a") if args.output else None
+    for row in rows:
+        line = json.dumps({"commit": commit, **row})
+        print(line)
+        if output:
+            output.write(line + "\n")
+    if output:
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
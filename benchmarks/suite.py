@@ -0,0 +1,311 @@
+"""End-to-end benchmarks of the Flask app against a fake Cohere backend.
+
+Drives the real routes through Flask's test client with
+benchmarks/fake_cohere.py standing in for cohere.ClientV2, so no API
+credits are spent and latency is only what the code adds on top of the
+configured fake model delays. Runs in a throwaway working directory.
+
+Each scenario prints one JSON line with request count, throughput,
+p50/p95/p99 latency and the peak and growth of RSS while it ran, tagged with
+the git commit, so runs can be compared across commits:
+
+    python benchmarks/suite.py --output bench.jsonl
+    python benchmarks/suite.py --documents 30 --sizes 2 50 500 --users 16 --scenarios upload search concurrent
+    python benchmarks/suite.py --scenarios search batch_search --batch-queries 5000 --batch-size 1000
+"""
+import argparse
+import atexit
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+os.environ.setdefault("COHERE_API_KEY", "benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# Measure the code, not the per-worker Cohere rate limit
+os.environ.setdefault("MODEL_CALLS_PER_MINUTE", "0")
+sys.path.insert(0, ROOT)
+# UPLOAD_FOLDER and the state database are created under the working directory on import
+WORKDIR = tempfile.mkdtemp(prefix="chatty-bench-")
+os.chdir(WORKDIR)
+atexit.register(shutil.rmtree, WORKDIR, True)
+
+import numpy as np
+
+from benchmarks.fake_cohere import FakeClientV2
+from src import app as chatty
+
+SCENARIOS = ("upload", "search", "batch_search", "chat", "chat_stream", "concurrent")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        # No /proc (macOS): fall back to the process-wide peak; ru_maxrss is in bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024)
+
+
+class RssMonitor:
+    """Peak RSS since the last reset, sampled from a background thread.
+
+    ru_maxrss only ever grows, so on its own it would credit every scenario
+    with the peak of the heaviest one that ran before it.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.baseline = self.peak = current_rss_mb()
+        threading.Thread(target=self._sample, daemon=True).start()
+
+    def _sample(self):
+        while True:
+            rss = current_rss_mb()
+            with self.lock:
+                self.peak = max(self.peak, rss)
+            time.sleep(self.interval)
+
+    def reset(self):
+        """Peak and growth of RSS since the previous reset, then start a new window"""
+        rss = current_rss_mb()
+        with self.lock:
+            window = {"peak_rss_mb": round(max(self.peak, rss), 1), "rss_growth_mb": round(rss - self.baseline, 1)}
+            self.baseline = self.peak = rss
+        return window
+
+
+rss_monitor = None
+
+
+def make_vocabulary(rng, size=3000):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(size)]
+
+
+def make_document(rng, vocabulary, kilobytes):
+    sentences = []
+    length = 0
+    while length < kilobytes * 1024:
+        sentence = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(8, 20))).capitalize() + "."
+        sentences.append(sentence)
+        length += len(sentence) + 1
+    return " ".join(sentences)
+
+
+def summarize(scenario, latencies, seconds, errors=0, **extra):
+    latencies_ms = np.array(latencies) * 1000
+    row = {
+        "scenario": scenario,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) / seconds, 2) if seconds else None
+    }
+    for percentile in (50, 95, 99):
+        row[f"p{percentile}_ms"] = round(float(np.percentile(latencies_ms, percentile)), 2) if len(latencies_ms) else None
+    row.update(extra)
+    row.update(rss_monitor.reset())
+    return row
+
+
+def timed_requests(requests):
+    """Run (callable) requests one after another; returns (latencies, errors, seconds)"""
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for send in requests:
+        request_started = time.perf_counter()
+        if not send():
+            errors += 1
+        latencies.append(time.perf_counter() - request_started)
+    return latencies, errors, time.perf_counter() - started
+
+
+def upload(client, user_id, filename, text):
+    response = client.post("/upload", data={
+        "user_id": user_id,
+        "wait": "true",
+        "file": (io.BytesIO(text.encode("utf-8")), filename)
+    })
+    return response.status_code == 200
+
+
+def search(client, user_id, query, hits=None):
+    """Run one search, appending whether it found context to hits"""
+    response = client.post("/search", json={"user_id": user_id, "query": query})
+    if response.status_code != 200:
+        return False
+    if hits is not None:
+        hits.append(response.get_json()["has_results"])
+    return True
+
+
+def batch_search(client, user_id, queries):
+    response = client.post("/search/batch", json={"user_id": user_id, "queries": queries})
+    return response.status_code == 200
+
+
+def chat(client, user_id, message):
+    response = client.post("/chat", json={"user_id": user_id, "message": message, "use_documents": True})
+    return response.status_code == 200
+
+
+def chat_stream(client, user_id, message, first_event):
+    """Stream one answer, appending the time to the first delta to first_event"""
+    started = time.perf_counter()
+    response = client.post("/chat-stream?protocol=delta", buffered=False,
+                           json={"user_id": user_id, "message": message, "use_documents": True})
+    ok = response.status_code == 200
+    seen_first = False
+    for piece in response.response:
+        piece = piece.decode("utf-8") if isinstance(piece, bytes) else piece
+        if not seen_first and "event: delta" in piece:
+            first_event.append(time.perf_counter() - started)
+            seen_first = True
+        if "event: error" in piece:
+            ok = False
+    response.close()
+    return ok and seen_first
+
+
+def main():
+    global rss_monitor
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--documents", type=int, default=12, help="documents uploaded per size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2, 50, 500], help="document sizes in KB")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--batch-queries", type=int, default=1000, help="queries sent to /search/batch in total")
+    parser.add_argument("--batch-size", type=int, default=200, help="queries per /search/batch request")
+    parser.add_argument("--users", type=int, default=8, help="threads in the concurrent scenario")
+    parser.add_argument("--rounds", type=int, default=5, help="search + chat rounds per concurrent user")
+    parser.add_argument("--dims", type=int, default=1024)
+    parser.add_argument("--embed-latency", type=float, default=0.02)
+    parser.add_argument("--ttft", type=float, default=0.05)
+    parser.add_argument("--token-latency", type=float, default=0.002)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the JSON lines to this file as well")
+    args = parser.parse_args()
+
+    fake = FakeClientV2(dims=args.dims, embed_latency=args.embed_latency, ttft=args.ttft,
+                        token_latency=args.token_latency, tokens=args.tokens)
+    chatty.co = fake
+    client = chatty.app.test_client()
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng)
+    commit = git_commit()
+
+    rows = [{"scenario": "meta", "python": platform.python_version(), "numpy": np.__version__,
+             "config": vars(args)}]
+
+    corpus = {size: [make_document(rng, vocabulary, size) for _ in range(args.documents)] for size in args.sizes}
+    # Every scenario reports the RSS peak and growth since the previous one finished
+    rss_monitor = RssMonitor()
+    user_id = "bench-user"
+    needs_documents = {"search", "batch_search", "chat", "chat_stream"} & set(args.scenarios)
+    if "upload" in args.scenarios or needs_documents:
+        for size, texts in corpus.items():
+            latencies, errors, seconds = timed_requests(
+                lambda i=i, text=text: upload(client, user_id, f"doc-{size}kb-{i}.txt", text)
+                for i, text in enumerate(texts)
+            )
+            if "upload" in args.scenarios:
+                megabytes = sum(len(text) for text in texts) / 1e6
+                rows.append(summarize(f"upload_{size}kb", latencies, seconds, errors,
+                                      megabytes_per_second=round(megabytes / seconds, 3)))
+
+    # Questions are sentences from the uploaded documents, so searches have real hits
+    all_texts = [text for texts in corpus.values() for text in texts]
+    questions = [rng.choice(rng.choice(all_texts).split(". ")) for _ in range(args.queries)]
+
+    if "search" in args.scenarios:
+        hits = []
+        latencies, errors, seconds = timed_requests(
+            lambda question=question: search(client, user_id, question, hits) for question in questions
+        )
+        rows.append(summarize("search", latencies, seconds, errors,
+                              hit_rate=round(sum(hits) / len(hits), 3) if hits else None))
+
+    if "batch_search" in args.scenarios:
+        batch = [rng.choice(rng.choice(all_texts).split(". ")) for _ in range(args.batch_queries)]
+        latencies, errors, seconds = timed_requests(
+            lambda offset=offset: batch_search(client, user_id, batch[offset:offset + args.batch_size])
+            for offset in range(0, len(batch), args.batch_size)
+        )
+        rows.append(summarize("batch_search", latencies, seconds, errors,
+                              queries_per_second=round(len(batch) / seconds, 1)))
+
+    if "chat" in args.scenarios:
+        latencies, errors, seconds = timed_requests(
+            lambda question=question: chat(client, user_id, question) for question in questions
+        )
+        rows.append(summarize("chat", latencies, seconds, errors))
+
+    if "chat_stream" in args.scenarios:
+        first_event = []
+        latencies, errors, seconds = timed_requests(
+            lambda question=question: chat_stream(client, user_id, question, first_event) for question in questions
+        )
+        first_event_ms = np.array(first_event) * 1000
+        rows.append(summarize("chat_stream", latencies, seconds, errors,
+                              first_event_p50_ms=round(float(np.percentile(first_event_ms, 50)), 2) if first_event else None,
+                              first_event_p95_ms=round(float(np.percentile(first_event_ms, 95)), 2) if first_event else None))
+
+    if "concurrent" in args.scenarios:
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        document = corpus[args.sizes[len(args.sizes) // 2]][0]
+        user_questions = document.split(". ")
+
+        def simulate_user(index):
+            user_client = chatty.app.test_client()
+            user = f"bench-concurrent-{index}"
+            requests = [lambda: upload(user_client, user, "shared.txt", document)]
+            for question in rng.sample(user_questions, min(args.rounds, len(user_questions))):
+                requests.append(lambda question=question: search(user_client, user, question))
+                requests.append(lambda question=question: chat(user_client, user, question))
+            user_latencies, user_errors, _ = timed_requests(requests)
+            with lock:
+                latencies.extend(user_latencies)
+                errors.append(user_errors)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            list(pool.map(simulate_user, range(args.users)))
+        rows.append(summarize("concurrent", latencies, time.perf_counter() - started, sum(errors), users=args.users))
+
+    rows.append({"scenario": "fake_backend", **fake.calls})
+    output = open(args.output, "a") if args.output else None
+    for row in rows:
+        line = json.dumps({"commit": commit, **row})
+        print(line)
+        if output:
+            output.write(line + "\n")
+    if output:
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
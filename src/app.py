@@ -1,316 +1,3573 @@
-import cohere
 import os
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, Response, render_template
+from flask import Blueprint, Flask, request, jsonify, Response, render_template, current_app, g
 import json
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-import PyPDF2
-import docx
 import uuid
 import logging
+import threading
+import hashlib
+import gc
+import shutil
+import base64
+import gzip
+import zlib
+import random
+import time
+import unicodedata
+from collections import Counter, OrderedDict, deque
+import math
+import bisect
+import asyncio
+import contextvars
+import queue
+import sqlite3
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-# import re
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None
+import re
 
 load_dotenv()
+
+# Request trace id, attached to every log line so one request's lines can be followed
+trace_id_var = contextvars.ContextVar('trace_id', default='-')
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        return True
+
+# Set up logging; LOG_LEVEL=DEBUG for development, the default keeps hot paths quiet
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"
+)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdFilter())
+logger = logging.getLogger(__name__)
+
 # Make sure to add your COHERE_API_KEY to Azure App Service Configuration
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 if not COHERE_API_KEY:
     logger.error("COHERE_API_KEY environment variable is not set!")
     raise ValueError("COHERE_API_KEY environment variable is required")
 
-co = cohere.ClientV2(api_key=COHERE_API_KEY)
+# Created on first use: importing the SDK takes most of a second, and a client built
+# before gunicorn --preload forks the workers would share one connection pool between them
+co = None
+co_lock = threading.Lock()
 
-app = Flask(__name__)
-CORS(app)
+def get_cohere_client():
+    global co
+    if co is None:
+        with co_lock:
+            if co is None:
+                import cohere
+                co = cohere.ClientV2(api_key=COHERE_API_KEY)
+    return co
+
+# Every route is registered on this blueprint; create_app builds the Flask app around it
+routes = Blueprint('chatty', __name__)
 
 # Configuration
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'docx', 'md'}
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
-MAX_CONTEXT_LENGTH = 100000  # Adjust based on model limits
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 3000))  # Document context sent with a chat turn
+CONTEXT_MIN_SECTION_TOKENS = 64  # Clip a passage to fit the budget only if at least this much room is left
+FALLBACK_MAX_DOCUMENTS = 20  # Most recent documents the lexical fallback reads per chat
+FALLBACK_MAX_CHARS = 400_000  # Characters of document text the lexical fallback ranks per chat
 CHUNK_SIZE = 500  # Size of text chunks for embedding
 CHUNK_OVERLAP = 50  # Overlap between chunks
+CHUNK_BOUNDARY_WINDOW = 32  # Characters before a sentence break that decide whether to cut there
+CHUNK_BOUNDARY_DIVISOR = 3  # About one in this many sentence breaks past the minimum length becomes a boundary
 SIMILARITY_THRESHOLD = 0.3  # Minimum similarity score for relevance
 MAX_RELEVANT_CHUNKS = 5  # Maximum number of chunks to include in context
+EMBED_MODEL = "embed-v4.0"
+CHAT_MODEL = "command-r-plus-08-2024"
+EMBED_BATCH_SIZE = 96  # Cohere accepts at most 96 texts per embed call
+EMBED_MAX_WORKERS = int(os.getenv('EMBED_MAX_WORKERS', 4))  # Concurrent embed calls per worker
+EMBED_MAX_RETRIES = 4  # Retries for rate-limited or failed embed batches
+EMBED_RETRY_BASE_DELAY = 0.5  # Seconds, doubled after every failed attempt
+MODEL_CALLS_PER_MINUTE = float(os.getenv('MODEL_CALLS_PER_MINUTE', 600))  # Cohere calls per worker process; 0 disables the limit
+MODEL_CALL_BURST = 20  # Calls that may go out back to back after an idle spell
+MODEL_STREAM_SLOTS = int(os.getenv('MODEL_STREAM_SLOTS', 1000))  # Chat streams open at once per worker; queued ones get keep-alives
+MODEL_LANES = (("interactive", 32), ("stream", MODEL_STREAM_SLOTS), ("background", 2), ("bulk", EMBED_MAX_WORKERS))  # Priority order and concurrent calls per lane
+MODEL_ASYNC_POLL_SECONDS = 0.01  # How often a queued async call checks whether it may start
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 5000))  # Cached embeddings per worker (~6KB each at 1536 dims)
+EMBEDDING_STORAGE = os.getenv('EMBEDDING_STORAGE', 'float')  # In-memory vectors: 'float', 'int8' or 'binary'
+RESCORE_FACTOR = 10  # Quantized search rescores top_k * RESCORE_FACTOR candidates at full precision...
+RESCORE_CANDIDATES = 100  # ...but never fewer than this many
+QUANTIZED_SCAN_BLOCK = 4096  # Rows decoded at a time when scanning quantized vectors
+ANN_MIN_CHUNKS = int(os.getenv('ANN_MIN_CHUNKS', 20000))  # Users with more live chunks get an IVF index
+IVF_NPROBE = int(os.getenv('IVF_NPROBE', 8))  # IVF lists scanned per query
+IVF_TRAIN_ITERATIONS = 10  # k-means iterations when (re)training the IVF centroids
+IVF_TRAIN_SAMPLES_PER_LIST = 50  # k-means trains on at most this many rows per list
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 2000))  # Cached query embeddings per worker
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', 3600))  # Seconds a cached query embedding stays valid
+QUERY_BATCH_WINDOW = 0.005  # Seconds to wait for concurrent query embeds to share one call
+INDEX_COMPACT_RATIO = 0.25  # Compact a user's index once this fraction of rows is dead
+INDEX_FOLDER = os.path.join(UPLOAD_FOLDER, 'index')  # Memory-mapped embedding store
+STORE_MAX_SEGMENTS = 16  # Merge segments into the base file once there are more than this
+JOBS_FOLDER = os.path.join(UPLOAD_FOLDER, 'jobs')  # Upload job status, readable by every worker
+INGEST_MAX_WORKERS = int(os.getenv('INGEST_MAX_WORKERS', 2))  # Documents processed at once per worker
+INGESTION_STAGES = ("extracting", "chunking", "embedding", "indexing")
+INGESTION_JOB_TTL = 24 * 3600  # Seconds a finished upload job's status stays available
+INGEST_BATCH_PARALLEL_FILES = 4  # Files of one /upload-batch request processed at once
+UPLOAD_BATCH_MAX_FILES = 100  # Most files accepted by one /upload-batch request
+UPLOAD_SESSIONS_FOLDER = os.path.join(UPLOAD_FOLDER, 'partial')  # Resumable uploads in progress
+UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE_MB', 1024)) * 1024 * 1024  # Largest file accepted by /uploads
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Suggested chunk size for /uploads; every chunk must stay under MAX_FILE_SIZE
+UPLOAD_STREAM_BLOCK = 1024 * 1024  # Bytes read from the request body at a time
+UPLOAD_SESSION_TTL = 24 * 3600  # Seconds an unfinished resumable upload is kept
+PDF_PAGES_PER_TASK = 8  # PDF pages parsed per process pool task
+EXTRACT_MAX_PROCESSES = int(os.getenv('EXTRACT_MAX_PROCESSES', min(4, os.cpu_count() or 1)))
+STREAM_KEEPALIVE_SECONDS = 15  # Send an SSE comment when the model is silent this long
+SSE_KEEPALIVE = ": keep-alive\n\n"  # SSE comment, ignored by clients but keeps proxies from closing the connection
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # Histogram bounds, seconds
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')  # Conversation memory and document records: 'sqlite' or 'memory'
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(UPLOAD_FOLDER, 'state.db'))  # Shared by every worker on this host
+STATE_CACHE_SIZE = 10000  # Users whose conversation memory is cached per worker
+STATE_WRITE_BATCH = 256  # Most queued writes committed in one SQLite transaction
+MEMORY_MAX_MESSAGES = 50  # Conversation messages stored per user, summarized or not
+MEMORY_TOKEN_BUDGET = int(os.getenv('MEMORY_TOKEN_BUDGET', 2000))  # Verbatim history sent with each chat turn
+MEMORY_RECENT_TOKENS = MEMORY_TOKEN_BUDGET // 2  # History kept verbatim after older turns are summarized
+MEMORY_SUMMARY_TOKENS = 300  # Longest running summary the model may write
+MEMORY_SUMMARY_INPUT_TOKENS = 1000  # Longest single message passed to the summarizer
+CHARS_PER_TOKEN = 4  # Rough characters per token for English text
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1000))  # Cached answers per worker; 0 disables the cache
+RESPONSE_CACHE_PER_USER = 50  # Cached answers kept per user
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 24 * 3600))  # Seconds a cached answer stays valid
+RESPONSE_CACHE_SIMILARITY = 0.95  # Cosine similarity at which a new question reuses a cached answer
+USER_STATE_MEMORY_MB = int(os.getenv('USER_STATE_MEMORY_MB', 512))  # Loaded indexes per worker before idle users are evicted
+USER_STATE_ROW_BYTES = 300  # Rough size of one chunk's or document's metadata dict in memory
+DOCUMENT_PREVIEW_CHARS = 100  # Characters of extracted text shown in document listings
+SEARCH_BATCH_MAX_QUERIES = 5000  # Most queries accepted by one /search/batch request
+SEARCH_BATCH_MAX_TOP_K = 50  # Most chunks returned per query by /search/batch
+SEARCH_BATCH_SCORE_CELLS = 4 * 1024 * 1024  # Largest float32 score (or rescoring) block built at once in a batch search
+DOCUMENTS_PAGE_SIZE = 50  # Documents per /documents page unless the request sets a limit
+DOCUMENTS_MAX_PAGE_SIZE = 200  # Largest limit accepted by /documents
+COMPRESS_MIN_BYTES = 1024  # JSON responses at least this large are gzipped for clients that accept it
+PRELOAD_INDEXES = os.getenv('PRELOAD_INDEXES', 'false').lower() == 'true'  # Load shared collection indexes in create_app
+
+# Conversation memory and document records live in state_backend, shared by all workers
+# Document records per user; content stays on disk (user_id -> list of doc_info)
+user_documents = {}
+user_documents_version = {}
+# Listing summaries, rebuilt when user_documents changes (user_id -> (docs, summaries, {doc_id: position}))
+user_document_summaries = {}
+# Chunks the lexical fallback ranks, rebuilt when a searched document set changes
+# (user_id -> (documents versions, passages, {word: {passage position: count}}, estimated bytes))
+user_fallback_passages = {}
+# Store document embeddings per user (user_id -> UserVectorIndex)
+user_embeddings = {}
+# On-disk embedding stores shared by all workers (user_id -> EmbeddingStore)
+user_stores = {}
+# Users with loaded state, least recently used first (user_id -> estimated bytes)
+user_state_usage = OrderedDict()
+user_state_bytes = 0  # Running sum of user_state_usage values
+user_state_lock = threading.Lock()
+user_state_evictions = 0
+# Background document ingestion (job_id -> job state, mirrored to JOBS_FOLDER)
+ingestion_jobs = {}
+ingestion_jobs_lock = threading.Lock()
+ingestion_executor = ThreadPoolExecutor(max_workers=INGEST_MAX_WORKERS, thread_name_prefix='ingest')
+# Running sha256 of resumable uploads this worker received chunks for (upload_id -> (offset, hasher))
+upload_hashers = {}
+upload_hashers_lock = threading.Lock()
+# Running conversation summaries, computed after the reply has been sent
+memory_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='memory-summary')
+memory_summaries_running = set()
+memory_summaries_lock = threading.Lock()
+# PDF parsing processes, started on first use
+extract_pool = None
+extract_pool_lock = threading.Lock()
+
+class LatencyHistograms:
+    """Cumulative latency histograms, rendered in the Prometheus text format.
+
+    Each worker process keeps its own; a scrape sees whichever worker answered it.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.series = {}  # (name, labels) -> [per-bucket counts..., overflow count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self):
+        with self.lock:
+            series = sorted((key, list(values)) for key, values in self.series.items())
+        lines = []
+        current = None
+        for (name, labels), values in series:
+            if name != current:
+                lines.append(f"# TYPE {name} histogram")
+                current = name
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            prefix = f"{label_text}," if label_text else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            cumulative += values[len(self.buckets)]
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            suffix = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{name}_sum{suffix} {values[-1]:.6f}")
+            lines.append(f"{name}_count{suffix} {cumulative}")
+        return lines
+
+latency_metrics = LatencyHistograms()
+
+def observe_stage(stage, seconds):
+    if seconds is not None:
+        latency_metrics.observe("chatty_stage_seconds", {"stage": stage}, seconds)
+
+@contextmanager
+def timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+SENTENCE_BREAK = re.compile(r"[.!?](?=\s)|\n")
+
+class StreamingChunker:
+    """Splits text into overlapping chunks with content-defined boundaries, incrementally.
+
+    Text is fed in pieces (e.g. PDF pages as they are extracted). Each call
+    returns the chunks that can no longer change, as (start, end, text)
+    tuples with offsets into the concatenated text. The chunks are exactly
+    the ones chunk_text_spans produces for the whole text at once.
+
+    Chunks end at sentence breaks chosen by a hash of the text just before
+    the break, not at fixed offsets, so an edit only changes the chunks
+    around it and the rest of a revised document cuts the same way. A chunk
+    is at least half and at most twice chunk_size long, and starts `overlap`
+    characters before the previous boundary.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+        self.chunk_size = chunk_size
+        self.min_size = chunk_size // 2
+        self.max_size = chunk_size * 2
+        self.overlap = overlap
+        self.buffer = ""  # Text from self.offset onwards; earlier text is no longer needed
+        self.offset = 0
+        self.cut = 0  # Last boundary
+        self.length = 0
+
+    def feed(self, piece):
+        self.buffer += piece
+        self.length += len(piece)
+        if self.length <= self.chunk_size:
+            return []
+        return self._advance(final=False)
+
+    def finish(self):
+        if self.length <= self.chunk_size:
+            # Short texts are kept whole
+            chunk = self.buffer.strip()
+            if not chunk:
+                return []
+            start = len(self.buffer) - len(self.buffer.lstrip())
+            return [(start, start + len(chunk), chunk)]
+        return self._advance(final=True)
+
+    def _boundary(self, text, base, total, final):
+        """Next boundary after self.cut, or None if it depends on text not yet fed"""
+        cut = self.cut
+        limit = cut + self.max_size
+        fallback = None
+        for match in SENTENCE_BREAK.finditer(text, cut + self.min_size - base, min(limit, total) - base):
+            end = match.end()
+            fallback = end + base
+            window = text[max(end - CHUNK_BOUNDARY_WINDOW, 0):end]
+            if zlib.crc32(window.encode('utf-8', 'surrogatepass')) % CHUNK_BOUNDARY_DIVISOR == 0:
+                return end + base
+        if limit <= total:
+            # No chosen break within max_size: use the last sentence break, or cut hard
+            return fallback or limit
+        return total if final else None
+
+    def _advance(self, final):
+        text = self.buffer
+        base = self.offset
+        total = self.length
+        chunks = []
+
+        while self.cut < total:
+            end = self._boundary(text, base, total, final)
+            if end is None:
+                break
+            start = max(self.cut - self.overlap, 0)
+            segment = text[start - base:end - base]
+            chunk = segment.strip()
+            if chunk:
+                chunk_start = start + len(segment) - len(segment.lstrip())
+                chunks.append((chunk_start, chunk_start + len(chunk), chunk))
+            self.cut = end
+
+        keep_from = max(self.cut - self.overlap, 0)
+        if keep_from > base:
+            self.buffer = text[keep_from - base:]
+            self.offset = keep_from
+        return chunks
+
+def chunk_text_spans(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Split text into overlapping chunks, as (start, end, text) tuples"""
+    chunker = StreamingChunker(chunk_size, overlap)
+    return chunker.feed(text) + chunker.finish()
+
+def utf8_offsets(text, offsets):
+    """Map character offsets into text to byte offsets into its UTF-8 encoding"""
+    if text.isascii():
+        return {offset: offset for offset in offsets}
+    byte_offsets = {}
+    previous = 0
+    position = 0
+    for offset in sorted(set(offsets)):
+        position += len(text[previous:offset].encode('utf-8'))
+        byte_offsets[offset] = position
+        previous = offset
+    return byte_offsets
+
+def get_extract_pool():
+    global extract_pool
+    with extract_pool_lock:
+        if extract_pool is None:
+            # spawn rather than fork: forking a process that runs request threads is unsafe
+            extract_pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_MAX_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return extract_pool
+
+def iter_pdf_pages(file_path):
+    """Yield PDF page texts in order, parsing page ranges in parallel processes"""
+    # Imported on first use; the pool processes import only this small module
+    try:
+        from src.pdf_extract import count_pdf_pages, extract_pdf_pages
+    except ImportError:  # Run as python src/app.py
+        from pdf_extract import count_pdf_pages, extract_pdf_pages
+    page_count = count_pdf_pages(file_path)
+
+    if page_count <= PDF_PAGES_PER_TASK:
+        yield from extract_pdf_pages(file_path, 0, page_count)
+        return
+
+    pool = get_extract_pool()
+    futures = [
+        pool.submit(extract_pdf_pages, file_path, start, min(start + PDF_PAGES_PER_TASK, page_count))
+        for start in range(0, page_count, PDF_PAGES_PER_TASK)
+    ]
+    try:
+        for future in futures:
+            # Ranges finish in roughly submission order, so early pages stream out first
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+def iter_document_pages(file_path, filename):
+    """Yield the text of a file page by page; text and DOCX files are a single page.
+
+    The PDF and DOCX parsers are imported on first use of their file type.
+    """
+    file_ext = filename.rsplit('.', 1)[1].lower()
+    logger.info(f"Extracting text from {filename} (type: {file_ext})")
+    
+    if file_ext == 'txt' or file_ext == 'md':
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
+            yield file.read()
+    
+    elif file_ext == 'pdf':
+        yield from iter_pdf_pages(file_path)
+    
+    elif file_ext == 'docx':
+        import docx
+        doc = docx.Document(file_path)
+        yield "".join(paragraph.text + "\n" for paragraph in doc.paragraphs)
+    
+    else:
+        raise ValueError(f"Unsupported file type: {file_ext}")
+
+class EmbeddingCache:
+    """Bounded LRU cache of embeddings keyed by a hash of (model, input_type, text).
+
+    With a ttl (seconds), entries older than that are treated as misses.
+    """
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (embedding, expires_at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(model, input_type, text):
+        normalized = " ".join(unicodedata.normalize('NFC', text).split())
+        return hashlib.sha256(f"{model}\x00{input_type}\x00{normalized}".encode('utf-8')).digest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            embedding, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, key, embedding):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (embedding, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE)
+query_embedding_cache = EmbeddingCache(QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+# Shared by all uploads so the total number of in-flight embed calls stays bounded
+embed_executor = ThreadPoolExecutor(max_workers=EMBED_MAX_WORKERS, thread_name_prefix='embed')
+# Multi-batch query embeds (batch search), kept out of the upload backlog in embed_executor
+search_embed_executor = ThreadPoolExecutor(max_workers=dict(MODEL_LANES)["background"], thread_name_prefix='embed-search')
+embed_queue_depth = 0  # Embed tasks submitted but not yet started
+embed_queue_lock = threading.Lock()
+
+def submit_embed(fn, *args, executor=embed_executor):
+    """Run fn(*args) on an embed executor in a copy of the caller's context,
+    so the trace id follows the work, and count it while it waits."""
+    global embed_queue_depth
+    context = contextvars.copy_context()
+
+    def dequeue():
+        global embed_queue_depth
+        with embed_queue_lock:
+            embed_queue_depth -= 1
+
+    def run():
+        dequeue()
+        return context.run(fn, *args)
+
+    with embed_queue_lock:
+        embed_queue_depth += 1
+    future = executor.submit(run)
+    # A task cancelled before it started never runs dequeue itself
+    future.add_done_callback(lambda done: done.cancelled() and dequeue())
+    return future
+
+class ModelCallScheduler:
+    """Gate for every outbound Cohere call: priority lanes sharing one token bucket.
+
+    A call waits in its lane (interactive chats and query embeds, open chat
+    streams, background work, bulk document embeds) until it is the oldest call of the highest
+    priority lane that is under its concurrency limit, and a token is free.
+    Tokens refill at `rate` per second up to `burst`; a rate of 0 disables the
+    bucket and leaves only the lane limits. The limit is per worker process.
+    """
+
+    def __init__(self, rate, burst, lanes):
+        self.rate = rate
+        self.burst = burst
+        self.limits = OrderedDict(lanes)
+        self.cond = threading.Condition()
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.queues = {lane: deque() for lane in self.limits}
+        self.running = dict.fromkeys(self.limits, 0)
+        self.calls = dict.fromkeys(self.limits, 0)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def _try_start(self, lane, ticket):
+        """Start the queued ticket if it is next. Returns 0 when started, else seconds
+        until a token is due, or None to wait for another call to start or finish."""
+        for name, limit in self.limits.items():
+            if self.queues[name] and self.running[name] < limit:
+                break
+        else:
+            return None
+        if name != lane or self.queues[lane][0] is not ticket:
+            return None
+        if self.rate > 0:
+            self._refill()
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.queues[lane].popleft()
+        self.running[lane] += 1
+        self.calls[lane] += 1
+        self.cond.notify_all()
+        return 0
+
+    def _release(self, lane):
+        with self.cond:
+            self.running[lane] -= 1
+            self.cond.notify_all()
+
+    def _abandon(self, lane, ticket):
+        with self.cond:
+            if ticket in self.queues[lane]:
+                self.queues[lane].remove(ticket)
+                self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, lane):
+        """Hold one call slot in lane for the duration of the block"""
+        started = time.perf_counter()
+        ticket = object()
+        with self.cond:
+            self.queues[lane].append(ticket)
+            try:
+                while True:
+                    wait = self._try_start(lane, ticket)
+                    if wait == 0:
+                        break
+                    self.cond.wait(wait)
+            except BaseException:
+                self.queues[lane].remove(ticket)
+                self.cond.notify_all()
+                raise
+        latency_metrics.observe("chatty_model_queue_seconds", {"lane": lane}, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    @asynccontextmanager
+    async def slot_async(self, lane):
+        """slot for coroutines: polls instead of blocking the event loop"""
+        started = time.perf_counter()
+        ticket = object()
+        with self.cond:
+            self.queues[lane].append(ticket)
+        try:
+            while True:
+                with self.cond:
+                    wait = self._try_start(lane, ticket)
+                if wait == 0:
+                    break
+                await asyncio.sleep(min(wait or MODEL_ASYNC_POLL_SECONDS, 1.0))
+        except BaseException:
+            self._abandon(lane, ticket)
+            raise
+        latency_metrics.observe("chatty_model_queue_seconds", {"lane": lane}, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    def stats(self):
+        with self.cond:
+            if self.rate > 0:
+                self._refill()
+            return {
+                "calls_per_minute": self.rate * 60,
+                "tokens": round(self.tokens, 2) if self.rate > 0 else None,
+                "lanes": {lane: {
+                    "limit": limit,
+                    "queued": len(self.queues[lane]),
+                    "running": self.running[lane],
+                    "calls": self.calls[lane]
+                } for lane, limit in self.limits.items()}
+            }
+
+model_scheduler = ModelCallScheduler(MODEL_CALLS_PER_MINUTE / 60, MODEL_CALL_BURST, MODEL_LANES)
+
+def is_transient_error(error):
+    """Rate limits, server errors and network failures are worth retrying"""
+    # Both are loaded by the time a call has failed
+    import httpx
+    from cohere.core import ApiError
+    if isinstance(error, ApiError):
+        return error.status_code == 429 or (error.status_code or 0) >= 500
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+def embed_lane(input_type, lane=None):
+    return lane or ("interactive" if input_type == "search_query" else "bulk")
+
+def embed_batch(texts, input_type, lane=None):
+    """Embed one API-sized batch, retrying transient failures with exponential backoff.
+
+    Query embeds go in the interactive lane and document embeds in the bulk
+    lane unless a lane is given.
+    """
+    lane = embed_lane(input_type, lane)
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            with model_scheduler.slot(lane):
+                response = get_cohere_client().embed(
+                    texts=texts,
+                    model=EMBED_MODEL,
+                    input_type=input_type,
+                    embedding_types=["float"]
+                )
+            return response.embeddings.float_
+        except Exception as e:
+            if attempt == EMBED_MAX_RETRIES or not is_transient_error(e):
+                raise
+            delay = EMBED_RETRY_BASE_DELAY * (2 ** attempt) * (1 + random.random())
+            logger.warning(f"Embedding batch of {len(texts)} failed ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def embed_batched(texts, input_type, progress=None, lane=None):
+    """Split texts into batches, embed them concurrently and return embeddings in input order"""
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    if len(batches) == 1:
+        return embed_batch(batches[0], input_type, lane)
+
+    logger.info(f"Embedding {len(texts)} texts in {len(batches)} batches")
+    executor = embed_executor if embed_lane(input_type, lane) == "bulk" else search_embed_executor
+    futures = [submit_embed(embed_batch, batch, input_type, lane, executor=executor) for batch in batches]
+    try:
+        embeddings = []
+        for future in futures:
+            embeddings.extend(future.result())
+            if progress is not None:
+                progress(len(embeddings), len(texts))
+        return embeddings
+    except Exception:
+        for future in futures:
+            future.cancel()
+        raise
+
+class QueryEmbedBatcher:
+    """Coalesces concurrent single-query embeds into one batched co.embed call.
+
+    The first caller to arrive waits `window` seconds for others to join, then
+    embeds every distinct pending text in one request. A batch that fills up
+    is sent immediately by the caller that filled it. Each caller gets back
+    its own vector.
+    """
+
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.pending = []  # (text, Future)
+        self.requests = 0
+        self.batches = 0
+
+    def embed(self, text):
+        future = Future()
+        batch = None
+        with self.lock:
+            leader = not self.pending
+            self.pending.append((text, future))
+            self.requests += 1
+            if len(self.pending) >= self.max_batch:
+                batch, self.pending = self.pending, []
+
+        if batch is None and leader:
+            time.sleep(self.window)
+            with self.lock:
+                batch, self.pending = self.pending, []
+        if batch:
+            self._run(batch)
+        return future.result()
+
+    def _run(self, batch):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        with self.lock:
+            self.batches += 1
+        try:
+            embeddings = dict(zip(texts, embed_batch(texts, "search_query")))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for text, future in batch:
+            future.set_result(np.asarray(embeddings[text], dtype=np.float32))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "queries_per_batch": self.requests / self.batches if self.batches else 0.0
+            }
+
+query_embed_batcher = QueryEmbedBatcher(QUERY_BATCH_WINDOW, EMBED_BATCH_SIZE)
+
+class EmbedPacker:
+    """Packs the chunks of files ingested together into full-size embed calls.
+
+    Each file hands over its chunks as they are produced and gets back a
+    Future for the embeddings of that group. Full batches are sent right away.
+    Leftover chunks wait until no file is still chunking, so the last chunks
+    of many small files share calls instead of costing one call per file.
+    """
+
+    def __init__(self, batch_size=EMBED_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pending = []  # (group, position, text)
+        self.chunking = set()  # job ids that may still add chunks
+        self.calls = 0
+
+    def start(self, job_id):
+        with self.lock:
+            self.chunking.add(job_id)
+
+    def finish(self, job_id):
+        """The job will add no more chunks. Safe to call more than once."""
+        with self.lock:
+            self.chunking.discard(job_id)
+            batch = []
+            if not self.chunking:
+                batch, self.pending = self.pending, []
+        if batch:
+            self._submit(batch)
+
+    def add(self, texts):
+        future = Future()
+        # Marked running so a caller's cancel() cannot race with the result being set
+        future.set_running_or_notify_cancel()
+        if not texts:
+            future.set_result([])
+            return future
+        group = {"future": future, "embeddings": [None] * len(texts), "remaining": len(texts)}
+        batches = []
+        with self.lock:
+            self.pending.extend((group, position, text) for position, text in enumerate(texts))
+            while len(self.pending) >= self.batch_size:
+                batches.append(self.pending[:self.batch_size])
+                self.pending = self.pending[self.batch_size:]
+        for batch in batches:
+            self._submit(batch)
+        return future
+
+    def _submit(self, batch):
+        with self.lock:
+            self.calls += 1
+        submit_embed(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            embeddings = embed_texts([text for _, _, text in batch], "search_document")
+        except Exception as e:
+            for group in {id(group): group for group, _, _ in batch}.values():
+                if not group["future"].done():
+                    group["future"].set_exception(e)
+            return
+        completed = []
+        with self.lock:
+            for (group, position, _), embedding in zip(batch, embeddings):
+                group["embeddings"][position] = embedding
+                group["remaining"] -= 1
+                if group["remaining"] == 0:
+                    completed.append(group)
+        for group in completed:
+            if not group["future"].done():
+                group["future"].set_result(group["embeddings"])
+
+def embed_query(query):
+    """Embedding for a search query, from the TTL cache or a coalesced embed call"""
+    key = EmbeddingCache.make_key(EMBED_MODEL, "search_query", query)
+    with timed_stage("query_embed"):
+        embedding = query_embedding_cache.get(key)
+        if embedding is None:
+            embedding = query_embed_batcher.embed(query)
+            query_embedding_cache.put(key, embedding)
+    return embedding
+
+def embed_texts(texts, input_type="search_document", progress=None, cache=None, lane=None):
+    """Generate embeddings for texts using Cohere API, skipping cached texts.
+
+    progress, if given, is called as progress(done, total) as batches finish.
+    cache defaults to the document embedding cache; lane is passed to embed_batch.
+    """
+    cache = cache or embedding_cache
+    keys = [EmbeddingCache.make_key(EMBED_MODEL, input_type, text) for text in texts]
+    embeddings = [cache.get(key) for key in keys]
+
+    # Only send each distinct uncached text once
+    missing = {}
+    for i, (key, embedding) in enumerate(zip(keys, embeddings)):
+        if embedding is None:
+            missing.setdefault(key, []).append(i)
+
+    if missing:
+        miss_texts = [texts[positions[0]] for positions in missing.values()]
+        logger.info(f"Generating embeddings for {len(miss_texts)} of {len(texts)} texts ({len(texts) - len(miss_texts)} cached)")
+        cached_count = len(texts) - sum(len(positions) for positions in missing.values())
+        batch_progress = None
+        if progress is not None:
+            batch_progress = lambda done, total: progress(cached_count + done, len(texts))
+        for (key, positions), embedding in zip(missing.items(), embed_batched(miss_texts, input_type, batch_progress, lane)):
+            embedding = np.asarray(embedding, dtype=np.float32)
+            cache.put(key, embedding)
+            for i in positions:
+                embeddings[i] = embedding
+    else:
+        logger.info(f"All {len(texts)} embeddings served from cache")
+    if progress is not None:
+        progress(len(texts), len(texts))
+    return embeddings
+
+@contextmanager
+def file_lock(path):
+    """Exclusive advisory lock shared by every worker process on this host"""
+    with open(path, 'a+') as handle:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+def write_atomic(path, write):
+    """Write a file through a temporary sibling so readers never see partial data"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as handle:
+        write(handle)
+    os.replace(tmp_path, path)
+
+class EmbeddingStore:
+    """Disk-backed embedding store for one user, shared by all worker processes.
+
+    Every uploaded document is written as its own segment: a normalized float32
+    ``.npy`` matrix plus a JSON file with the chunk metadata. Segments are merged
+    into a single base file once there are enough of them. ``manifest.json`` lists
+    the live base, segments and document records, and is replaced atomically under
+    a file lock. Readers memory-map the ``.npy`` files, so opening them is zero-copy.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        self.lock_path = os.path.join(path, '.lock')
+        self.lock = threading.Lock()
+        self._manifest = None
+        self._manifest_stat = None
+
+    @staticmethod
+    def empty_manifest():
+        return {"version": 0, "base": None, "base_deleted": [], "segments": []}
+
+    def load_manifest(self):
+        """Return the current manifest, re-reading it only when the file changed"""
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return self.empty_manifest()
+        stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stat_key != self._manifest_stat:
+            with open(self.manifest_path, 'r', encoding='utf-8') as handle:
+                self._manifest = json.load(handle)
+            self._manifest_stat = stat_key
+        return self._manifest
+
+    def _save_manifest(self, manifest):
+        manifest["version"] += 1
+        data = json.dumps(manifest).encode('utf-8')
+        write_atomic(self.manifest_path, lambda handle: handle.write(data))
+
+    @contextmanager
+    def _update(self):
+        with self.lock, file_lock(self.lock_path):
+            self._manifest_stat = None
+            manifest = json.loads(json.dumps(self.load_manifest()))
+            yield manifest
+            self._save_manifest(manifest)
+
+    def file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def load_matrix(self, name):
+        return np.load(self.file_path(name), mmap_mode='r')
+
+    def load_metadata(self, name):
+        with open(self.file_path(name), 'r', encoding='utf-8') as handle:
+            return json.load(handle)
+
+    def _write_matrix(self, name, vectors):
+        write_atomic(self.file_path(name), lambda handle: np.save(handle, vectors))
+
+    def _write_metadata(self, name, metadata):
+        data = json.dumps(metadata).encode('utf-8')
+        write_atomic(self.file_path(name), lambda handle: handle.write(data))
+
+    def _remove_files(self, *names):
+        for name in names:
+            try:
+                os.remove(self.file_path(name))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def document_content_name(doc_id, version=1):
+        # Each version gets its own file, so searches against the old rows keep working during a replace
+        return f"doc-{doc_id}.txt" if version == 1 else f"doc-{doc_id}-v{version}.txt"
+
+    def write_document_content(self, doc_id, content, version=1):
+        """Write a document's extracted text, returning the file name to record"""
+        name = self.document_content_name(doc_id, version)
+        data = content.encode('utf-8')
+        write_atomic(self.file_path(name), lambda handle: handle.write(data))
+        return name
+
+    def take_legacy_documents(self):
+        """Remove and return document records from manifests written before state_backend existed"""
+        if not self.load_manifest().get("documents"):
+            return []
+        with self._update() as manifest:
+            return manifest.pop("documents", [])
+
+    def load_document_content(self, record, max_chars=-1):
+        with open(self.file_path(record['content_file']), 'r', encoding='utf-8') as handle:
+            return handle.read(max_chars)
+
+    def read_document_slice(self, doc_id, byte_start, byte_end, version=1):
+        """Read part of a document's extracted text by its UTF-8 byte offsets"""
+        with open(self.file_path(self.document_content_name(doc_id, version)), 'rb') as handle:
+            handle.seek(byte_start)
+            return handle.read(byte_end - byte_start).decode('utf-8', errors='replace')
+
+    def load_document_rows(self, doc_id):
+        """(vectors, chunk metadata) of a live document, read from its segment or the base"""
+        manifest = self.load_manifest()
+        for segment in manifest["segments"]:
+            if segment["doc_id"] == doc_id:
+                return self.load_matrix(f"{segment['name']}.npy"), self.load_metadata(f"{segment['name']}.json")
+        base = manifest["base"]
+        if base and doc_id in base["documents"] and doc_id not in manifest["base_deleted"]:
+            start, end = base["documents"][doc_id]
+            return (self.load_matrix(f"{base['name']}.npy")[start:end],
+                    self.load_metadata(f"{base['name']}.json")[start:end])
+        return None, []
+
+    def add_segment(self, doc_id, filename, vectors, chunk_metadata):
+        """Write a document's normalized vectors as a new segment"""
+        segment_name = f"seg-{doc_id}-{uuid.uuid4().hex[:8]}"
+        self._write_matrix(f"{segment_name}.npy", vectors)
+        self._write_metadata(f"{segment_name}.json", chunk_metadata)
+        stale = []
+        with self._update() as manifest:
+            stale = self._drop_document_rows(manifest, doc_id)
+            manifest["segments"].append({
+                "doc_id": doc_id,
+                "filename": filename,
+                "name": segment_name,
+                "rows": len(vectors)
+            })
+            if len(manifest["segments"]) > STORE_MAX_SEGMENTS:
+                stale += self._compact(manifest)
+        self._remove_files(*stale)
+
+    def remove_content_file(self, name):
+        self._remove_files(name)
+
+    def remove_document(self, doc_id, content_file=None):
+        """Remove a document's embeddings and, if given, its content file"""
+        stale = []
+        with self._update() as manifest:
+            stale = self._drop_document_rows(manifest, doc_id)
+            base = manifest["base"]
+            if base and base["dead_rows"] > base["rows"] * INDEX_COMPACT_RATIO:
+                stale += self._compact(manifest)
+        if content_file:
+            stale.append(content_file)
+        self._remove_files(*stale)
+
+    def _drop_document_rows(self, manifest, doc_id):
+        """Unlink a document from the manifest, returning segment files to delete"""
+        stale = []
+        kept = []
+        for segment in manifest["segments"]:
+            if segment["doc_id"] == doc_id:
+                stale += [f"{segment['name']}.npy", f"{segment['name']}.json"]
+            else:
+                kept.append(segment)
+        manifest["segments"] = kept
+
+        base = manifest["base"]
+        if base and doc_id in base["documents"] and doc_id not in manifest["base_deleted"]:
+            start, end = base["documents"][doc_id]
+            manifest["base_deleted"].append(doc_id)
+            base["dead_rows"] += end - start
+        return stale
+
+    def _compact(self, manifest):
+        """Merge the live base rows and every segment into a new base file"""
+        blocks = []
+        metadata = []
+        documents = {}
+        row = 0
+        base = manifest["base"]
+        if base:
+            base_matrix = self.load_matrix(f"{base['name']}.npy")
+            base_metadata = self.load_metadata(f"{base['name']}.json")
+            for doc_id, (start, end) in base["documents"].items():
+                if doc_id in manifest["base_deleted"]:
+                    continue
+                blocks.append(base_matrix[start:end])
+                metadata += base_metadata[start:end]
+                documents[doc_id] = (row, row + end - start)
+                row += end - start
+        for segment in manifest["segments"]:
+            blocks.append(self.load_matrix(f"{segment['name']}.npy"))
+            metadata += self.load_metadata(f"{segment['name']}.json")
+            documents[segment["doc_id"]] = (row, row + segment["rows"])
+            row += segment["rows"]
+        if not blocks:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+        else:
+            vectors = np.ascontiguousarray(np.concatenate(blocks), dtype=np.float32)
+
+        base_name = f"base-{manifest['version'] + 1}-{uuid.uuid4().hex[:8]}"
+        self._write_matrix(f"{base_name}.npy", vectors)
+        self._write_metadata(f"{base_name}.json", metadata)
+
+        stale = []
+        if base:
+            stale += [f"{base['name']}.npy", f"{base['name']}.json"]
+        for segment in manifest["segments"]:
+            stale += [f"{segment['name']}.npy", f"{segment['name']}.json"]
+        manifest["base"] = {"name": base_name, "rows": row, "dead_rows": 0, "documents": documents}
+        manifest["base_deleted"] = []
+        manifest["segments"] = []
+        logger.info(f"Compacted embedding store {self.path} into {row} rows")
+        return stale
+
+class InMemoryStateBackend:
+    """Conversation memory and document records held in this process only.
+
+    Fine for tests and single-worker development; with several workers each one
+    sees only its own state. SQLiteStateBackend has the same methods.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.memory = {}  # user_id -> list of messages
+        self.summaries = {}  # user_id -> running summary of folded messages
+        self.documents = {}  # user_id -> {doc_id: record}, in upload order
+        self.versions = {}  # user_id -> documents version
+        self.collections = {}  # collection_id -> record
+        self.subscriptions = {}  # user_id -> list of collection_ids
+
+    def get_memory(self, user_id):
+        """Return (summary, messages) for a user"""
+        with self.lock:
+            return self.summaries.get(user_id, ""), list(self.memory.get(user_id, []))
+
+    def append_memory(self, user_id, messages, keep):
+        with self.lock:
+            self.memory[user_id] = (self.memory.get(user_id, []) + messages)[-keep:]
+
+    def fold_memory(self, user_id, folded, summary):
+        """Replace the oldest messages with a summary, unless they changed since they were read"""
+        with self.lock:
+            messages = self.memory.get(user_id, [])
+            if messages[:len(folded)] != folded:
+                return False
+            self.memory[user_id] = messages[len(folded):]
+            self.summaries[user_id] = summary
+            return True
+
+    def list_documents(self, user_id):
+        with self.lock:
+            return list(self.documents.get(user_id, {}).values())
+
+    def get_document(self, user_id, doc_id):
+        with self.lock:
+            return self.documents.get(user_id, {}).get(doc_id)
+
+    def put_document(self, user_id, record):
+        with self.lock:
+            self.documents.setdefault(user_id, {})[record["id"]] = record
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+    def delete_document(self, user_id, doc_id):
+        """Remove a document record, returning it, or None if it does not exist"""
+        with self.lock:
+            record = self.documents.get(user_id, {}).pop(doc_id, None)
+            if record is not None:
+                self.versions[user_id] = self.versions.get(user_id, 0) + 1
+            return record
+
+    def documents_version(self, user_id):
+        with self.lock:
+            return self.versions.get(user_id, 0)
+
+    def list_collections(self):
+        with self.lock:
+            return list(self.collections.values())
+
+    def get_collection(self, collection_id):
+        with self.lock:
+            return self.collections.get(collection_id)
+
+    def put_collection(self, record):
+        with self.lock:
+            self.collections[record["collection_id"]] = record
+
+    def delete_collection(self, collection_id):
+        """Remove a collection record and its subscriptions, returning the record, or None"""
+        with self.lock:
+            record = self.collections.pop(collection_id, None)
+            for user_id, collection_ids in self.subscriptions.items():
+                if collection_id in collection_ids:
+                    collection_ids.remove(collection_id)
+                    self.versions[user_id] = self.versions.get(user_id, 0) + 1
+            return record
+
+    def list_subscriptions(self, user_id):
+        with self.lock:
+            return list(self.subscriptions.get(user_id, []))
+
+    def count_subscribers(self):
+        with self.lock:
+            return Counter(collection_id for collection_ids in self.subscriptions.values() for collection_id in collection_ids)
+
+    def set_subscription(self, user_id, collection_id, subscribed):
+        """Subscribe or unsubscribe a user; returns whether anything changed"""
+        with self.lock:
+            collection_ids = self.subscriptions.setdefault(user_id, [])
+            if (collection_id in collection_ids) == subscribed:
+                return False
+            if subscribed:
+                collection_ids.append(collection_id)
+            else:
+                collection_ids.remove(collection_id)
+            # Subscriptions change what the user's searches see, so they count as a document change
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+            return True
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        return {"backend": self.name, "pending_writes": 0}
+
+class SQLiteStateBackend:
+    """Conversation memory and document records in a SQLite database in WAL mode.
+
+    Every worker process on the host opens the same file, so a follow-up request
+    finds the user's history and documents whichever worker it lands on. Writes
+    are queued to one writer thread per process, which commits everything queued
+    so far in a single transaction. Memory reads come from a per-process cache
+    that is dropped whenever another connection commits (``PRAGMA data_version``),
+    except for users whose own writes are still queued.
+    """
+
+    name = "sqlite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS memory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS memory_user ON memory (user_id, id);
+        CREATE TABLE IF NOT EXISTS memory_summaries (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS documents (
+            user_id TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            record TEXT NOT NULL,
+            PRIMARY KEY (user_id, doc_id)
+        );
+        CREATE INDEX IF NOT EXISTS documents_user ON documents (user_id, seq);
+        CREATE TABLE IF NOT EXISTS document_versions (
+            user_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS collections (
+            collection_id TEXT PRIMARY KEY,
+            record TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS collection_subscriptions (
+            user_id TEXT NOT NULL,
+            collection_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (user_id, collection_id)
+        );
+        CREATE INDEX IF NOT EXISTS collection_subscribers ON collection_subscriptions (collection_id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()  # Guards the reader connection and the caches
+        self._pid = None
+        self._reader = None
+        self._writes = None
+        self._memory_cache = OrderedDict()  # user_id -> (summary, list of messages)
+        self._cache_data_version = None
+        self._pending = {}  # user_id -> queued memory writes
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _ensure_open(self):
+        # Connections and the writer thread do not survive a fork, so they are opened per process
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            writer = self._connect()
+            writer.executescript(self.SCHEMA)
+            self._reader = self._connect()
+            self._writes = queue.Queue()
+            self._memory_cache = OrderedDict()
+            self._cache_data_version = None
+            self._pending = {}
+            threading.Thread(target=self._write_loop, args=(writer, self._writes), name='state-writer', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _write_loop(self, connection, writes):
+        while True:
+            batch = [writes.get()]
+            while len(batch) < STATE_WRITE_BATCH:
+                try:
+                    batch.append(writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                results = [write(connection) for write, _, _ in batch]
+                connection.execute("COMMIT")
+                outcomes = [(result, None) for result in results]
+            except Exception:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                # Retry one by one so a single bad write does not fail the rest of the batch
+                outcomes = []
+                for write, _, _ in batch:
+                    try:
+                        connection.execute("BEGIN IMMEDIATE")
+                        result = write(connection)
+                        connection.execute("COMMIT")
+                        outcomes.append((result, None))
+                    except Exception as e:
+                        if connection.in_transaction:
+                            connection.execute("ROLLBACK")
+                        outcomes.append((None, e))
+
+            with self.lock:
+                for _, user_id, _ in batch:
+                    if user_id is not None:
+                        self._pending[user_id] -= 1
+                        if not self._pending[user_id]:
+                            del self._pending[user_id]
+            for (_, _, future), (result, error) in zip(batch, outcomes):
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def _submit(self, write, user_id=None):
+        """Queue a write; user_id marks a memory write whose cached result must survive until it commits"""
+        self._ensure_open()
+        future = Future()
+        if user_id is not None:
+            with self.lock:
+                self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        self._writes.put((write, user_id, future))
+        return future
+
+    def _read(self, sql, params=()):
+        self._ensure_open()
+        with self.lock:
+            return self._reader.execute(sql, params).fetchall()
+
+    def _cached_memory(self, user_id):
+        """Return the cached (summary, messages) for a user, loading it if needed. Call with self.lock held."""
+        data_version = self._reader.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._cache_data_version:
+            self._memory_cache = OrderedDict(
+                (cached_user, messages) for cached_user, messages in self._memory_cache.items()
+                if cached_user in self._pending
+            )
+            self._cache_data_version = data_version
+        entry = self._memory_cache.get(user_id)
+        if entry is None:
+            rows = self._reader.execute(
+                "SELECT role, content FROM memory WHERE user_id = ? ORDER BY id", (user_id,)
+            ).fetchall()
+            summary = self._reader.execute(
+                "SELECT summary FROM memory_summaries WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            entry = (summary[0] if summary else "", [{"role": role, "content": content} for role, content in rows])
+            self._memory_cache[user_id] = entry
+            while len(self._memory_cache) > STATE_CACHE_SIZE:
+                self._memory_cache.popitem(last=False)
+        self._memory_cache.move_to_end(user_id)
+        return entry
+
+    def get_memory(self, user_id):
+        """Return (summary, messages) for a user"""
+        self._ensure_open()
+        with self.lock:
+            summary, messages = self._cached_memory(user_id)
+            return summary, list(messages)
+
+    def append_memory(self, user_id, messages, keep):
+        """Append messages and keep the last `keep`. Returns without waiting for the commit."""
+        self._ensure_open()
+        with self.lock:
+            summary, cached = self._cached_memory(user_id)
+            self._memory_cache[user_id] = (summary, (cached + messages)[-keep:])
+
+        def write(connection):
+            connection.executemany(
+                "INSERT INTO memory (user_id, role, content) VALUES (?, ?, ?)",
+                [(user_id, message["role"], message["content"]) for message in messages]
+            )
+            connection.execute(
+                "DELETE FROM memory WHERE user_id = ? AND id NOT IN "
+                "(SELECT id FROM memory WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                (user_id, user_id, keep)
+            )
+
+        def report_failure(future):
+            if future.exception() is not None:
+                logger.error(f"Failed to save memory for user {user_id}: {str(future.exception())}")
+
+        self._submit(write, user_id).add_done_callback(report_failure)
+
+    def fold_memory(self, user_id, folded, summary):
+        """Replace the oldest messages with a summary, unless they changed since they were read"""
+        self._ensure_open()
+        with self.lock:
+            _, cached = self._cached_memory(user_id)
+            if cached[:len(folded)] == folded:
+                self._memory_cache[user_id] = (summary, cached[len(folded):])
+
+        def write(connection):
+            rows = connection.execute(
+                "SELECT id, role, content FROM memory WHERE user_id = ? ORDER BY id LIMIT ?", (user_id, len(folded))
+            ).fetchall()
+            if [{"role": role, "content": content} for _, role, content in rows] != folded:
+                return False
+            if rows:
+                connection.execute("DELETE FROM memory WHERE user_id = ? AND id <= ?", (user_id, rows[-1][0]))
+            connection.execute(
+                "INSERT INTO memory_summaries (user_id, summary) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET summary = excluded.summary",
+                (user_id, summary)
+            )
+            return True
+
+        return self._submit(write, user_id).result()
+
+    def list_documents(self, user_id):
+        rows = self._read("SELECT record FROM documents WHERE user_id = ? ORDER BY seq", (user_id,))
+        return [json.loads(record) for record, in rows]
+
+    def get_document(self, user_id, doc_id):
+        rows = self._read("SELECT record FROM documents WHERE user_id = ? AND doc_id = ?", (user_id, doc_id))
+        return json.loads(rows[0][0]) if rows else None
+
+    @staticmethod
+    def _bump_documents_version(connection, user_id):
+        connection.execute(
+            "INSERT INTO document_versions (user_id, version) VALUES (?, 1) "
+            "ON CONFLICT (user_id) DO UPDATE SET version = version + 1",
+            (user_id,)
+        )
+
+    def put_document(self, user_id, record):
+        """Insert or replace a document record and wait until it is committed"""
+        data = json.dumps(record)
+
+        def write(connection):
+            connection.execute(
+                "INSERT INTO documents (user_id, doc_id, seq, record) VALUES "
+                "(?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM documents WHERE user_id = ?), ?) "
+                "ON CONFLICT (user_id, doc_id) DO UPDATE SET record = excluded.record",
+                (user_id, record["id"], user_id, data)
+            )
+            self._bump_documents_version(connection, user_id)
+
+        self._submit(write).result()
+
+    def delete_document(self, user_id, doc_id):
+        """Remove a document record, returning it, or None if it does not exist"""
+        def write(connection):
+            row = connection.execute(
+                "SELECT record FROM documents WHERE user_id = ? AND doc_id = ?", (user_id, doc_id)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute("DELETE FROM documents WHERE user_id = ? AND doc_id = ?", (user_id, doc_id))
+            self._bump_documents_version(connection, user_id)
+            return json.loads(row[0])
+
+        return self._submit(write).result()
+
+    def documents_version(self, user_id):
+        rows = self._read("SELECT version FROM document_versions WHERE user_id = ?", (user_id,))
+        return rows[0][0] if rows else 0
+
+    def list_collections(self):
+        rows = self._read("SELECT record FROM collections ORDER BY rowid")
+        return [json.loads(record) for record, in rows]
+
+    def get_collection(self, collection_id):
+        rows = self._read("SELECT record FROM collections WHERE collection_id = ?", (collection_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def put_collection(self, record):
+        """Insert or replace a collection record and wait until it is committed"""
+        data = json.dumps(record)
+
+        def write(connection):
+            connection.execute(
+                "INSERT INTO collections (collection_id, record) VALUES (?, ?) "
+                "ON CONFLICT (collection_id) DO UPDATE SET record = excluded.record",
+                (record["collection_id"], data)
+            )
+
+        self._submit(write).result()
+
+    def delete_collection(self, collection_id):
+        """Remove a collection record and its subscriptions, returning the record, or None"""
+        def write(connection):
+            row = connection.execute("SELECT record FROM collections WHERE collection_id = ?", (collection_id,)).fetchone()
+            subscribers = connection.execute(
+                "SELECT user_id FROM collection_subscriptions WHERE collection_id = ?", (collection_id,)
+            ).fetchall()
+            connection.execute("DELETE FROM collection_subscriptions WHERE collection_id = ?", (collection_id,))
+            connection.execute("DELETE FROM collections WHERE collection_id = ?", (collection_id,))
+            for user_id, in subscribers:
+                self._bump_documents_version(connection, user_id)
+            return json.loads(row[0]) if row else None
+
+        return self._submit(write).result()
+
+    def list_subscriptions(self, user_id):
+        rows = self._read("SELECT collection_id FROM collection_subscriptions WHERE user_id = ? ORDER BY seq", (user_id,))
+        return [collection_id for collection_id, in rows]
+
+    def count_subscribers(self):
+        rows = self._read("SELECT collection_id, COUNT(*) FROM collection_subscriptions GROUP BY collection_id")
+        return Counter(dict(rows))
+
+    def set_subscription(self, user_id, collection_id, subscribed):
+        """Subscribe or unsubscribe a user; returns whether anything changed"""
+        def write(connection):
+            if subscribed:
+                changed = connection.execute(
+                    "INSERT OR IGNORE INTO collection_subscriptions (user_id, collection_id, seq) VALUES "
+                    "(?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM collection_subscriptions WHERE user_id = ?))",
+                    (user_id, collection_id, user_id)
+                ).rowcount
+            else:
+                changed = connection.execute(
+                    "DELETE FROM collection_subscriptions WHERE user_id = ? AND collection_id = ?", (user_id, collection_id)
+                ).rowcount
+            if changed:
+                # Subscriptions change what the user's searches see, so they count as a document change
+                self._bump_documents_version(connection, user_id)
+            return bool(changed)
+
+        return self._submit(write).result()
+
+    def flush(self):
+        """Wait for every write queued so far to be committed"""
+        self._submit(lambda connection: None).result()
+
+    def stats(self):
+        self._ensure_open()
+        with self.lock:
+            return {"backend": self.name, "path": self.path, "pending_writes": self._writes.qsize(), "cached_users": len(self._memory_cache)}
+
+def create_state_backend(kind=STATE_BACKEND):
+    if kind == "sqlite":
+        return SQLiteStateBackend(STATE_DB_PATH)
+    if kind == "memory":
+        return InMemoryStateBackend()
+    raise ValueError(f"Unknown STATE_BACKEND: {kind}")
+
+state_backend = create_state_backend()
+
+def quantize_vectors(vectors, storage):
+    """Encode normalized float32 vectors for compact storage.
+
+    Returns (codes, scales). int8 codes use one float32 scale per row;
+    binary codes are sign bits packed eight per byte and have no scales.
+    """
+    if storage == 'int8':
+        max_abs = np.abs(vectors).max(axis=1)
+        max_abs[max_abs == 0] = 1.0
+        scales = (max_abs / 127.0).astype(np.float32)
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales
+    if storage == 'binary':
+        return np.packbits(np.asarray(vectors) > 0, axis=1), None
+    return np.asarray(vectors, dtype=np.float32), None
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(values):
+        return POPCOUNT_TABLE[values]
+
+def approximate_scores(codes, scales, query, storage, out):
+    """First-pass similarity of query against encoded rows, written into out"""
+    if storage == 'float':
+        np.matmul(codes, query, out=out)
+    elif storage == 'int8':
+        # Convert in blocks so the float32 temporary stays small
+        for start in range(0, len(codes), QUANTIZED_SCAN_BLOCK):
+            end = start + QUANTIZED_SCAN_BLOCK
+            out[start:end] = (codes[start:end].astype(np.float32) @ query) * scales[start:end]
+    else:
+        dims = len(query)
+        query_bits = np.packbits(query > 0)
+        for start in range(0, len(codes), QUANTIZED_SCAN_BLOCK):
+            end = start + QUANTIZED_SCAN_BLOCK
+            hamming = popcount(codes[start:end] ^ query_bits).sum(axis=1, dtype=np.int32)
+            out[start:end] = 1.0 - 2.0 * hamming / dims
+    return out
+
+def approximate_scores_batch(codes, scales, queries, storage, out):
+    """approximate_scores for a (queries, dims) matrix at once; out has one row per query"""
+    if storage == 'float':
+        np.matmul(queries, codes.T, out=out)
+        return out
+    if storage == 'binary':
+        # Dot products of +-1 signs equal dims - 2 * hamming distance
+        dims = queries.shape[1]
+        queries = np.where(queries > 0, 1.0, -1.0).astype(np.float32) / dims
+    for start in range(0, len(codes), QUANTIZED_SCAN_BLOCK):
+        end = start + QUANTIZED_SCAN_BLOCK
+        if storage == 'int8':
+            out[:, start:end] = (queries @ codes[start:end].astype(np.float32).T) * scales[start:end]
+        else:
+            signs = np.unpackbits(codes[start:end], axis=1, count=dims).astype(np.float32) * 2 - 1
+            out[:, start:end] = queries @ signs.T
+    return out
+
+def assign_ivf_lists(vectors, centroids):
+    """Index of the nearest centroid for every row, computed in bounded-size blocks"""
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), QUANTIZED_SCAN_BLOCK):
+        block = np.asarray(vectors[start:start + QUANTIZED_SCAN_BLOCK], dtype=np.float32)
+        lists[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return lists
+
+def train_ivf_centroids(vectors, nlist, iterations=IVF_TRAIN_ITERATIONS, seed=0):
+    """Spherical k-means: unit-length centroids that maximize cosine similarity"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        lists = assign_ivf_lists(vectors, centroids)
+        order = np.argsort(lists, kind='stable')
+        counts = np.bincount(lists, minlength=nlist)
+        filled = np.flatnonzero(counts)
+        sums = np.add.reduceat(vectors[order], np.concatenate(([0], np.cumsum(counts)[:-1]))[filled], axis=0)
+        new_centroids = vectors[rng.choice(len(vectors), nlist)].copy()  # reseeds empty lists
+        new_centroids[filled] = sums
+        centroids = normalize_embeddings(new_centroids)
+    return centroids
+
+class UserVectorIndex:
+    """In-memory view of one user's document chunks for similarity search.
+
+    Rows come from two blocks. The base block is the store's compacted
+    ``.npy`` file, memory-mapped read-only and shared with other workers. The
+    tail block is a contiguous matrix that new segments are appended to.
+    Rows are L2-normalized, so a query is one matrix-vector product per
+    block. Deleting a document only marks its rows dead; the tail is
+    compacted once enough of its rows are dead.
+
+    With EMBEDDING_STORAGE set to 'int8' or 'binary' only compact codes are
+    held in memory. The first pass scores those codes, and a shortlist of
+    RESCORE_CANDIDATES rows is then rescored exactly against the float32
+    vectors, read from the memory-mapped store files.
+
+    Once a user has ANN_MIN_CHUNKS live rows, queries switch to an IVF index:
+    rows are clustered around sqrt(n) k-means centroids, and only the rows in
+    the IVF_NPROBE lists closest to the query are scored. New rows are
+    assigned to their nearest centroid as they arrive. The centroids are
+    retrained when the live row count has doubled or halved since training.
+
+    Chunk metadata holds byte offsets into the document's text file rather
+    than the text itself; search results read their text from disk.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage or EMBEDDING_STORAGE
+        self.lock = threading.RLock()
+        self.store = None
+        self.version = None
+        self.base_name = None
+        self.base_matrix = None  # read-only memory map of the store's base file
+        self.base_codes = None  # base_matrix itself for float storage, else its quantized codes
+        self.base_scales = None
+        self.base_alive = np.zeros(0, dtype=bool)
+        self.base_metadata = []
+        self.matrix = None  # (capacity, ...) codes, rows [0, size) are in use
+        self.scales = None  # per-row int8 scales, parallel to matrix
+        self.alive = np.zeros(0, dtype=bool)
+        self.metadata = []
+        self.size = 0
+        self.dead_count = 0
+        self.doc_rows = {}  # doc_id -> (block, start_row, end_row)
+        self.doc_segments = {}  # doc_id -> segment name the tail rows were loaded from
+        self.doc_vectors = {}  # doc_id -> memory-mapped float32 rows, for exact rescoring of the tail
+        self.centroids = None  # IVF centroids, trained once the index is large enough
+        self.ivf_trained_rows = 0
+        self.base_lists = np.zeros(0, dtype=np.int32)  # IVF list of every base row
+        self.lists = np.zeros(0, dtype=np.int32)  # IVF list of every tail row
+
+    def __len__(self):
+        return len(self.doc_rows)
+
+    @property
+    def base_size(self):
+        return len(self.base_metadata)
+
+    @property
+    def live_count(self):
+        return int(self.base_alive.sum()) + self.size - self.dead_count
+
+    @property
+    def dimensions(self):
+        if self.base_matrix is not None:
+            return self.base_matrix.shape[1]
+        if self.doc_vectors:
+            return next(iter(self.doc_vectors.values())).shape[1]
+        if self.matrix is not None and self.storage == 'float':
+            return self.matrix.shape[1]
+        return 0
+
+    def _ensure_capacity(self, needed, codes, scales):
+        if self.matrix is None:
+            capacity = max(needed, 64)
+            self.matrix = np.zeros((capacity,) + codes.shape[1:], dtype=codes.dtype)
+            self.scales = np.zeros(capacity, dtype=np.float32) if scales is not None else None
+            self.alive = np.zeros(capacity, dtype=bool)
+            self.lists = np.zeros(capacity, dtype=np.int32)
+            return
+        if self.matrix.shape[1:] != codes.shape[1:]:
+            raise ValueError(f"Embedding dimension mismatch: index has {self.matrix.shape[1:]}, got {codes.shape[1:]}")
+        capacity = self.matrix.shape[0]
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2)
+        matrix = np.zeros((new_capacity,) + self.matrix.shape[1:], dtype=self.matrix.dtype)
+        matrix[:self.size] = self.matrix[:self.size]
+        if self.scales is not None:
+            scales = np.zeros(new_capacity, dtype=np.float32)
+            scales[:self.size] = self.scales[:self.size]
+            self.scales = scales
+        alive = np.zeros(new_capacity, dtype=bool)
+        alive[:self.size] = self.alive[:self.size]
+        lists = np.zeros(new_capacity, dtype=np.int32)
+        lists[:self.size] = self.lists[:self.size]
+        self.matrix = matrix
+        self.alive = alive
+        self.lists = lists
+
+    def add_vectors(self, doc_id, vectors, chunk_metadata):
+        """Append a document's normalized vectors to the tail, replacing any previous version"""
+        if len(vectors) == 0:
+            return
+        codes, scales = quantize_vectors(vectors, self.storage)
+        with self.lock:
+            if doc_id in self.doc_rows:
+                self.remove_document(doc_id)
+            start = self.size
+            end = start + len(vectors)
+            self._ensure_capacity(end, codes, scales)
+            self.matrix[start:end] = codes
+            if scales is not None:
+                self.scales[start:end] = scales
+            self.alive[start:end] = True
+            if self.centroids is not None:
+                self.lists[start:end] = assign_ivf_lists(vectors, self.centroids)
+            self.metadata.extend(chunk_metadata)
+            self.size = end
+            self.doc_rows[doc_id] = ('tail', start, end)
+            if self.storage != 'float':
+                self.doc_vectors[doc_id] = vectors
+
+    def remove_document(self, doc_id):
+        """Mark a document's rows dead. Returns False if the document is unknown."""
+        with self.lock:
+            rows = self.doc_rows.pop(doc_id, None)
+            self.doc_segments.pop(doc_id, None)
+            self.doc_vectors.pop(doc_id, None)
+            if rows is None:
+                return False
+            block, start, end = rows
+            if block == 'base':
+                self.base_alive[start:end] = False
+                return True
+            self.alive[start:end] = False
+            self.dead_count += end - start
+            if self.dead_count > self.size * INDEX_COMPACT_RATIO:
+                self.compact()
+            return True
+
+    def compact(self):
+        """Drop dead tail rows and rebuild the row ranges of the remaining documents"""
+        with self.lock:
+            if self.dead_count == 0:
+                return
+            keep = np.flatnonzero(self.alive[:self.size])
+            self.matrix[:len(keep)] = self.matrix[keep]
+            if self.scales is not None:
+                self.scales[:len(keep)] = self.scales[keep]
+            self.lists[:len(keep)] = self.lists[keep]
+            self.alive[:len(keep)] = True
+            self.alive[len(keep):self.size] = False
+            self.metadata = [self.metadata[i] for i in keep]
+            self.size = len(keep)
+            self.dead_count = 0
+
+            for doc_id, (block, _, _) in list(self.doc_rows.items()):
+                if block == 'tail':
+                    del self.doc_rows[doc_id]
+            for row, meta in enumerate(self.metadata):
+                _, start, _ = self.doc_rows.get(meta['doc_id'], ('tail', row, row))
+                self.doc_rows[meta['doc_id']] = ('tail', start, row + 1)
+            logger.info(f"Compacted vector index to {self.size} rows")
+
+    def _load_base(self, store, base):
+        self.base_name = base["name"] if base else None
+        self.base_matrix = None
+        self.base_codes = None
+        self.base_scales = None
+        self.base_metadata = []
+        self.base_alive = np.zeros(0, dtype=bool)
+        self.base_lists = np.zeros(0, dtype=np.int32)
+        self.matrix = None
+        self.scales = None
+        self.alive = np.zeros(0, dtype=bool)
+        self.lists = np.zeros(0, dtype=np.int32)
+        self.metadata = []
+        self.size = 0
+        self.dead_count = 0
+        self.doc_rows = {}
+        self.doc_segments = {}
+        self.doc_vectors = {}
+        if not base or base["rows"] == 0:
+            return
+        self.base_matrix = store.load_matrix(f"{base['name']}.npy")
+        self.base_codes, self.base_scales = quantize_vectors(self.base_matrix, self.storage)
+        self.base_metadata = store.load_metadata(f"{base['name']}.json")
+        self.base_alive = np.ones(base["rows"], dtype=bool)
+        if self.centroids is not None:
+            self.base_lists = assign_ivf_lists(self.base_matrix, self.centroids)
+        for doc_id, (start, end) in base["documents"].items():
+            self.doc_rows[doc_id] = ('base', start, end)
+
+    def sync(self, store):
+        """Bring the index up to date with the store, loading only what changed"""
+        self.store = store
+        manifest = store.load_manifest()
+        if manifest["version"] == self.version:
+            return
+        with self.lock:
+            base = manifest["base"]
+            if (base["name"] if base else None) != self.base_name:
+                self._load_base(store, base)
+
+            live = {segment["doc_id"]: segment["name"] for segment in manifest["segments"]}
+            if base:
+                for doc_id in base["documents"]:
+                    if doc_id not in manifest["base_deleted"]:
+                        live.setdefault(doc_id, None)
+
+            for doc_id in list(self.doc_rows):
+                if doc_id not in live or (live[doc_id] and self.doc_segments.get(doc_id) != live[doc_id]):
+                    self.remove_document(doc_id)
+
+            for segment in manifest["segments"]:
+                if segment["doc_id"] in self.doc_rows:
+                    continue
+                vectors = store.load_matrix(f"{segment['name']}.npy")
+                chunk_metadata = store.load_metadata(f"{segment['name']}.json")
+                self.add_vectors(segment["doc_id"], vectors, chunk_metadata)
+                self.doc_segments[segment["doc_id"]] = segment["name"]
+            self.version = manifest["version"]
+
+    def _row_metadata(self, row):
+        if row < self.base_size:
+            return self.base_metadata[row]
+        return self.metadata[row - self.base_size]
+
+    def _row_vectors(self, rows):
+        """Full-precision vectors for the given rows, read from the memory-mapped store"""
+        rows = np.asarray(rows)
+        base_size = self.base_size
+        vectors = np.empty((len(rows), self.dimensions), dtype=np.float32)
+        in_base = rows < base_size
+        if in_base.any():
+            vectors[in_base] = self.base_matrix[rows[in_base]]
+        tail_positions = np.flatnonzero(~in_base)
+        if not len(tail_positions):
+            # After a store compaction every row is in the base and self.matrix is None
+            return vectors
+        if self.storage == 'float':
+            vectors[tail_positions] = self.matrix[rows[tail_positions] - base_size]
+        else:
+            for position in tail_positions:
+                row = rows[position] - base_size
+                doc_id = self.metadata[row]['doc_id']
+                _, start, _ = self.doc_rows[doc_id]
+                vectors[position] = self.doc_vectors[doc_id][row - start]
+        return vectors
+
+    def _scores(self, query):
+        """First-pass scores for every row, with dead rows set to -inf"""
+        base_size = self.base_size
+        scores = np.empty(base_size + self.size, dtype=np.float32)
+        if base_size:
+            approximate_scores(self.base_codes, self.base_scales, query, self.storage, scores[:base_size])
+            scores[:base_size][~self.base_alive] = -np.inf
+        if self.size:
+            tail_scores = scores[base_size:]
+            tail_scales = self.scales[:self.size] if self.scales is not None else None
+            approximate_scores(self.matrix[:self.size], tail_scales, query, self.storage, tail_scores)
+            if self.dead_count:
+                tail_scores[~self.alive[:self.size]] = -np.inf
+        return scores
+
+    def _candidate_scores(self, rows, query):
+        """First-pass scores for a subset of live rows"""
+        base_size = self.base_size
+        scores = np.empty(len(rows), dtype=np.float32)
+        split = np.searchsorted(rows, base_size)
+        if split:
+            base_rows = rows[:split]
+            base_scales = self.base_scales[base_rows] if self.base_scales is not None else None
+            approximate_scores(self.base_codes[base_rows], base_scales, query, self.storage, scores[:split])
+        if split < len(rows):
+            tail_rows = rows[split:] - base_size
+            tail_scales = self.scales[tail_rows] if self.scales is not None else None
+            approximate_scores(self.matrix[tail_rows], tail_scales, query, self.storage, scores[split:])
+        return scores
+
+    def _train_ivf(self):
+        live_rows = np.flatnonzero(np.concatenate([self.base_alive, self.alive[:self.size]]))
+        nlist = min(max(int(np.sqrt(len(live_rows))), 16), 4096)
+        sample_size = min(len(live_rows), nlist * IVF_TRAIN_SAMPLES_PER_LIST)
+        sample = np.sort(np.random.default_rng(0).choice(live_rows, sample_size, replace=False))
+        started = time.perf_counter()
+        self.centroids = train_ivf_centroids(self._row_vectors(sample), nlist)
+        if self.base_size:
+            self.base_lists = assign_ivf_lists(self.base_matrix, self.centroids)
+        if self.size:
+            tail_rows = np.arange(self.base_size, self.base_size + self.size)
+            self.lists[:self.size] = assign_ivf_lists(self._row_vectors(tail_rows), self.centroids)
+        self.ivf_trained_rows = len(live_rows)
+        logger.info(f"Trained IVF index with {nlist} lists on {sample_size} of {len(live_rows)} rows in {time.perf_counter() - started:.2f}s")
+
+    def _use_ivf(self):
+        live = self.live_count
+        if live < ANN_MIN_CHUNKS:
+            return False
+        if self.centroids is None or not (self.ivf_trained_rows / 2 <= live <= self.ivf_trained_rows * 2):
+            self._train_ivf()
+        return True
+
+    def _top_rows(self, query, top_k, search_info=None):
+        """Return (rows, exact scores) of the best top_k live rows, best first"""
+        mode = 'exact'
+        rows = None
+        if self._use_ivf():
+            nprobe = min(IVF_NPROBE, len(self.centroids))
+            probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            probed = np.zeros(len(self.centroids), dtype=bool)
+            probed[probe] = True
+            mask = np.concatenate([
+                probed[self.base_lists] & self.base_alive,
+                probed[self.lists[:self.size]] & self.alive[:self.size]
+            ])
+            rows = np.flatnonzero(mask)
+            if len(rows) >= top_k:
+                mode = 'ivf'
+                scores = self._candidate_scores(rows, query)
+            else:
+                rows = None
+        if rows is None:
+            scores = self._scores(query)
+        if search_info is not None:
+            search_info['mode'] = mode
+            search_info['candidates'] = len(rows) if rows is not None else self.live_count
+
+        live = len(rows) if rows is not None else self.live_count
+        if self.storage == 'float':
+            k = min(top_k, live)
+            top = np.argpartition(-scores, k - 1)[:k]
+            exact = scores[top]
+        else:
+            shortlist = min(max(top_k * RESCORE_FACTOR, RESCORE_CANDIDATES), live)
+            top = np.argpartition(-scores, shortlist - 1)[:shortlist]
+            exact = None
+        if rows is not None:
+            top = rows[top]
+        if exact is None:
+            exact = self._row_vectors(top) @ query
+        order = np.argsort(-exact)[:top_k]
+        return top[order], exact[order]
+
+    def _top_rows_batch(self, queries, top_k):
+        """_top_rows for a matrix of queries, scanning every live row with one
+        matrix product per block of queries. Yields (rows, scores) per query."""
+        base_size = self.base_size
+        rows = base_size + self.size
+        live = self.live_count
+        if self.storage == 'float':
+            k = min(top_k, live)
+            block = max(1, SEARCH_BATCH_SCORE_CELLS // rows)
+        else:
+            k = min(max(top_k * RESCORE_FACTOR, RESCORE_CANDIDATES), live)
+            block = max(1, SEARCH_BATCH_SCORE_CELLS // max(rows, k * self.dimensions))
+        for start in range(0, len(queries), block):
+            chunk = queries[start:start + block]
+            scores = np.empty((len(chunk), rows), dtype=np.float32)
+            if base_size:
+                approximate_scores_batch(self.base_codes, self.base_scales, chunk, self.storage, scores[:, :base_size])
+                scores[:, :base_size][:, ~self.base_alive] = -np.inf
+            if self.size:
+                tail_scales = self.scales[:self.size] if self.scales is not None else None
+                approximate_scores_batch(self.matrix[:self.size], tail_scales, chunk, self.storage, scores[:, base_size:])
+                if self.dead_count:
+                    scores[:, base_size:][:, ~self.alive[:self.size]] = -np.inf
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            if self.storage == 'float':
+                exact = np.take_along_axis(scores, top, axis=1)
+            else:
+                vectors = self._row_vectors(top.ravel()).reshape(len(chunk), k, -1)
+                exact = np.einsum('qkd,qd->qk', vectors, chunk)
+            order = np.argsort(-exact, axis=1)[:, :top_k]
+            yield from zip(np.take_along_axis(top, order, axis=1), np.take_along_axis(exact, order, axis=1))
+
+    def search(self, query_embedding, top_k=MAX_RELEVANT_CHUNKS, threshold=SIMILARITY_THRESHOLD, search_info=None):
+        """Return up to top_k chunks with cosine similarity >= threshold, best first.
+
+        If search_info is a dict it is filled with the search mode ('exact' or
+        'ivf') and the number of rows that were scored.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query = query / norm
+
+        with self.lock:
+            if self.live_count == 0 or top_k <= 0:
+                return []
+            rows, scores = self._top_rows(query, top_k, search_info)
+            results = self._results(rows, scores, threshold)
+        return [chunk_info for chunk_info in results if self._load_text(chunk_info)]
+
+    def search_batch(self, query_embeddings, top_k=MAX_RELEVANT_CHUNKS, threshold=SIMILARITY_THRESHOLD,
+                     search_info=None, with_text=True):
+        """search for a (queries, dims) matrix at once; returns one result list per query.
+
+        Without IVF every block of queries is scored with a single matrix
+        product per index block. with_text=False skips reading chunk text
+        from disk.
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        results = [[] for _ in range(len(queries))]
+
+        with self.lock:
+            if self.live_count == 0 or top_k <= 0 or not len(queries):
+                return results
+            ivf = self._use_ivf()
+            if ivf:
+                ranked = (self._top_rows(query, top_k) for query in queries)
+            else:
+                ranked = self._top_rows_batch(queries, top_k)
+            for i, (rows, scores) in enumerate(ranked):
+                if norms[i, 0] > 0:
+                    results[i] = self._results(rows, scores, threshold)
+        if search_info is not None:
+            search_info['mode'] = 'ivf' if ivf else 'exact'
+
+        if not with_text:
+            for query_results in results:
+                for chunk_info in query_results:
+                    chunk_info.pop('text', None)
+            return results
+        texts = {}
+        return [[chunk_info for chunk_info in query_results if self._load_text(chunk_info, texts)]
+                for query_results in results]
+
+    def _results(self, rows, scores, threshold):
+        results = []
+        for row, score in zip(rows, scores):
+            score = float(score)
+            if score < threshold:
+                break
+            chunk_info = self._row_metadata(row).copy()
+            chunk_info['similarity'] = score
+            results.append(chunk_info)
+        return results
+
+    def _load_text(self, chunk_info, texts=None):
+        """Fill in a result's text from its document file. False if the document is gone.
+
+        texts, if given, caches the slices already read during one batch.
+        """
+        if 'text' in chunk_info:
+            return True
+        key = (chunk_info['doc_id'], chunk_info['byte_start'], chunk_info['byte_end'], chunk_info.get('doc_version', 1))
+        text = texts.get(key) if texts is not None else None
+        if text is None:
+            try:
+                text = self.store.read_document_slice(*key)
+            except FileNotFoundError:
+                text = False
+            if texts is not None:
+                texts[key] = text
+        if text is False:
+            return False
+        chunk_info['text'] = text
+        return True
+
+    def resident_bytes(self):
+        """Estimated memory held by this index, leaving out the memory-mapped store files"""
+        with self.lock:
+            arrays = [self.base_alive, self.base_lists, self.alive, self.lists, self.matrix, self.scales,
+                      self.base_scales, self.centroids]
+            if self.storage != 'float':
+                arrays.append(self.base_codes)
+            total = sum(array.nbytes for array in arrays if array is not None)
+            return total + (len(self.base_metadata) + len(self.metadata)) * USER_STATE_ROW_BYTES
+
+    def stats(self, recall_sample=0, top_k=MAX_RELEVANT_CHUNKS):
+        """Memory use of the in-memory codes against float32, and optionally recall@top_k.
+
+        Recall is measured by using a sample of the stored vectors as queries
+        and comparing against an exact float32 scan of every live row.
+        """
+        with self.lock:
+            rows = self.base_size + self.size
+            dims = self.dimensions
+            memory_bytes = 0
+            if self.storage != 'float' and self.base_codes is not None:
+                memory_bytes += self.base_codes.nbytes + (self.base_scales.nbytes if self.base_scales is not None else 0)
+            if self.matrix is not None:
+                memory_bytes += self.matrix[:self.size].nbytes
+                if self.scales is not None:
+                    memory_bytes += self.scales[:self.size].nbytes
+            result = {
+                "storage": self.storage,
+                "rows": rows,
+                "live_rows": self.live_count,
+                "dimensions": dims,
+                "memory_bytes": memory_bytes,
+                "float32_bytes": rows * dims * 4
+            }
+            if recall_sample and self.live_count:
+                live_rows = np.flatnonzero(np.concatenate([self.base_alive, self.alive[:self.size]]))
+                everything = self._row_vectors(live_rows)
+                sample = np.random.default_rng(0).choice(len(live_rows), min(recall_sample, len(live_rows)), replace=False)
+                k = min(top_k, len(live_rows))
+                hits = 0
+                for i in sample:
+                    query = everything[i]
+                    exact = live_rows[np.argpartition(-(everything @ query), k - 1)[:k]]
+                    found, _ = self._top_rows(query, k)
+                    hits += len(np.intersect1d(exact, found))
+                result["recall_at_k"] = hits / (len(sample) * k)
+                result["recall_k"] = k
+                result["recall_queries"] = len(sample)
+            return result
+
+def normalize_embeddings(embeddings):
+    """Convert embeddings to an L2-normalized float32 matrix"""
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def find_similar_chunks(query_embedding, indexes, top_k=MAX_RELEVANT_CHUNKS, search_info=None):
+    """Find most similar document chunks to query using cosine similarity.
+
+    indexes are (collection_id, index) pairs from searchable_indexes. Each
+    index returns its own top_k and the lists are merged, which is the exact
+    top_k over all of them. Chunks from a collection carry its collection_id.
+    """
+    indexes = [(collection_id, index) for collection_id, index in indexes if index]
+    if not indexes:
+        return []
+
+    relevant_chunks = []
+    modes = set()
+    candidates = 0
+    with timed_stage("search"):
+        for collection_id, index in indexes:
+            index_info = {}
+            found = index.search(query_embedding, top_k=top_k, search_info=index_info)
+            if collection_id is not None:
+                for chunk_info in found:
+                    chunk_info['collection_id'] = collection_id
+            relevant_chunks.extend(found)
+            modes.add(index_info.get('mode'))
+            candidates += index_info.get('candidates', 0)
+        if len(indexes) > 1:
+            relevant_chunks = sorted(relevant_chunks, key=lambda chunk_info: chunk_info['similarity'], reverse=True)[:top_k]
+    if search_info is not None:
+        search_info['mode'] = '+'.join(sorted(mode for mode in modes if mode))
+        search_info['candidates'] = candidates
+    logger.info(f"Found {len(relevant_chunks)} relevant chunks above threshold {SIMILARITY_THRESHOLD} in {len(indexes)} indexes")
+    return relevant_chunks
+
+def batch_search_chunks(queries, user_ids, top_k=MAX_RELEVANT_CHUNKS, threshold=SIMILARITY_THRESHOLD, with_text=True):
+    """Best chunks for every query across the given users' documents, best first per query.
+
+    Queries are embedded in batched calls and each user's index is scored
+    against all of them at once, as is each collection the users subscribe
+    to (once, however many of them share it). Every match carries the
+    user_id or collection_id it came from.
+    """
+    with timed_stage("batch_query_embed"):
+        query_vectors = np.vstack(embed_texts(queries, "search_query", cache=query_embedding_cache, lane="background"))
+    matches = [[] for _ in queries]
+    indexes = {}
+    for user_id in user_ids:
+        for collection_id, index in searchable_indexes(user_id):
+            indexes.setdefault(('collection_id', collection_id) if collection_id else ('user_id', user_id), index)
+    with timed_stage("batch_search"):
+        for (key, value), index in indexes.items():
+            if not len(index):
+                continue
+            user_matches = index.search_batch(query_vectors, top_k=top_k, threshold=threshold, with_text=with_text)
+            for query_matches, found in zip(matches, user_matches):
+                for chunk_info in found:
+                    chunk_info[key] = value
+                query_matches.extend(found)
+        if len(indexes) > 1:
+            matches = [sorted(query_matches, key=lambda chunk_info: chunk_info['similarity'], reverse=True)[:top_k]
+                       for query_matches in matches]
+    logger.info(f"Batch search of {len(queries)} queries over {len(indexes)} indexes found {sum(map(len, matches))} chunks")
+    return matches
+
+def estimate_tokens(text):
+    # A local estimate: calling the tokenize endpoint per message would cost more than it saves
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def estimate_prompt_tokens(messages):
+    return sum(estimate_tokens(message["content"]) for message in messages)
+
+def clip_to_tokens(text, max_tokens):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    return text if len(text) <= max_chars else text[:max_chars] + " [...]"
+
+def count_recent_messages(messages, budget):
+    """How many of the newest messages fit in `budget` tokens together"""
+    used = 0
+    for count, message in enumerate(reversed(messages)):
+        used += estimate_tokens(message["content"])
+        if used > budget:
+            return count
+    return len(messages)
+
+def get_conversation(user_id):
+    """Running summary and the recent history that fits MEMORY_TOKEN_BUDGET"""
+    summary, messages = state_backend.get_memory(user_id)
+    recent = messages[len(messages) - count_recent_messages(messages, MEMORY_TOKEN_BUDGET):]
+    if not recent and messages:
+        # The newest message alone is over budget
+        recent = [dict(messages[-1], content=clip_to_tokens(messages[-1]["content"], MEMORY_TOKEN_BUDGET))]
+    return summary, recent
+
+def get_memory(user_id):
+    return get_conversation(user_id)[1]
+
+def update_memory(user_id, user_msg, bot_msg):
+    # Older turns are folded into the running summary once the history is over budget;
+    # MEMORY_MAX_MESSAGES only bounds storage if summarizing keeps failing
+    state_backend.append_memory(user_id, [
+        {"role": "user", "content": user_msg},
+        {"role": "chatbot", "content": bot_msg}
+    ], keep=MEMORY_MAX_MESSAGES)
+    logger.debug("Updated memory for user %s", user_id)
+    schedule_memory_summary(user_id)
+
+def schedule_memory_summary(user_id):
+    _, messages = state_backend.get_memory(user_id)
+    if estimate_prompt_tokens(messages) <= MEMORY_TOKEN_BUDGET:
+        return
+    with memory_summaries_lock:
+        if user_id in memory_summaries_running:
+            return
+        memory_summaries_running.add(user_id)
+    memory_summary_executor.submit(contextvars.copy_context().run, summarize_memory, user_id)
+
+def summarize_memory(user_id):
+    """Fold everything but the most recent MEMORY_RECENT_TOKENS of history into the running summary"""
+    try:
+        summary, messages = state_backend.get_memory(user_id)
+        folded = messages[:len(messages) - count_recent_messages(messages, MEMORY_RECENT_TOKENS)]
+        if not folded:
+            return
+        transcript = "\n\n".join(
+            f"{message['role']}: {clip_to_tokens(message['content'], MEMORY_SUMMARY_INPUT_TOKENS)}" for message in folded
+        )
+        with model_scheduler.slot("background"):
+            response = get_cohere_client().chat(model=CHAT_MODEL, max_tokens=MEMORY_SUMMARY_TOKENS, messages=[
+                {
+                    "role": "system",
+                    "content": "You maintain a running summary of a conversation between a user and a chatbot. "
+                               "Merge the new messages into the current summary. Keep facts, names, numbers, "
+                               "decisions and open questions; drop pleasantries. Reply with the summary only."
+                },
+                {
+                    "role": "user",
+                    "content": f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
+                }
+            ])
+        new_summary = response.message.content[0].text.strip()
+        if state_backend.fold_memory(user_id, folded, new_summary):
+            logger.info(f"Summarized {len(folded)} messages for user {user_id} ({estimate_tokens(new_summary)} tokens)")
+    except Exception as e:
+        logger.error(f"Memory summary failed for user {user_id}: {str(e)}")
+    finally:
+        with memory_summaries_lock:
+            memory_summaries_running.discard(user_id)
+
+def user_index_path(user_id):
+    return os.path.join(INDEX_FOLDER, hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:32])
+
+def get_user_store(user_id):
+    store = user_stores.get(user_id)
+    if store is None:
+        store = EmbeddingStore(user_index_path(user_id))
+        # Document records used to live in the store's manifest; move any left there
+        for record in store.take_legacy_documents():
+            state_backend.put_document(user_id, record)
+        store = user_stores.setdefault(user_id, store)
+    return store
+
+def touch_user_state(user_id):
+    """Mark a user's loaded state as recently used, evicting the least recently
+    used users once the estimated total is over USER_STATE_MEMORY_MB.
+
+    Evicted users reload their index and document records on their next request.
+    """
+    global user_state_bytes, user_state_evictions
+    index = user_embeddings.get(user_id)
+    size = len(user_documents.get(user_id, ())) * USER_STATE_ROW_BYTES
+    if index is not None:
+        size += index.resident_bytes()
+    fallback = user_fallback_passages.get(user_id)
+    if fallback is not None:
+        size += fallback[3]
+    evicted = []
+    with user_state_lock:
+        user_state_bytes += size - user_state_usage.get(user_id, 0)
+        user_state_usage[user_id] = size
+        user_state_usage.move_to_end(user_id)
+        while user_state_bytes > USER_STATE_MEMORY_MB * 1024 * 1024 and len(user_state_usage) > 1:
+            idle_user, idle_size = user_state_usage.popitem(last=False)
+            user_state_bytes -= idle_size
+            evicted.append(idle_user)
+        user_state_evictions += len(evicted)
+    for idle_user in evicted:
+        drop_user_state(idle_user)
+    if evicted:
+        logger.info(f"Evicted in-memory state of {len(evicted)} idle users")
+
+def drop_user_state(user_id):
+    """Forget a user's loaded index and document records; they reload on next use"""
+    user_embeddings.pop(user_id, None)
+    user_documents.pop(user_id, None)
+    user_documents_version.pop(user_id, None)
+    user_document_summaries.pop(user_id, None)
+    user_fallback_passages.pop(user_id, None)
+    user_stores.pop(user_id, None)
+
+def forget_user_state_usage(user_id):
+    """Stop counting a user's loaded state, e.g. after it was deleted"""
+    global user_state_bytes
+    with user_state_lock:
+        user_state_bytes -= user_state_usage.pop(user_id, 0)
+
+def user_state_stats():
+    with user_state_lock:
+        return {
+            "users": len(user_state_usage),
+            "bytes": user_state_bytes,
+            "limit_bytes": USER_STATE_MEMORY_MB * 1024 * 1024,
+            "evictions": user_state_evictions
+        }
+
+def get_user_documents(user_id):
+    """The user's document records. Content stays on disk; see EmbeddingStore.load_document_content."""
+    store = get_user_store(user_id)
+    version = state_backend.documents_version(user_id)
+    docs = user_documents.get(user_id)
+    if docs is None or user_documents_version.get(user_id) != version:
+        docs = []
+        for record in state_backend.list_documents(user_id):
+            if 'content_preview' not in record:
+                # Records written before previews were computed at ingest
+                content = store.load_document_content(record)
+                record = dict(record, content_preview=document_preview(content))
+                record.setdefault('content_length', len(content))
+            docs.append(record)
+        user_documents[user_id] = docs
+        user_documents_version[user_id] = version
+    touch_user_state(user_id)
+    logger.debug("Retrieved %d documents for user %s", len(docs), user_id)
+    return docs
+
+def get_document_summaries(user_id):
+    """Listing summaries of the user's documents in upload order, and each one's
+    position by id. Rebuilt only after an upload or deletion changed the records."""
+    docs = get_user_documents(user_id)
+    cached = user_document_summaries.get(user_id)
+    if cached is None or cached[0] is not docs:
+        summaries = [{
+            "id": doc["id"],
+            "filename": doc["filename"],
+            "upload_time": doc["upload_time"],
+            "content_length": doc.get("content_length", 0),
+            "chunk_count": doc.get("chunk_count", 0),
+            "content_preview": doc["content_preview"]
+        } for doc in docs]
+        cached = (docs, summaries, {summary["id"]: position for position, summary in enumerate(summaries)})
+        user_document_summaries[user_id] = cached
+    return cached[1], cached[2]
+
+def encode_document_cursor(position, doc_id):
+    return base64.urlsafe_b64encode(f"{position}:{doc_id}".encode('utf-8')).decode('ascii').rstrip("=")
+
+def document_page_start(cursor, positions):
+    """Position of the first document after the cursor. Raises ValueError for a malformed cursor."""
+    if not cursor:
+        return 0
+    position, doc_id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode('utf-8').split(":", 1)
+    if doc_id in positions:
+        return positions[doc_id] + 1
+    # The cursor's document was deleted and the ones after it moved up a place
+    return max(int(position), 0)
+
+def load_fallback_documents(user_id):
+    """Copies of the records the lexical fallback ranks, with their text read from disk.
+
+    Takes the most recent documents of the user, then of each subscribed
+    collection, up to FALLBACK_MAX_DOCUMENTS and FALLBACK_MAX_CHARS in all, so
+    a large library does not make the fallback read and chunk all of it.
+    """
+    docs = []
+    remaining = FALLBACK_MAX_CHARS
+    for _, owner in searchable_owners(user_id):
+        store = get_user_store(owner)
+        owner_docs = []
+        for record in reversed(get_user_documents(owner)):
+            if len(docs) + len(owner_docs) >= FALLBACK_MAX_DOCUMENTS or remaining <= 0:
+                break
+            content = store.load_document_content(record, remaining)
+            remaining -= len(content)
+            owner_docs.append(dict(record, content=content))
+        # Back to upload order, which breaks ties between equally ranked chunks
+        docs.extend(reversed(owner_docs))
+    return docs
+
+def fallback_passages(user_id):
+    """(passages, postings) of the documents load_fallback_documents picks: their
+    chunks, and for every word the chunks it occurs in with its count there.
+
+    Rebuilt only after the documents of the user or of a subscribed collection
+    changed, so chats that fall back do not re-read and re-tokenize the text.
+    """
+    versions = tuple((owner, state_backend.documents_version(owner)) for _, owner in searchable_owners(user_id))
+    cached = user_fallback_passages.get(user_id)
+    if cached is None or cached[0] != versions:
+        passages = []
+        postings = {}
+        size = 0
+        for doc in load_fallback_documents(user_id):
+            for chunk_index, (start, end, text) in enumerate(chunk_text_spans(doc['content'])):
+                for word, count in Counter(re.findall(r"\w+", text.lower())).items():
+                    postings.setdefault(word, {})[len(passages)] = count
+                passages.append({
+                    'doc_id': doc['id'],
+                    'filename': doc['filename'],
+                    'start': start,
+                    'end': end,
+                    'text': text,
+                    'chunk_index': chunk_index
+                })
+                size += len(text) + USER_STATE_ROW_BYTES
+        cached = (versions, passages, postings, size)
+        user_fallback_passages[user_id] = cached
+    return cached[1], cached[2]
+
+def get_user_embeddings(user_id):
+    embeddings = user_embeddings.get(user_id)
+    if embeddings is None:
+        embeddings = user_embeddings.setdefault(user_id, UserVectorIndex())
+    embeddings.sync(get_user_store(user_id))
+    touch_user_state(user_id)
+    logger.debug("Retrieved embeddings for %d documents for user %s", len(embeddings), user_id)
+    return embeddings
+
+def collection_owner(collection_id):
+    """Key a collection's documents and embeddings are stored under, in place of a user_id"""
+    return f"collection:{collection_id}"
+
+def is_reserved_user_id(user_id):
+    """True for user ids that would collide with a collection_owner key"""
+    return isinstance(user_id, str) and user_id.startswith("collection:")
+
+def document_owner(user_id, collection_id=None):
+    """Key to store or list documents under: the collection's if one is given,
+    else the user's. None if the collection does not exist."""
+    if not collection_id:
+        return user_id
+    if state_backend.get_collection(str(collection_id)) is None:
+        return None
+    return collection_owner(collection_id)
+
+def searchable_owners(user_id):
+    """(collection_id, owner key) of everything a user's questions search: their own
+    documents first (collection_id None), then each collection they subscribe to"""
+    return [(None, user_id)] + [
+        (collection_id, collection_owner(collection_id)) for collection_id in state_backend.list_subscriptions(user_id)
+    ]
+
+def searchable_indexes(user_id):
+    """(collection_id, index) pairs a user's searches cover. A collection's index
+    is loaded once per worker and shared by all of its subscribers."""
+    return [(collection_id, get_user_embeddings(owner)) for collection_id, owner in searchable_owners(user_id)]
+
+def document_preview(content):
+    if len(content) > DOCUMENT_PREVIEW_CHARS:
+        return content[:DOCUMENT_PREVIEW_CHARS] + "..."
+    return content
+
+def add_user_document(user_id, doc_info):
+    """Persist a document record; its content goes to a text file next to its embeddings.
+
+    doc_info either carries the content, or a content_file already written
+    with EmbeddingStore.write_document_content.
+    """
+    record = {key: value for key, value in doc_info.items() if key != 'content'}
+    if 'content' in doc_info:
+        record['content_file'] = get_user_store(user_id).write_document_content(doc_info['id'], doc_info['content'])
+        record.setdefault('content_preview', document_preview(doc_info['content']))
+    state_backend.put_document(user_id, record)
+    response_cache.invalidate(user_id)
+    logger.info(f"Added document {doc_info['filename']} for user {user_id}")
+
+def remove_user_document(user_id, doc_id):
+    """Remove a document and its embeddings. Returns the removed record or None."""
+    store = get_user_store(user_id)
+    record = state_backend.delete_document(user_id, doc_id)
+    if record is not None:
+        store.remove_document(doc_id, record.get('content_file'))
+        response_cache.invalidate(user_id)
+    return record
+
+def store_document_embeddings(user_id, doc_id, filename, chunks_with_embeddings, version=1):
+    """Store a document's chunk vectors, replacing any earlier version's. Chunks
+    with byte offsets into the document's text file are stored without their text."""
+    vectors = normalize_embeddings([chunk['embedding'] for chunk in chunks_with_embeddings])
+    chunk_metadata = []
+    for i, chunk in enumerate(chunks_with_embeddings):
+        meta = {
+            'doc_id': doc_id,
+            'chunk_index': chunk.get('chunk_index', i),
+            'filename': filename,
+            'page': chunk.get('page'),
+            'start': chunk.get('start'),
+            'end': chunk.get('end')
+        }
+        if 'byte_start' in chunk:
+            meta['byte_start'] = chunk['byte_start']
+            meta['byte_end'] = chunk['byte_end']
+            if version != 1:
+                meta['doc_version'] = version
+        else:
+            meta['text'] = chunk['text']
+        chunk_metadata.append(meta)
+    get_user_store(user_id).add_segment(doc_id, filename, vectors, chunk_metadata)
+    logger.info(f"Stored embeddings for document {filename} (user {user_id})")
+
+def document_chunk_vectors(user_id, record):
+    """Stored vector of every chunk of a document, keyed by chunk text"""
+    store = get_user_store(user_id)
+    vectors, chunk_metadata = store.load_document_rows(record['id'])
+    if vectors is None:
+        return {}
+    content = None
+    by_text = {}
+    for row, meta in enumerate(chunk_metadata):
+        text = meta.get('text')
+        if text is None:
+            if content is None:
+                content = store.load_document_content(record).encode('utf-8')
+            text = content[meta['byte_start']:meta['byte_end']].decode('utf-8', errors='replace')
+        by_text.setdefault(text, np.array(vectors[row]))
+    return by_text
+
+def find_replaced_document(user_id, filename, document_id=None):
+    """The record an upload replaces: document_id if given, else the user's latest document with that filename"""
+    if document_id:
+        return state_backend.get_document(user_id, document_id)
+    same_name = [record for record in state_backend.list_documents(user_id) if record['filename'] == filename]
+    if not same_name:
+        return None
+    return max(same_name, key=lambda record: float(record.get('upload_time') or 0))
+
+def replaced_document_id(user_id, filename, document_id=None, replace=True):
+    """Id of the document an upload becomes the next version of, or None to add a new document"""
+    if not document_id and not replace:
+        return None
+    previous = find_replaced_document(user_id, filename, document_id)
+    return previous['id'] if previous else None
+
+def remove_previous_version(user_id, previous, current):
+    """Delete the files of a replaced version that the new one no longer uses"""
+    if previous.get('content_file') and previous['content_file'] != current['content_file']:
+        get_user_store(user_id).remove_content_file(previous['content_file'])
+    if previous.get('file_path') and previous['file_path'] != current['file_path']:
+        try:
+            os.remove(previous['file_path'])
+        except FileNotFoundError:
+            pass
+
+def merge_chunk_spans(chunks, score_key='similarity'):
+    """Merge overlapping or touching chunks of the same document into passages, best first.
+
+    Chunk text is content[start:end], so the text an overlapping chunk repeats
+    is dropped by offset. Chunks stored without offsets are kept as they are.
+    A passage scores as its best chunk.
+    """
+    passages = []
+    by_document = {}
+    for chunk in chunks:
+        if chunk.get('start') is None or chunk.get('end') is None:
+            passages.append(dict(chunk, chunk_count=1))
+        else:
+            by_document.setdefault(chunk['doc_id'], []).append(chunk)
+
+    for doc_chunks in by_document.values():
+        doc_chunks.sort(key=lambda chunk: chunk['start'])
+        current = dict(doc_chunks[0], chunk_count=1)
+        for chunk in doc_chunks[1:]:
+            if chunk['start'] > current['end']:
+                passages.append(current)
+                current = dict(chunk, chunk_count=1)
+                continue
+            if chunk['end'] > current['end']:
+                current['text'] += chunk['text'][current['end'] - chunk['start']:]
+                current['end'] = chunk['end']
+            current[score_key] = max(current[score_key], chunk[score_key])
+            current['chunk_count'] += 1
+        passages.append(current)
+
+    passages.sort(key=lambda passage: passage[score_key], reverse=True)
+    return passages
+
+def pack_context(passages, max_tokens, header):
+    """Join passages in order while they fit in max_tokens. Returns (context, tokens, passages used).
+
+    header(passage) formats the line introducing each passage. A passage that
+    does not fit is skipped, or clipped if enough room is left, so a smaller
+    one further down can still make it in.
+    """
+    parts = []
+    used = 0
+    for passage in passages:
+        title = header(passage)
+        title_tokens = estimate_tokens(title)
+        tokens = title_tokens + estimate_tokens(passage['text'])
+        if used + tokens <= max_tokens:
+            parts.append(title + passage['text'])
+            used += tokens
+            continue
+        room = max_tokens - used - title_tokens - 2  # clip_to_tokens appends a marker
+        if room >= CONTEXT_MIN_SECTION_TOKENS:
+            text = clip_to_tokens(passage['text'], room)
+            parts.append(title + text)
+            used += title_tokens + estimate_tokens(text)
+            break
+    return "\n".join(parts), used, len(parts)
+
+def prepare_semantic_context(query, user_id, max_tokens=CONTEXT_TOKEN_BUDGET, search_info=None, query_embedding=None):
+    """Prepare document context using semantic similarity search.
+
+    search_info, if given, is filled with how the index served the query.
+    query_embedding can be passed in when the caller has already embedded the query.
+    """
+    try:
+        # Generate embedding for the query
+        if query_embedding is None:
+            query_embedding = embed_query(query)
+        
+        # Get the embeddings of the user's documents and subscribed collections
+        indexes = searchable_indexes(user_id)
+        
+        if not any(index for _, index in indexes):
+            logger.info("No document embeddings found for semantic search")
+            return ""
+        
+        # Find similar chunks
+        relevant_chunks = find_similar_chunks(query_embedding, indexes, search_info=search_info)
+        
+        if not relevant_chunks:
+            logger.info("No relevant chunks found above similarity threshold")
+            return ""
+        
+        # Build context from relevant chunks, merging neighbours so overlaps are sent once
+        with timed_stage("context_build"):
+            passages = merge_chunk_spans(relevant_chunks)
+            context, tokens, used = pack_context(
+                passages,
+                max_tokens,
+                lambda passage: f"\n=== Document: {passage['filename']} (Similarity: {passage['similarity']:.3f}) ===\n"
+            )
+        logger.info(f"Prepared semantic context: ~{tokens} tokens from {used} passages ({len(relevant_chunks)} relevant chunks)")
+        return context
+        
+    except Exception as e:
+        logger.error(f"Error in semantic search: {str(e)}")
+        return ""
+
+def lexical_passages(passages, postings, query):
+    """Copies of fallback_passages' chunks ranked by query word overlap (BM25-style), best first.
+
+    Chunks sharing no words with the query rank by position, so a question
+    like "summarize this" gets the opening of every document in turn.
+    """
+    scores = [0.0] * len(passages)
+    for term in set(re.findall(r"\w+", (query or "").lower())):
+        counts = postings.get(term)
+        if not counts:
+            continue
+        weight = math.log(1 + len(passages) / len(counts))
+        for position, count in counts.items():
+            scores[position] += weight * count / (count + 1.2)
+    ranking = [(score, -passage['chunk_index']) for score, passage in zip(scores, passages)]
+    for position in sorted(range(len(passages)), key=ranking.__getitem__, reverse=True):
+        yield dict(passages[position], score=ranking[position])
+
+def prepare_document_context(passages, postings, max_tokens=CONTEXT_TOKEN_BUDGET, query=None):
+    """Prepare document context within a token budget (fallback method).
+
+    Instead of the raw documents, sends the chunks that best match the query
+    words, merged where they touch.
+    """
+    if not passages:
+        return ""
+
+    with timed_stage("context_build"):
+        selected = []
+        selected_tokens = 0
+        for candidate in lexical_passages(passages, postings, query):
+            if selected_tokens >= max_tokens:
+                break
+            selected.append(candidate)
+            selected_tokens += estimate_tokens(candidate['text'])
+
+        passages = merge_chunk_spans(selected, score_key='score')
+        context, tokens, used = pack_context(
+            passages, max_tokens, lambda passage: f"\n=== Document: {passage['filename']} ===\n"
+        )
+    logger.info(f"Prepared document context: ~{tokens} tokens from {used} of {len(passages)} passages")
+    return context
+
+def document_system_message(message, user_id, query_embedding=None, semantic=True):
+    """System message carrying the user's document context for this question, or None.
+
+    semantic=False skips the similarity search and goes straight to the fallback.
+    """
+    doc_context = ""
+    if semantic:
+        logger.info("Using semantic search for document context")
+        doc_context = prepare_semantic_context(message, user_id, query_embedding=query_embedding)
+    
+    if doc_context:
+        logger.info(f"Added semantic document context ({len(doc_context)} chars)")
+        return {
+            "role": "system", 
+            "content": f"""You are a helpful assistant with access to the user's documents. Use the following relevant document excerpts to answer questions:
+
+{doc_context}
+
+Instructions:
+- The document excerpts above were selected based on semantic similarity to the user's question
+- Each excerpt shows the document name and similarity score
+- Use this information to provide accurate, specific answers
+- Always cite which document you're referencing
+- If the excerpts don't contain relevant information, say so clearly
+"""
+        }
+    
+    # Fallback to regular document context if semantic search fails
+    passages, postings = fallback_passages(user_id)
+    if passages:
+        doc_context = prepare_document_context(passages, postings, query=message)
+        if doc_context:
+            logger.info("Used fallback document context")
+            return {
+                "role": "system", 
+                "content": f"""You are a helpful assistant with access to the user's documents:
+
+{doc_context}
+
+Instructions:
+- Use the document information above to answer questions when relevant
+- Always specify which document you're referencing
+- If the question cannot be answered from the documents, say so clearly
+"""
+            }
+    return None
+
+class ResponseCache:
+    """Answers to standalone questions, reused when a user asks nearly the same thing again.
+
+    Entries belong to one user and carry that user's document-set version; a
+    lookup only matches entries for the current version, so an upload or a
+    deletion retires every answer built on the old set. Questions match when
+    their query embeddings are within RESPONSE_CACHE_SIMILARITY. Bounded by
+    max_entries overall (least recently used users go first), per_user, and ttl.
+    """
+
+    def __init__(self, max_entries, per_user, ttl, threshold):
+        self.max_entries = max_entries
+        self.per_user = per_user
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()  # user_id -> list of entries, least recently used user first
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _live_entries(self, user_id, version):
+        """Drop a user's expired and out-of-date entries. Call with self.lock held."""
+        entries = self.entries.get(user_id)
+        if entries is None:
+            return []
+        now = time.monotonic()
+        live = [entry for entry in entries if entry["version"] == version and entry["expires_at"] > now]
+        self.size -= len(entries) - len(live)
+        if live:
+            self.entries[user_id] = live
+        else:
+            del self.entries[user_id]
+        return live
+
+    def get(self, user_id, version, use_documents, query_embedding):
+        query = normalize_embeddings([query_embedding])[0]
+        with self.lock:
+            best = None
+            best_similarity = self.threshold
+            for entry in self._live_entries(user_id, version):
+                if entry["use_documents"] != use_documents:
+                    continue
+                similarity = float(entry["embedding"] @ query)
+                if similarity >= best_similarity:
+                    best, best_similarity = entry, similarity
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(user_id)
+            return best["answer"]
+
+    def put(self, user_id, version, use_documents, query_embedding, answer):
+        entry = {
+            "version": version,
+            "use_documents": use_documents,
+            "embedding": normalize_embeddings([query_embedding])[0],
+            "answer": answer,
+            "expires_at": time.monotonic() + self.ttl
+        }
+        with self.lock:
+            entries = self._live_entries(user_id, version) + [entry]
+            self.size += 1
+            if len(entries) > self.per_user:
+                self.size -= len(entries) - self.per_user
+                self.evictions += len(entries) - self.per_user
+                entries = entries[-self.per_user:]
+            self.entries[user_id] = entries
+            self.entries.move_to_end(user_id)
+            while self.size > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += len(evicted)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.size -= len(self.entries.pop(user_id, []))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self.size,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_PER_USER, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY)
+
+def response_cache_version(user_id, use_documents):
+    """The document-set version a cached answer depends on; None when documents are not used.
+
+    Covers the subscribed collections too, so a collection upload retires its subscribers' answers.
+    """
+    if not use_documents:
+        return None
+    return tuple(state_backend.documents_version(owner) for _, owner in searchable_owners(user_id))
+
+def lookup_cached_response(user_id, message, use_documents):
+    """Check the answer cache for a standalone question.
+
+    Returns (answer, ticket). answer is None on a miss; pass the ticket to
+    store_cached_response once the model has answered.
+    """
+    try:
+        query_embedding = embed_query(message)
+    except Exception as e:
+        logger.error(f"Response cache lookup failed: {str(e)}")
+        return None, None
+    version = response_cache_version(user_id, use_documents)
+    answer = response_cache.get(user_id, version, use_documents, query_embedding)
+    if answer is not None:
+        logger.info(f"Answered from the response cache for user {user_id}")
+    return answer, (version, query_embedding)
+
+def store_cached_response(user_id, ticket, use_documents, answer):
+    if ticket is not None and answer:
+        version, query_embedding = ticket
+        response_cache.put(user_id, version, use_documents, query_embedding, answer)
+
+def assemble_chat_messages(system_message, summary, history, message):
+    """Order the pieces of a chat turn; the conversation summary rides in the system message"""
+    messages = history + [{"role": "user", "content": message}]
+    if summary:
+        summary_text = f"Summary of the earlier conversation with this user:\n{summary}"
+        if system_message:
+            system_message = dict(system_message, content=f"{system_message['content']}\n{summary_text}")
+        else:
+            system_message = {"role": "system", "content": summary_text}
+    if system_message:
+        messages = [system_message] + messages
+    return messages
+
+def build_chat_messages(user_id, message, use_documents, with_history=True):
+    """Conversation history plus the new message, led by document context if requested.
+
+    with_history=False leaves the conversation out, for answers that may be cached.
+    """
+    summary, history = get_conversation(user_id) if with_history else ("", [])
+    system_message = document_system_message(message, user_id) if use_documents else None
+    return assemble_chat_messages(system_message, summary, history, message)
+
+def sse_event(data, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {data if isinstance(data, str) else json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+class ChatStreamEncoder:
+    """Turns Cohere chat stream chunks into server-sent events.
+
+    In delta mode every event carries only the new text and the stream ends
+    with a 'done' event holding usage and timing. Otherwise each event
+    carries the whole answer so far and the stream ends with [DONE], as
+    older clients expect.
+    """
+
+    def __init__(self, delta_mode, prompt_tokens=None):
+        self.delta_mode = delta_mode
+        self.prompt_tokens = prompt_tokens
+        self.cached = False
+        self.started = time.perf_counter()
+        self.first_token_seconds = None
+        self.total_seconds = None
+        self.parts = []
+        self.usage = None
+        self.event_id = 0
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def encode(self, chunk):
+        """SSE text for one stream chunk, or None if it produces no event"""
+        if chunk.type == "message-end":
+            self.usage = usage_to_dict(getattr(chunk.delta, 'usage', None))
+            return None
+        if chunk.type != "content-delta":
+            return None
+        delta_text = chunk.delta.message.content.text
+        if self.first_token_seconds is None:
+            self.first_token_seconds = time.perf_counter() - self.started
+        self.parts.append(delta_text)
+        if self.delta_mode:
+            self.event_id += 1
+            return sse_event({'delta': delta_text}, event="delta", event_id=self.event_id)
+        return sse_event({'response': self.text})
+
+    def replay(self, text):
+        """SSE text sending a whole answer from the response cache as one event"""
+        self.cached = True
+        self.first_token_seconds = time.perf_counter() - self.started
+        self.parts.append(text)
+        if self.delta_mode:
+            self.event_id += 1
+            return sse_event({'delta': text}, event="delta", event_id=self.event_id)
+        return sse_event({'response': self.text})
+
+    def done(self):
+        self.total_seconds = time.perf_counter() - self.started
+        if not self.delta_mode:
+            return sse_event("[DONE]")
+        self.event_id += 1
+        return sse_event({
+            "length": sum(len(part) for part in self.parts),
+            "prompt_tokens": self.prompt_tokens,
+            "cached": self.cached,
+            "usage": self.usage,
+            "timing": {
+                "time_to_first_token": round(self.first_token_seconds, 3) if self.first_token_seconds is not None else None,
+                "total": round(self.total_seconds, 3)
+            }
+        }, event="done", event_id=self.event_id)
+
+    def error(self, error):
+        return sse_event({'error': str(error)}, event="error" if self.delta_mode else None)
+
+def observe_chat_stream(encoder):
+    observe_stage("llm_first_token", encoder.first_token_seconds)
+    observe_stage("llm_total", encoder.total_seconds)
+
+def iter_with_keepalive(iterable, interval):
+    """Yield items from a blocking iterable, yielding None after every `interval` seconds of silence"""
+    items = queue.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def reader():
+        try:
+            for item in iterable:
+                items.put((item, None))
+                if stop.is_set():
+                    break
+        except Exception as e:
+            items.put((None, e))
+        items.put((done, None))
+
+    threading.Thread(target=reader, daemon=True, name='stream-reader').start()
+    try:
+        while True:
+            try:
+                item, error = items.get(timeout=interval)
+            except queue.Empty:
+                yield None
+                continue
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+def usage_to_dict(usage):
+    """Token counts from a Cohere usage object"""
+    if usage is None:
+        return None
+    tokens = getattr(usage, 'tokens', None) or getattr(usage, 'billed_units', None)
+    if tokens is None:
+        return None
+    return {
+        "input_tokens": getattr(tokens, 'input_tokens', None),
+        "output_tokens": getattr(tokens, 'output_tokens', None)
+    }
+
+class IngestionError(Exception):
+    """A document could not be processed; the message is shown to the user"""
+
+def job_file_path(job_id):
+    return os.path.join(JOBS_FOLDER, f"{secure_filename(job_id)}.json")
+
+def save_ingestion_job(job):
+    # Jobs are written to disk so any worker can answer /upload-status
+    job["updated"] = time.time()
+    data = json.dumps(job).encode('utf-8')
+    write_atomic(job_file_path(job["job_id"]), lambda handle: handle.write(data))
+
+def expire_ingestion_jobs():
+    """Forget jobs untouched for INGESTION_JOB_TTL, in memory and on disk. A running
+    job is saved after every embed batch, so only finished or abandoned jobs go."""
+    cutoff = time.time() - INGESTION_JOB_TTL
+    with ingestion_jobs_lock:
+        for job_id in [job_id for job_id, job in ingestion_jobs.items() if job["updated"] < cutoff]:
+            del ingestion_jobs[job_id]
+    for name in os.listdir(JOBS_FOLDER):
+        path = os.path.join(JOBS_FOLDER, name)
+        try:
+            if name.endswith(".json") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def create_ingestion_job(user_id, filename, replaces=None):
+    expire_ingestion_jobs()
+    now = time.time()
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "filename": filename,
+        "replaces": replaces,
+        "status": "queued",
+        "stage": "queued",
+        "stages": {stage: {"status": "pending"} for stage in INGESTION_STAGES},
+        "progress": {"chunks_embedded": 0, "chunk_count": None},
+        "created": now
+    }
+    with ingestion_jobs_lock:
+        ingestion_jobs[job["job_id"]] = job
+        save_ingestion_job(job)
+    return job
+
+def update_ingestion_job(job_id, **fields):
+    with ingestion_jobs_lock:
+        job = ingestion_jobs[job_id]
+        job.update(fields)
+        save_ingestion_job(job)
+
+def get_ingestion_job(job_id):
+    with ingestion_jobs_lock:
+        job = ingestion_jobs.get(job_id)
+        if job is not None:
+            return json.loads(json.dumps(job))
+    try:
+        with open(job_file_path(job_id), 'r', encoding='utf-8') as handle:
+            return json.load(handle)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def start_ingestion_stage(job_id, stage):
+    with ingestion_jobs_lock:
+        job = ingestion_jobs[job_id]
+        job["stage"] = stage
+        job["stages"][stage] = {"status": "running", "started": time.time()}
+        save_ingestion_job(job)
+
+def finish_ingestion_stage(job_id, stage, status="done"):
+    with ingestion_jobs_lock:
+        job = ingestion_jobs[job_id]
+        info = job["stages"][stage]
+        if info["status"] != "running":
+            return
+        job["stages"][stage] = {"status": status, "seconds": round(time.time() - info["started"], 3)}
+        save_ingestion_job(job)
+
+@contextmanager
+def ingestion_stage(job_id, stage):
+    """Record the start, duration and outcome of one pipeline stage"""
+    start_ingestion_stage(job_id, stage)
+    status = "failed"
+    try:
+        yield
+        status = "done"
+    finally:
+        finish_ingestion_stage(job_id, stage, status)
+
+def process_document(job_id, user_id, file_path, filename, packer=None, document_id=None):
+    """Extract, chunk, embed and index one saved upload.
+
+    Pages are chunked as soon as they are extracted and every full batch of
+    chunks is sent for embedding straight away, so embedding overlaps with
+    parsing the rest of the file. With an EmbedPacker the chunks go to it
+    instead, to share embed calls with the other files of a batch.
+
+    With a document_id the upload becomes the next version of that document.
+    Chunks whose text is unchanged reuse the stored vectors and only new or
+    edited chunks are embedded.
+    """
+    chunker = StreamingChunker()
+    pages = []
+    page_offsets = []
+    content_length = 0
+    chunks = []
+    batch_futures = []
+    submitted = 0
+    embed_start = None
+    previous = state_backend.get_document(user_id, document_id) if document_id else None
+    reusable = document_chunk_vectors(user_id, previous) if previous else {}
+    reused = 0
+
+    def report_progress(future):
+        if not future.cancelled() and future.exception() is None:
+            with ingestion_jobs_lock:
+                job = ingestion_jobs[job_id]
+                job["progress"]["chunks_embedded"] += len(future.result())
+                save_ingestion_job(job)
+
+    def submit_batches(final=False):
+        nonlocal submitted, embed_start
+        while len(chunks) - submitted >= EMBED_BATCH_SIZE or ((final or packer) and submitted < len(chunks)):
+            if embed_start is None:
+                embed_start = time.perf_counter()
+                start_ingestion_stage(job_id, "embedding")
+            batch = [chunk for _, _, chunk in chunks[submitted:submitted + EMBED_BATCH_SIZE]]
+            future = embed_chunks(batch)
+            future.add_done_callback(report_progress)
+            batch_futures.append(future)
+            submitted += len(batch)
+
+    def embed_chunks(batch):
+        """Future for a batch's embeddings, taking unchanged chunks from the previous version"""
+        nonlocal reused
+        missing = [chunk for chunk in batch if chunk not in reusable]
+        reused += len(batch) - len(missing)
+        if not missing:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            future.set_result([reusable[chunk] for chunk in batch])
+            return future
+        if packer is not None:
+            embedded = packer.add(missing)
+        else:
+            # A batch never exceeds EMBED_BATCH_SIZE, so embed_texts will not fan out into the pool itself
+            embedded = submit_embed(embed_texts, missing, "search_document")
+        if len(missing) == len(batch):
+            return embedded
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def merge(done):
+            if done.cancelled() or done.exception() is not None:
+                future.set_exception(done.exception() if not done.cancelled() else IngestionError("Embedding was cancelled"))
+                return
+            fresh = iter(done.result())
+            future.set_result([reusable[chunk] if chunk in reusable else next(fresh) for chunk in batch])
+        embedded.add_done_callback(merge)
+        return future
+
+    def cancel_batches():
+        if packer is not None:
+            packer.finish(job_id)
+        for future in batch_futures:
+            future.cancel()
+
+    extract_seconds = 0.0
+    chunk_seconds = 0.0
+    if packer is not None:
+        packer.start(job_id)
+    start_ingestion_stage(job_id, "extracting")
+    start_ingestion_stage(job_id, "chunking")
+    try:
+        page_iter = iter(iter_document_pages(file_path, filename))
+        while True:
+            started = time.perf_counter()
+            page_text = next(page_iter, None)
+            extract_seconds += time.perf_counter() - started
+            if page_text is None:
+                break
+            page_offsets.append(content_length)
+            pages.append(page_text)
+            content_length += len(page_text)
+            started = time.perf_counter()
+            chunks.extend(chunker.feed(page_text))
+            chunk_seconds += time.perf_counter() - started
+            submit_batches()
+    except Exception as e:
+        cancel_batches()
+        logger.error(f"Error extracting text from {filename}: {str(e)}")
+        raise IngestionError("Failed to extract text from file") from e
+    finish_ingestion_stage(job_id, "extracting")
+    observe_stage("extract", extract_seconds)
+
+    text_content = "".join(pages)
+    logger.info(f"Extracted {len(text_content)} characters from {len(pages)} pages of {filename}")
+    if not text_content.strip():
+        cancel_batches()
+        raise IngestionError("No text content found in file")
+
+    started = time.perf_counter()
+    chunks.extend(chunker.finish())
+    observe_stage("chunk", chunk_seconds + time.perf_counter() - started)
+    submit_batches(final=True)
+    if packer is not None:
+        packer.finish(job_id)
+    finish_ingestion_stage(job_id, "chunking")
+    logger.info(f"Split text into {len(chunks)} chunks")
+    with ingestion_jobs_lock:
+        job = ingestion_jobs[job_id]
+        job["progress"]["chunk_count"] = len(chunks)
+        save_ingestion_job(job)
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+    try:
+        chunk_embeddings = []
+        for future in batch_futures:
+            chunk_embeddings.extend(future.result())
+    except Exception as e:
+        cancel_batches()
+        raise IngestionError(f"Failed to generate embeddings: {str(e)}") from e
+    embed_seconds = time.perf_counter() - embed_start
+    finish_ingestion_stage(job_id, "embedding")
+    observe_stage("document_embed", embed_seconds)
 
-# Create upload directory if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    # Chunks point into the document's text file instead of carrying a second copy of the text
+    byte_offsets = utf8_offsets(text_content, [offset for start, end, _ in chunks for offset in (start, end)])
+    chunks_with_embeddings = []
+    for i, ((start, end, _), embedding) in enumerate(zip(chunks, chunk_embeddings)):
+        chunks_with_embeddings.append({
+            'embedding': embedding,
+            'chunk_index': i,
+            'start': start,
+            'end': end,
+            'byte_start': byte_offsets[start],
+            'byte_end': byte_offsets[end],
+            'page': bisect.bisect_right(page_offsets, start)
+        })
 
-# Simple memory store per user (can be replaced with a database)
-memory = {}
-# Store documents per user
-user_documents = {}
-# Store document embeddings per user
-user_embeddings = {}
+    chunks_per_second = len(chunks) / embed_seconds if embed_seconds > 0 else None
+    logger.info(f"Generated embeddings for {len(chunks_with_embeddings)} chunks in {embed_seconds:.2f}s")
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    with ingestion_stage(job_id, "indexing"):
+        doc_id = previous["id"] if previous else str(uuid.uuid4())
+        version = previous.get("version", 1) + 1 if previous else 1
+        doc_info = {
+            "id": doc_id,
+            "version": version,
+            "filename": filename,
+            "file_path": file_path,
+            "content_file": get_user_store(user_id).write_document_content(doc_id, text_content, version),
+            "content_preview": document_preview(text_content),
+            "upload_time": str(os.path.getctime(file_path)),
+            "content_length": len(text_content),
+            "chunk_count": len(chunks),
+            "page_count": len(pages),
+            "page_offsets": page_offsets
+        }
 
-def chunk_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
-    """Split text into overlapping chunks for better embedding and retrieval"""
-    if len(text) <= chunk_size:
-        return [text]
-    
-    chunks = []
-    start = 0
-    
-    while start < len(text):
-        end = start + chunk_size
-        
-        # Try to break at sentence or paragraph boundaries
-        if end < len(text):
-            # Look for sentence endings
-            for i in range(min(50, chunk_size // 4)):  # Look back up to 50 chars
-                if text[end - i] in '.!?\n':
-                    end = end - i + 1
-                    break
-        
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
-        
-        start = end - overlap
-        if start >= len(text):
-            break
-    
-    logger.info(f"Split text into {len(chunks)} chunks")
-    return chunks
+        # Text, then embeddings, so the document is searchable as soon as it is listed
+        store_document_embeddings(user_id, doc_id, filename, chunks_with_embeddings, version)
+        add_user_document(user_id, doc_info)
+        if previous:
+            remove_previous_version(user_id, previous, doc_info)
+            logger.info(f"Replaced {filename} with version {version}: {reused} of {len(chunks)} chunks reused")
+
+    return {
+        "message": "Document uploaded and processed successfully",
+        "document_id": doc_id,
+        "version": version,
+        "chunks_reused": reused,
+        "filename": filename,
+        "content_length": len(text_content),
+        "chunk_count": len(chunks),
+        "page_count": len(pages),
+        "embedding_seconds": round(embed_seconds, 3),
+        "chunks_per_second": round(chunks_per_second, 1) if chunks_per_second else None,
+        "content_preview": text_content[:200] + "..." if len(text_content) > 200 else text_content
+    }
 
-def extract_text_from_file(file_path, filename):
-    """Extract text content from various file types"""
+def run_ingestion_job(job_id, user_id, file_path, filename, packer=None, document_id=None):
+    """Background entry point: runs the pipeline and records the outcome on the job"""
+    update_ingestion_job(job_id, status="running")
     try:
-        file_ext = filename.rsplit('.', 1)[1].lower()
-        logger.info(f"Extracting text from {filename} (type: {file_ext})")
-        
-        if file_ext == 'txt' or file_ext == 'md':
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                content = file.read()
-                logger.info(f"Extracted {len(content)} characters from {filename}")
-                return content
-        
-        elif file_ext == 'pdf':
-            text = ""
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for i, page in enumerate(pdf_reader.pages):
-                    page_text = page.extract_text()
-                    text += page_text + "\n"
-                    logger.debug(f"Extracted {len(page_text)} chars from page {i+1}")
-            logger.info(f"Extracted {len(text)} characters from PDF {filename}")
-            return text
-        
-        elif file_ext == 'docx':
-            doc = docx.Document(file_path)
-            text = ""
-            for paragraph in doc.paragraphs:
-                text += paragraph.text + "\n"
-            logger.info(f"Extracted {len(text)} characters from DOCX {filename}")
-            return text
-        
-        else:
-            logger.error(f"Unsupported file type: {file_ext}")
-            return None
+        result = process_document(job_id, user_id, file_path, filename, packer, document_id)
     except Exception as e:
-        logger.error(f"Error extracting text from {filename}: {str(e)}")
-        return None
+        if packer is not None:
+            # Never leave the other files of the batch waiting on this one
+            packer.finish(job_id)
+        error = str(e) if isinstance(e, IngestionError) else f"Upload failed: {str(e)}"
+        logger.error(f"Ingestion job {job_id} failed: {error}")
+        if os.path.exists(file_path):
+            os.remove(file_path)  # Clean up
+        for stage in INGESTION_STAGES:
+            finish_ingestion_stage(job_id, stage, "failed")
+        update_ingestion_job(job_id, status="failed", error=error)
+        return
+    update_ingestion_job(job_id, status="completed", stage="done", **result)
+    logger.info(f"Ingestion job {job_id} completed: {filename} for user {user_id}")
+
+def run_ingestion_batch(user_id, entries):
+    """Background entry point for /upload-batch: ingests (job_id, file_path, filename, document_id)
+    entries a few at a time, packing their chunks into shared embed calls"""
+    packer = EmbedPacker()
+    workers = min(INGEST_BATCH_PARALLEL_FILES, len(entries))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest-batch') as pool:
+        for job_id, file_path, filename, document_id in entries:
+            pool.submit(contextvars.copy_context().run, run_ingestion_job, job_id, user_id, file_path, filename,
+                        packer, document_id)
+    logger.info(f"Ingested a batch of {len(entries)} files for user {user_id} in {packer.calls} embed calls")
+
+def start_ingestion(user_id, file_path, filename, document_id=None):
+    """Create a job for a saved file and queue it; returns (job, future)"""
+    job = create_ingestion_job(user_id, filename, document_id)
+    # copy_context carries the request's trace id into the ingestion thread's log lines
+    future = ingestion_executor.submit(
+        contextvars.copy_context().run, run_ingestion_job, job["job_id"], user_id, file_path, filename, None, document_id
+    )
+    return job, future
+
+def upload_session_path(upload_id, suffix=".json"):
+    return os.path.join(UPLOAD_SESSIONS_FOLDER, f"{secure_filename(upload_id)}{suffix}")
 
-async def embed_texts(texts, input_type="search_document"):
-    """Generate embeddings for texts using Cohere API"""
+def save_upload_session(session):
+    # Sessions live on disk like ingestion jobs, so any worker can take the next chunk
+    session["updated"] = time.time()
+    data = json.dumps(session).encode('utf-8')
+    write_atomic(upload_session_path(session["upload_id"]), lambda handle: handle.write(data))
+
+def load_upload_session(upload_id):
+    """The session with its current offset (bytes received so far), or None"""
     try:
-        logger.info(f"Generating embeddings for {len(texts)} texts")
-        response = co.embed(
-            texts=texts,
-            model="embed-v4.0",
-            input_type=input_type,
-            embedding_types=["float"]
-        )
-        embeddings = response.embeddings.float_
-        logger.info(f"Generated {len(embeddings)} embeddings")
-        return embeddings
-    except Exception as e:
-        logger.error(f"Error generating embeddings: {str(e)}")
+        with open(upload_session_path(upload_id), 'r', encoding='utf-8') as handle:
+            session = json.load(handle)
+    except (FileNotFoundError, ValueError):
         return None
+    try:
+        session["offset"] = os.path.getsize(upload_session_path(upload_id, ".part"))
+    except FileNotFoundError:
+        session["offset"] = session["size"] if session["status"] != "uploading" else 0
+    return session
 
-def find_similar_chunks(query_embedding, document_chunks, top_k=MAX_RELEVANT_CHUNKS):
-    """Find most similar document chunks to query using cosine similarity"""
-    if not document_chunks:
-        return []
-    
-    # Collect all embeddings and metadata
-    all_embeddings = []
-    chunk_metadata = []
-    
-    for doc_id, doc_info in document_chunks.items():
-        for i, chunk_data in enumerate(doc_info['chunks']):
-            all_embeddings.append(chunk_data['embedding'])
-            chunk_metadata.append({
-                'doc_id': doc_id,
-                'chunk_index': i,
-                'text': chunk_data['text'],
-                'filename': doc_info['filename']
-            })
-    
-    if not all_embeddings:
-        return []
-    
-    # Calculate similarities
-    similarities = cosine_similarity([query_embedding], all_embeddings)[0]
-    
-    # Get top-k most similar chunks above threshold
-    similar_indices = np.argsort(similarities)[::-1]
-    
-    relevant_chunks = []
-    for idx in similar_indices[:top_k]:
-        if similarities[idx] >= SIMILARITY_THRESHOLD:
-            chunk_info = chunk_metadata[idx].copy()
-            chunk_info['similarity'] = float(similarities[idx])
-            relevant_chunks.append(chunk_info)
-    
-    logger.info(f"Found {len(relevant_chunks)} relevant chunks above threshold {SIMILARITY_THRESHOLD}")
-    return relevant_chunks
+def remove_upload_session(upload_id):
+    with upload_hashers_lock:
+        upload_hashers.pop(upload_id, None)
+    for suffix in (".json", ".part", ".lock"):
+        try:
+            os.remove(upload_session_path(upload_id, suffix))
+        except FileNotFoundError:
+            pass
 
-def get_memory(user_id):
-    return memory.get(user_id, [])
+def expire_upload_sessions():
+    """Forget upload sessions untouched for UPLOAD_SESSION_TTL, deleting data nobody ingested"""
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for name in os.listdir(UPLOAD_SESSIONS_FOLDER):
+        upload_id, suffix = os.path.splitext(name)
+        if suffix != ".json":
+            continue
+        session = load_upload_session(upload_id)
+        if session is None or session["updated"] >= cutoff:
+            continue
+        logger.info(f"Expiring upload session {upload_id} ({session['status']})")
+        if session["status"] == "uploaded":
+            try:
+                os.remove(session["file_path"])
+            except FileNotFoundError:
+                pass
+        remove_upload_session(upload_id)
 
-def update_memory(user_id, user_msg, bot_msg):
-    memory.setdefault(user_id, []).append({"role": "user", "content": user_msg})
-    memory[user_id].append({"role": "chatbot", "content": bot_msg})
-    # Limit memory to last 10 messages
-    # will have to adjust this later as needed
-    memory[user_id] = memory[user_id][-10:]
-    logger.debug(f"Updated memory for user {user_id}: {len(memory[user_id])} messages")
+def upload_hasher(upload_id, offset):
+    """sha256 of the first offset bytes of an upload, reusing the running hash when this worker has it"""
+    with upload_hashers_lock:
+        entry = upload_hashers.pop(upload_id, None)
+    if entry is not None and entry[0] == offset:
+        return entry[1]
+    # Earlier chunks went to another worker (or this one restarted): catch up from the file
+    hasher = hashlib.sha256()
+    with open(upload_session_path(upload_id, ".part"), 'rb') as handle:
+        remaining = offset
+        while remaining:
+            block = handle.read(min(UPLOAD_STREAM_BLOCK, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
 
-def get_user_documents(user_id):
-    docs = user_documents.get(user_id, [])
-    logger.debug(f"Retrieved {len(docs)} documents for user {user_id}")
-    return docs
+def upload_session_summary(session):
+    summary = {key: session.get(key) for key in ("upload_id", "filename", "size", "offset", "status", "sha256", "job_id", "error")}
+    summary["upload_url"] = f"/uploads/{session['upload_id']}"
+    if session.get("job_id"):
+        summary["status_url"] = f"/upload-status/{session['job_id']}"
+    return summary
 
-def get_user_embeddings(user_id):
-    embeddings = user_embeddings.get(user_id, {})
-    logger.debug(f"Retrieved embeddings for {len(embeddings)} documents for user {user_id}")
-    return embeddings
+def request_trace_id(header_value):
+    """Use the caller's X-Request-ID if it looks sane, otherwise a fresh id"""
+    if header_value and re.fullmatch(r"[\w.-]{1,64}", header_value):
+        return header_value
+    return uuid.uuid4().hex[:16]
 
-def add_user_document(user_id, doc_info):
-    user_documents.setdefault(user_id, []).append(doc_info)
-    logger.info(f"Added document {doc_info['filename']} for user {user_id}")
+@routes.before_app_request
+def start_request_trace():
+    g.trace_id = request_trace_id(request.headers.get('X-Request-ID'))
+    g.request_started = time.perf_counter()
+    trace_id_var.set(g.trace_id)
 
-def store_document_embeddings(user_id, doc_id, filename, chunks_with_embeddings):
-    user_embeddings.setdefault(user_id, {})[doc_id] = {
-        'filename': filename,
-        'chunks': chunks_with_embeddings
-    }
-    logger.info(f"Stored embeddings for document {filename} (user {user_id})")
+@routes.before_app_request
+def reject_reserved_user_id():
+    """Keep clients out of the keys collections are stored under"""
+    user_ids = [request.args.get('user_id'), request.form.get('user_id'), (request.view_args or {}).get('user_id')]
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        user_ids.append(data.get('user_id'))
+        if isinstance(data.get('user_ids'), list):
+            user_ids += data['user_ids']
+    if any(is_reserved_user_id(user_id) for user_id in user_ids):
+        return jsonify({"error": "user_id must not start with 'collection:'"}), 400
 
-def prepare_semantic_context(query, user_id, max_length=MAX_CONTEXT_LENGTH):
-    """Prepare document context using semantic similarity search"""
-    try:
-        # Generate embedding for the query
-        query_embeddings = co.embed(
-            texts=[query],
-            model="embed-v4.0",
-            input_type="search_query",
-            embedding_types=["float"]
-        )
-        query_embedding = query_embeddings.embeddings.float_[0]
-        
-        # Get user's document embeddings
-        document_chunks = get_user_embeddings(user_id)
-        
-        if not document_chunks:
-            logger.info("No document embeddings found for semantic search")
-            return ""
-        
-        # Find similar chunks
-        relevant_chunks = find_similar_chunks(query_embedding, document_chunks)
-        
-        if not relevant_chunks:
-            logger.info("No relevant chunks found above similarity threshold")
-            return ""
-        
-        # Build context from relevant chunks
-        context_parts = []
-        current_length = 0
-        
-        for chunk_info in relevant_chunks:
-            doc_header = f"\n=== Document: {chunk_info['filename']} (Similarity: {chunk_info['similarity']:.3f}) ===\n"
-            chunk_content = chunk_info['text']
-            
-            # Check length limits
-            section_length = len(doc_header) + len(chunk_content)
-            if current_length + section_length > max_length:
-                break
-            
-            context_parts.append(doc_header + chunk_content)
-            current_length += section_length
-        
-        context = "\n".join(context_parts)
-        logger.info(f"Prepared semantic context: {len(context)} characters from {len(context_parts)} relevant chunks")
-        return context
-        
-    except Exception as e:
-        logger.error(f"Error in semantic search: {str(e)}")
-        return ""
+@routes.after_app_request
+def finish_request_trace(response):
+    # For streamed responses this is the time until the headers are sent
+    response.headers['X-Request-ID'] = g.get('trace_id', '-')
+    if 'request_started' in g:
+        latency_metrics.observe("chatty_request_seconds", {
+            "endpoint": request.url_rule.rule if request.url_rule else "unmatched",
+            "status": str(response.status_code)
+        }, time.perf_counter() - g.request_started)
+    return response
 
-def prepare_document_context(docs, max_length=MAX_CONTEXT_LENGTH):
-    """Prepare document context with length limits (fallback method)"""
-    if not docs:
-        return ""
-    
-    context_parts = []
-    current_length = 0
-    
-    for doc in docs:
-        doc_header = f"\n=== Document: {doc['filename']} ===\n"
-        doc_content = doc['content']
-        
-        # Truncate if too long
-        available_space = max_length - current_length - len(doc_header)
-        if available_space <= 0:
-            break
-            
-        if len(doc_content) > available_space:
-            doc_content = doc_content[:available_space] + "\n[Content truncated...]"
-        
-        context_parts.append(doc_header + doc_content)
-        current_length += len(doc_header) + len(doc_content)
-        
-        if current_length >= max_length:
-            break
-    
-    context = "\n".join(context_parts)
-    logger.info(f"Prepared document context: {len(context)} characters from {len(context_parts)} documents")
-    return context
+@routes.after_app_request
+def compress_response(response):
+    """Gzip larger JSON responses for clients that accept it"""
+    if response.mimetype != 'application/json' or response.direct_passthrough or response.is_streamed:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+    data = response.get_data()
+    if len(data) >= COMPRESS_MIN_BYTES:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
-@app.errorhandler(500)
+@routes.app_errorhandler(500)
 def internal_error(error):
     logger.error(f"Internal server error: {str(error)}")
     return jsonify({"error": "Internal server error"}), 500
 
-@app.errorhandler(404)
+@routes.app_errorhandler(404)
 def not_found(error):
     return jsonify({"error": "Endpoint not found"}), 404
 
-@app.route("/health", methods=["GET"])
+@routes.route("/health", methods=["GET"])
 def health_check():
     return jsonify({
         "status": "healthy",
         "environment": os.getenv("ENVIRONMENT", "unknown"),
-        "upload_folder": app.config['UPLOAD_FOLDER']
+        "upload_folder": current_app.config['UPLOAD_FOLDER'],
+        "embedding_cache": embedding_cache.stats(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "query_embed_batches": query_embed_batcher.stats(),
+        "state": state_backend.stats(),
+        "response_cache": response_cache.stats(),
+        "user_state": user_state_stats(),
+        "model_calls": model_scheduler.stats()
     })
 
-@app.route("/")
+def metric_lines(name, kind, samples):
+    """Prometheus text lines for one metric; samples are (labels, value) pairs"""
+    lines = [f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return lines
+
+@routes.route("/metrics", methods=["GET"])
+def metrics():
+    caches = {"document_embedding": embedding_cache, "query_embedding": query_embedding_cache, "response": response_cache}
+    cache_stats = {name: cache.stats() for name, cache in caches.items()}
+    with ingestion_jobs_lock:
+        job_counts = Counter(job["status"] for job in ingestion_jobs.values())
+    batches = query_embed_batcher.stats()
+    state = state_backend.stats()
+    user_state = user_state_stats()
+    scheduler = model_scheduler.stats()
+
+    lines = latency_metrics.render()
+    lines += metric_lines("chatty_cache_entries", "gauge", [({"cache": name}, stats["entries"]) for name, stats in cache_stats.items()])
+    lines += metric_lines("chatty_cache_hits_total", "counter", [({"cache": name}, stats["hits"]) for name, stats in cache_stats.items()])
+    lines += metric_lines("chatty_cache_misses_total", "counter", [({"cache": name}, stats["misses"]) for name, stats in cache_stats.items()])
+    lines += metric_lines("chatty_cache_evictions_total", "counter", [({"cache": name}, stats["evictions"]) for name, stats in cache_stats.items()])
+    lines += metric_lines("chatty_ingestion_jobs", "gauge", [({"status": status}, job_counts.get(status, 0)) for status in ("queued", "running")])
+    lines += metric_lines("chatty_embed_queue_depth", "gauge", [({}, embed_queue_depth)])
+    lines += metric_lines("chatty_query_embed_requests_total", "counter", [({}, batches["requests"])])
+    lines += metric_lines("chatty_query_embed_batches_total", "counter", [({}, batches["batches"])])
+    lines += metric_lines("chatty_state_pending_writes", "gauge", [({"backend": state["backend"]}, state["pending_writes"])])
+    lines += metric_lines("chatty_memory_summaries_running", "gauge", [({}, len(memory_summaries_running))])
+    lines += metric_lines("chatty_indexed_users", "gauge", [({}, len(user_embeddings))])
+    lines += metric_lines("chatty_model_queue_depth", "gauge", [({"lane": lane}, info["queued"]) for lane, info in scheduler["lanes"].items()])
+    lines += metric_lines("chatty_model_calls_running", "gauge", [({"lane": lane}, info["running"]) for lane, info in scheduler["lanes"].items()])
+    lines += metric_lines("chatty_model_calls_total", "counter", [({"lane": lane}, info["calls"]) for lane, info in scheduler["lanes"].items()])
+    lines += metric_lines("chatty_user_state_bytes", "gauge", [({}, user_state["bytes"])])
+    lines += metric_lines("chatty_user_state_evictions_total", "counter", [({}, user_state["evictions"])])
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@routes.route("/")
 def index():
     return render_template("index.html")
 
-@app.route("/upload", methods=["POST"])
+@routes.route("/upload", methods=["POST"])
 def upload_document():
     logger.info("Document upload request received")
     
@@ -319,6 +3576,12 @@ def upload_document():
     
     file = request.files['file']
     user_id = request.form.get('user_id', 'default')
+    wait = request.form.get('wait', 'false').lower() == 'true'
+    # A re-upload under the same name replaces the earlier document unless replace=false
+    document_id = request.form.get('document_id')
+    replace = request.form.get('replace', 'true').lower() == 'true'
+    # With a collection_id the document goes into that shared collection instead
+    owner = document_owner(user_id, request.form.get('collection_id'))
     
     logger.info(f"Upload request from user {user_id}, file: {file.filename}")
     
@@ -328,105 +3591,294 @@ def upload_document():
     if not allowed_file(file.filename):
         return jsonify({"error": f"File type not allowed. Supported types: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
     
+    if owner is None:
+        return jsonify({"error": "Collection not found"}), 404
+    if document_id and state_backend.get_document(owner, document_id) is None:
+        return jsonify({"error": "Document not found"}), 404
+    
     try:
         # Generate unique filename
         filename = secure_filename(file.filename)
         unique_filename = f"{uuid.uuid4()}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
         
         # Save file
-        file.save(file_path)
+        with timed_stage("file_save"):
+            file.save(file_path)
         logger.info(f"File saved to {file_path}")
         
-        # Extract text content
-        text_content = extract_text_from_file(file_path, filename)
-        
-        if text_content is None:
-            os.remove(file_path)  # Clean up
-            return jsonify({"error": "Failed to extract text from file"}), 400
-        
-        if not text_content.strip():
-            os.remove(file_path)  # Clean up
-            return jsonify({"error": "No text content found in file"}), 400
-        
-        # Split text into chunks
-        text_chunks = chunk_text(text_content)
-        
-        # Generate embeddings for chunks
-        try:
-            embeddings = co.embed(
-                texts=text_chunks,
-                model="embed-v4.0",
-                input_type="search_document",
-                embedding_types=["float"]
-            )
-            chunk_embeddings = embeddings.embeddings.float_
-            
-            # Prepare chunks with embeddings
-            chunks_with_embeddings = []
-            for i, (chunk, embedding) in enumerate(zip(text_chunks, chunk_embeddings)):
-                chunks_with_embeddings.append({
-                    'text': chunk,
-                    'embedding': embedding,
-                    'chunk_index': i
-                })
-            
-            logger.info(f"Generated embeddings for {len(chunks_with_embeddings)} chunks")
-            
-        except Exception as e:
-            logger.error(f"Failed to generate embeddings: {str(e)}")
-            os.remove(file_path)  # Clean up
-            return jsonify({"error": f"Failed to generate embeddings: {str(e)}"}), 500
-        
-        # Store document info
-        doc_id = str(uuid.uuid4())
-        doc_info = {
-            "id": doc_id,
-            "filename": filename,
-            "file_path": file_path,
-            "content": text_content,
-            "upload_time": str(os.path.getctime(file_path)),
-            "content_length": len(text_content),
-            "chunk_count": len(text_chunks)
-        }
+        job, future = start_ingestion(owner, file_path, filename,
+                                      replaced_document_id(owner, filename, document_id, replace))
         
-        add_user_document(user_id, doc_info)
-        store_document_embeddings(user_id, doc_id, filename, chunks_with_embeddings)
+        if wait:
+            # Old behaviour for scripts that want the processed document in the response
+            future.result()
+            job = get_ingestion_job(job["job_id"])
+            return jsonify(job), (200 if job["status"] == "completed" else 400)
         
         return jsonify({
-            "message": "Document uploaded and processed successfully",
-            "document_id": doc_id,
+            "message": "Document received, processing started",
+            "job_id": job["job_id"],
             "filename": filename,
-            "content_length": len(text_content),
-            "chunk_count": len(text_chunks),
-            "content_preview": text_content[:200] + "..." if len(text_content) > 200 else text_content
-        })
+            "status_url": f"/upload-status/{job['job_id']}"
+        }), 202
         
     except Exception as e:
         logger.error(f"Upload failed: {str(e)}")
         return jsonify({"error": f"Upload failed: {str(e)}"}), 500
 
-@app.route("/documents", methods=["GET"])
+@routes.route("/upload-batch", methods=["POST"])
+def upload_batch():
+    """Ingest several files together, sharing embed calls between them.
+
+    Takes either multipart "files", or JSON with "upload_ids" of finished
+    resumable uploads that were created with "defer": true.
+    """
+    if request.files:
+        user_id = request.form.get('user_id', 'default')
+        wait = request.form.get('wait', 'false').lower() == 'true'
+        replace = request.form.get('replace', 'true').lower() == 'true'
+        collection_id = request.form.get('collection_id')
+        files = request.files.getlist('files')
+        upload_ids = []
+    else:
+        data = request.get_json(silent=True) or {}
+        user_id = data.get('user_id', 'default')
+        wait = bool(data.get('wait', False))
+        replace = bool(data.get('replace', True))
+        collection_id = data.get('collection_id')
+        files = []
+        upload_ids = data.get('upload_ids') or []
+    owner = document_owner(user_id, collection_id)
+
+    logger.info(f"Batch upload request from user {user_id}: {len(files)} files, {len(upload_ids)} finished uploads")
+
+    if not files and not upload_ids:
+        return jsonify({"error": "No files provided"}), 400
+    if len(files) + len(upload_ids) > UPLOAD_BATCH_MAX_FILES:
+        return jsonify({"error": f"At most {UPLOAD_BATCH_MAX_FILES} files per batch"}), 400
+    if owner is None:
+        return jsonify({"error": "Collection not found"}), 404
+    for file in files:
+        if file.filename == '' or not allowed_file(file.filename):
+            return jsonify({"error": f"File type not allowed: {file.filename}. Supported types: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
+    sessions = [load_upload_session(str(upload_id)) for upload_id in upload_ids]
+    for upload_id, session in zip(upload_ids, sessions):
+        if session is None or session["user_id"] != owner:
+            return jsonify({"error": f"Upload {upload_id} not found"}), 404
+        if session["status"] != "uploaded":
+            return jsonify({"error": f"Upload {upload_id} is not ready for ingestion", "upload": upload_session_summary(session)}), 409
+
+    try:
+        saved = []
+        with timed_stage("file_save"):
+            for file in files:
+                filename = secure_filename(file.filename)
+                file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{uuid.uuid4()}_{filename}")
+                file.save(file_path)
+                saved.append((file_path, filename))
+        entries = []
+        for file_path, filename in saved:
+            document_id = replaced_document_id(owner, filename, replace=replace)
+            entries.append((create_ingestion_job(owner, filename, document_id)["job_id"], file_path, filename, document_id))
+        for session in sessions:
+            document_id = replaced_document_id(owner, session["filename"], session.get("document_id"),
+                                               session.get("replace", True))
+            job_id = create_ingestion_job(owner, session["filename"], document_id)["job_id"]
+            session.update(status="processing", job_id=job_id)
+            save_upload_session(session)
+            entries.append((job_id, session["file_path"], session["filename"], document_id))
+
+        future = ingestion_executor.submit(contextvars.copy_context().run, run_ingestion_batch, owner, entries)
+        if wait:
+            future.result()
+            jobs = [get_ingestion_job(job_id) for job_id, _, _, _ in entries]
+            failed = any(job["status"] != "completed" for job in jobs)
+            return jsonify({"jobs": jobs}), (400 if failed else 200)
+
+        return jsonify({
+            "message": f"{len(entries)} documents received, processing started",
+            "jobs": [{
+                "job_id": job_id,
+                "filename": filename,
+                "status_url": f"/upload-status/{job_id}"
+            } for job_id, _, filename, _ in entries]
+        }), 202
+
+    except Exception as e:
+        logger.error(f"Batch upload failed: {str(e)}")
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+@routes.route("/uploads", methods=["POST"])
+def create_upload():
+    """Start a resumable upload. The file is then sent in chunks with PATCH /uploads/<upload_id>."""
+    data = request.get_json(silent=True) or {}
+    user_id = data.get("user_id", "default")
+    filename = secure_filename(str(data.get("filename", "")))
+    size = data.get("size")
+    checksum = data.get("sha256")
+    document_id = data.get("document_id")
+    owner = document_owner(user_id, data.get("collection_id"))
+
+    if not filename or not allowed_file(filename):
+        return jsonify({"error": f"File type not allowed. Supported types: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        return jsonify({"error": "size must be a positive number of bytes"}), 400
+    if size > UPLOAD_MAX_SIZE:
+        return jsonify({"error": f"File too large, the limit is {UPLOAD_MAX_SIZE // (1024 * 1024)}MB"}), 413
+    if checksum is not None and not re.fullmatch(r"[0-9a-fA-F]{64}", str(checksum)):
+        return jsonify({"error": "sha256 must be a hex digest"}), 400
+    if owner is None:
+        return jsonify({"error": "Collection not found"}), 404
+    if document_id and state_backend.get_document(owner, str(document_id)) is None:
+        return jsonify({"error": "Document not found"}), 404
+
+    expire_upload_sessions()
+    session = {
+        "upload_id": uuid.uuid4().hex,
+        "user_id": owner,
+        "filename": filename,
+        "size": size,
+        "expected_sha256": checksum.lower() if checksum else None,
+        "defer": bool(data.get("defer", False)),
+        "document_id": str(document_id) if document_id else None,
+        "replace": bool(data.get("replace", True)),
+        "status": "uploading",
+        "created": time.time()
+    }
+    save_upload_session(session)
+    open(upload_session_path(session["upload_id"], ".part"), 'wb').close()
+    session["offset"] = 0
+    logger.info(f"Resumable upload {session['upload_id']} started by user {user_id}: {filename}, {size} bytes")
+    return jsonify(dict(upload_session_summary(session), chunk_size=UPLOAD_CHUNK_SIZE)), 201
+
+@routes.route("/uploads/<upload_id>", methods=["GET"])
+def upload_session_status(upload_id):
+    session = load_upload_session(upload_id)
+    if session is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(upload_session_summary(session))
+
+@routes.route("/uploads/<upload_id>", methods=["PATCH"])
+def upload_chunk(upload_id):
+    """Append the request body at the Upload-Offset header's position.
+
+    The body is streamed to disk and hashed as it arrives. A chunk sent for
+    the wrong offset gets a 409 with the offset to resume from. The last
+    chunk verifies the checksum and starts ingestion, unless the upload was
+    created with "defer": true for /upload-batch.
+    """
+    session = load_upload_session(upload_id)
+    if session is None:
+        return jsonify({"error": "Upload not found"}), 404
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        return jsonify({"error": "Upload-Offset header is required"}), 400
+
+    part_path = upload_session_path(upload_id, ".part")
+    with file_lock(upload_session_path(upload_id, ".lock")):
+        session = load_upload_session(upload_id)
+        if session is None:
+            return jsonify({"error": "Upload not found"}), 404
+        if session["status"] != "uploading":
+            return jsonify(dict(upload_session_summary(session), error="Upload already finished")), 409
+        if offset != session["offset"]:
+            return jsonify(dict(upload_session_summary(session), error="Upload-Offset does not match the bytes received")), 409
+
+        hasher = upload_hasher(upload_id, offset)
+        received = offset
+        with timed_stage("upload_chunk"), open(part_path, 'ab') as handle:
+            while True:
+                block = request.stream.read(UPLOAD_STREAM_BLOCK)
+                if not block:
+                    break
+                if received + len(block) > session["size"]:
+                    handle.truncate(offset)
+                    return jsonify(dict(upload_session_summary(session), error="Chunk runs past the declared size")), 400
+                handle.write(block)
+                hasher.update(block)
+                received += len(block)
+        session["offset"] = received
+
+        if received < session["size"]:
+            with upload_hashers_lock:
+                upload_hashers[upload_id] = (received, hasher)
+            save_upload_session(session)
+            return jsonify(upload_session_summary(session))
+
+        digest = hasher.hexdigest()
+        if session.get("expected_sha256") and digest != session["expected_sha256"]:
+            os.remove(part_path)
+            session.update(status="failed", sha256=digest, error="Checksum mismatch, the file must be uploaded again")
+            save_upload_session(session)
+            logger.error(f"Resumable upload {upload_id} failed its checksum")
+            return jsonify(upload_session_summary(session)), 400
+
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{uuid.uuid4()}_{session['filename']}")
+        os.replace(part_path, file_path)
+        session.update(status="uploaded", sha256=digest, file_path=file_path)
+        if not session["defer"]:
+            job, _ = start_ingestion(session["user_id"], file_path, session["filename"], replaced_document_id(
+                session["user_id"], session["filename"], session.get("document_id"), session.get("replace", True)))
+            session.update(status="processing", job_id=job["job_id"])
+        save_upload_session(session)
+    logger.info(f"Resumable upload {upload_id} complete: {session['filename']} ({received} bytes)")
+    return jsonify(upload_session_summary(session))
+
+@routes.route("/uploads/<upload_id>", methods=["DELETE"])
+def abort_upload(upload_id):
+    session = load_upload_session(upload_id)
+    if session is None:
+        return jsonify({"error": "Upload not found"}), 404
+    if session["status"] == "uploaded":
+        # Deferred and never ingested
+        try:
+            os.remove(session["file_path"])
+        except FileNotFoundError:
+            pass
+    remove_upload_session(upload_id)
+    return jsonify({"message": "Upload removed"})
+
+@routes.route("/upload-status/<job_id>", methods=["GET"])
+def upload_status(job_id):
+    job = get_ingestion_job(job_id)
+    if job is None:
+        return jsonify({"error": "Upload job not found"}), 404
+    return jsonify(job)
+
+@routes.route("/documents", methods=["GET"])
 def list_documents():
     user_id = request.args.get('user_id', 'default')
-    docs = get_user_documents(user_id)
+    collection_id = request.args.get('collection_id')
+    owner = document_owner(user_id, collection_id)
+    if owner is None:
+        return jsonify({"error": "Collection not found"}), 404
+    try:
+        limit = max(1, min(int(request.args.get('limit', DOCUMENTS_PAGE_SIZE)), DOCUMENTS_MAX_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
     
-    # Return summary of documents (without full content)
-    doc_summaries = []
-    for doc in docs:
-        doc_summaries.append({
-            "id": doc["id"],
-            "filename": doc["filename"],
-            "upload_time": doc["upload_time"],
-            "content_length": doc.get("content_length", len(doc["content"])),
-            "chunk_count": doc.get("chunk_count", 0),
-            "content_preview": doc["content"][:100] + "..." if len(doc["content"]) > 100 else doc["content"]
-        })
+    summaries, positions = get_document_summaries(owner)
+    try:
+        start = document_page_start(request.args.get('cursor'), positions)
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    page = summaries[start:start + limit]
+    end = start + len(page)
     
-    logger.info(f"Listed {len(doc_summaries)} documents for user {user_id}")
-    return jsonify({"documents": doc_summaries})
+    logger.info(f"Listed {len(page)} of {len(summaries)} documents for {'collection ' + collection_id if collection_id else 'user ' + user_id}")
+    response = jsonify({
+        "documents": page,
+        "total": len(summaries),
+        "next_cursor": encode_document_cursor(end - 1, page[-1]["id"]) if end < len(summaries) else None
+    })
+    # Clients revalidate every time and get a 304 while the page is unchanged
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag(weak=True)
+    return response.make_conditional(request)
 
-@app.route("/search", methods=["POST"])
+@routes.route("/search", methods=["POST"])
 def semantic_search():
     """Endpoint for testing semantic search functionality"""
     data = request.get_json()
@@ -437,195 +3889,192 @@ def semantic_search():
         return jsonify({"error": "Query is required"}), 400
     
     try:
-        context = prepare_semantic_context(query, user_id)
+        search_info = {}
+        context = prepare_semantic_context(query, user_id, search_info=search_info)
         
         return jsonify({
             "query": query,
             "context_length": len(context),
             "context": context[:1000] + "..." if len(context) > 1000 else context,
-            "has_results": len(context) > 0
+            "has_results": len(context) > 0,
+            "search_mode": search_info.get("mode"),
+            "rows_scored": search_info.get("candidates")
         })
         
     except Exception as e:
         logger.error(f"Search error: {str(e)}")
         return jsonify({"error": f"Search failed: {str(e)}"}), 500
 
-@app.route("/chat", methods=["POST"])
+@routes.route("/search/batch", methods=["POST"])
+def batch_search():
+    """Search many queries against one or more users' documents in one request"""
+    data = request.get_json(silent=True) or {}
+    queries = data.get("queries")
+    user_ids = data.get("user_ids") or [data.get("user_id", "default")]
+
+    if not isinstance(queries, list) or not queries or not all(isinstance(query, str) and query.strip() for query in queries):
+        return jsonify({"error": "queries must be a non-empty list of non-empty strings"}), 400
+    if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+        return jsonify({"error": f"At most {SEARCH_BATCH_MAX_QUERIES} queries per request"}), 400
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, str) for user_id in user_ids):
+        return jsonify({"error": "user_ids must be a list of strings"}), 400
+    try:
+        top_k = max(1, min(int(data.get("top_k", MAX_RELEVANT_CHUNKS)), SEARCH_BATCH_MAX_TOP_K))
+        threshold = float(data.get("threshold", SIMILARITY_THRESHOLD))
+    except (TypeError, ValueError):
+        return jsonify({"error": "top_k and threshold must be numbers"}), 400
+    include_text = bool(data.get("include_text", True))
+
+    logger.info(f"Batch search of {len(queries)} queries for users {user_ids}")
+    try:
+        started = time.perf_counter()
+        queries = [query.strip() for query in queries]
+        matches = batch_search_chunks(queries, list(dict.fromkeys(user_ids)), top_k, threshold, include_text)
+        return jsonify({
+            "results": [{"query": query, "matches": query_matches} for query, query_matches in zip(queries, matches)],
+            "query_count": len(queries),
+            "top_k": top_k,
+            "seconds": round(time.perf_counter() - started, 3)
+        })
+    except Exception as e:
+        logger.error(f"Batch search error: {str(e)}")
+        return jsonify({"error": f"Search failed: {str(e)}"}), 500
+
+@routes.route("/chat", methods=["POST"])
 def chat():
     data = request.get_json()
     user_id = data.get("user_id", "default")
     message = data.get("message", "").strip()
     use_documents = data.get("use_documents", False)
+    # use_cache marks a standalone question: answered without history, so the answer can be reused
+    use_cache = bool(data.get("use_cache", False)) and RESPONSE_CACHE_SIZE > 0
 
     logger.info(f"Chat request from user {user_id}, use_documents: {use_documents}")
-    logger.debug(f"Message: {message[:100]}...")
+    logger.debug("Message: %.100s...", message)
 
     if not message:
         return jsonify({"error": "Message is required"}), 400
 
-    messages = get_memory(user_id) + [{"role": "user", "content": message}]
-    
-    # If using documents, add document context with semantic search
-    if use_documents:
-        logger.info("Using semantic search for document context")
-        doc_context = prepare_semantic_context(message, user_id)
-        
-        if doc_context:
-            system_message = {
-                "role": "system", 
-                "content": f"""You are a helpful assistant with access to the user's documents. Use the following relevant document excerpts to answer questions:
-
-{doc_context}
-
-Instructions:
-- The document excerpts above were selected based on semantic similarity to the user's question
-- Each excerpt shows the document name and similarity score
-- Use this information to provide accurate, specific answers
-- Always cite which document you're referencing
-- If the excerpts don't contain relevant information, say so clearly
-"""
-            }
-            messages = [system_message] + messages
-            logger.info(f"Added semantic document context ({len(doc_context)} chars)")
-        else:
-            # Fallback to regular document context if semantic search fails
-            docs = get_user_documents(user_id)
-            if docs:
-                doc_context = prepare_document_context(docs)
-                if doc_context:
-                    system_message = {
-                        "role": "system", 
-                        "content": f"""You are a helpful assistant with access to the user's documents:
-
-{doc_context}
+    cache_ticket = None
+    if use_cache:
+        cached_answer, cache_ticket = lookup_cached_response(user_id, message, use_documents)
+        if cached_answer is not None:
+            update_memory(user_id, message, cached_answer)
+            return jsonify({"response": cached_answer, "cached": True, "prompt_tokens": 0, "usage": None})
 
-Instructions:
-- Use the document information above to answer questions when relevant
-- Always specify which document you're referencing
-- If the question cannot be answered from the documents, say so clearly
-"""
-                    }
-                    messages = [system_message] + messages
-                    logger.info("Used fallback document context")
+    messages = build_chat_messages(user_id, message, use_documents, with_history=not use_cache)
+    prompt_tokens = estimate_prompt_tokens(messages)
 
     try:
-        logger.debug(f"Sending {len(messages)} messages to Cohere")
-        response = co.chat(model="command-r-plus-08-2024", messages=messages)
+        logger.debug("Sending %d messages (~%d tokens) to Cohere", len(messages), prompt_tokens)
+        with model_scheduler.slot("interactive"), timed_stage("llm_total"):
+            response = get_cohere_client().chat(model=CHAT_MODEL, messages=messages)
         bot_response = response.message.content[0].text
         
         update_memory(user_id, message, bot_response)
+        store_cached_response(user_id, cache_ticket, use_documents, bot_response)
         logger.info(f"Chat response generated ({len(bot_response)} chars)")
         
-        return jsonify({"response": bot_response})
+        return jsonify({
+            "response": bot_response,
+            "cached": False,
+            "prompt_tokens": prompt_tokens,
+            "usage": usage_to_dict(getattr(response, 'usage', None))
+        })
     
     except Exception as e:
         logger.error(f"Chat error: {str(e)}")
         return jsonify({"error": f"Chat failed: {str(e)}"}), 500
 
-@app.route("/chat-stream", methods=["POST"])
+@routes.route("/chat-stream", methods=["POST"])
 def chat_stream():
     data = request.get_json()
     user_id = data.get("user_id", "default")
     message = data.get("message", "").strip()
     use_documents = data.get("use_documents", False)
+    use_cache = bool(data.get("use_cache", False)) and RESPONSE_CACHE_SIZE > 0
 
     logger.info(f"Stream chat request from user {user_id}, use_documents: {use_documents}")
 
     if not message:
         return jsonify({"error": "Message is required"}), 400
 
-    messages = get_memory(user_id) + [{"role": "user", "content": message}]
-    
-    # If using documents, add document context with semantic search
-    if use_documents:
-        logger.info("Using semantic search for streaming chat")
-        doc_context = prepare_semantic_context(message, user_id)
-        
-        if doc_context:
-            system_message = {
-                "role": "system", 
-                "content": f"""You are a helpful assistant with access to the user's documents. Use the following relevant document excerpts to answer questions:
+    # protocol=delta sends only new text per event; the default resends the full answer
+    delta_mode = request.args.get('protocol', 'full') == 'delta'
 
-{doc_context}
+    cache_ticket = None
+    if use_cache:
+        cached_answer, cache_ticket = lookup_cached_response(user_id, message, use_documents)
+        if cached_answer is not None:
+            update_memory(user_id, message, cached_answer)
+            encoder = ChatStreamEncoder(delta_mode=delta_mode, prompt_tokens=0)
+            return Response([encoder.replay(cached_answer), encoder.done()], mimetype="text/event-stream", headers=SSE_HEADERS)
 
-Instructions:
-- The document excerpts above were selected based on semantic similarity to the user's question
-- Each excerpt shows the document name and similarity score
-- Use this information to provide accurate, specific answers
-- Always cite which document you're referencing
-- If the excerpts don't contain relevant information, say so clearly
-"""
-            }
-            messages = [system_message] + messages
-            logger.info(f"Added semantic document context to streaming chat")
-        else:
-            # Fallback to regular document context
-            docs = get_user_documents(user_id)
-            if docs:
-                doc_context = prepare_document_context(docs)
-                if doc_context:
-                    system_message = {
-                        "role": "system", 
-                        "content": f"""You are a helpful assistant with access to the user's documents:
+    messages = build_chat_messages(user_id, message, use_documents, with_history=not use_cache)
+    prompt_tokens = estimate_prompt_tokens(messages)
+    logger.debug("Streaming %d messages (~%d tokens) to Cohere", len(messages), prompt_tokens)
 
-{doc_context}
+    encoder = ChatStreamEncoder(delta_mode=delta_mode, prompt_tokens=prompt_tokens)
 
-Instructions:
-- Use the document information above to answer questions when relevant
-- Always specify which document you're referencing
-- If the question cannot be answered from the documents, say so clearly
-"""
-                    }
-                    messages = [system_message] + messages
-                    logger.info("Used fallback document context for streaming")
+    def model_stream():
+        # The slot is held for the whole stream, so the stream lane caps open streams
+        # without taking slots from /chat and query embeds
+        with model_scheduler.slot("stream"):
+            yield from get_cohere_client().chat_stream(model=CHAT_MODEL, messages=messages)
 
     def stream():
         try:
-            response = co.chat_stream(model="command-r-plus-08-2024", messages=messages)
-            response_text = ""
-            for chunk in response:
-                if chunk and chunk.type == "content-delta":
-                    delta_text = chunk.delta.message.content.text
-                    response_text += delta_text
-                    yield f"data: {json.dumps({'response': response_text})}\n\n"
+            # The slot is taken in the keep-alive reader thread, so a stream queued for the lane gets keep-alives too
+            for chunk in iter_with_keepalive(model_stream(), STREAM_KEEPALIVE_SECONDS):
+                if chunk is None:
+                    yield SSE_KEEPALIVE
+                    continue
+                event = encoder.encode(chunk)
+                if event:
+                    yield event
             
-            update_memory(user_id, message, response_text)
-            yield "data: [DONE]\n\n"
-            logger.info(f"Streaming chat completed ({len(response_text)} chars)")
+            update_memory(user_id, message, encoder.text)
+            store_cached_response(user_id, cache_ticket, use_documents, encoder.text)
+            yield encoder.done()
+            observe_chat_stream(encoder)
+            logger.info(f"Streaming chat completed ({len(encoder.text)} chars)")
             
         except Exception as e:
             logger.error(f"Streaming error: {str(e)}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield encoder.error(e)
+
+    return Response(stream(), mimetype="text/event-stream", headers=SSE_HEADERS)
 
-    return Response(stream(), mimetype="text/event-stream")
+@routes.route("/debug/index-stats", methods=["GET"])
+def debug_index_stats():
+    user_id = request.args.get('user_id', 'default')
+    owner = document_owner(user_id, request.args.get('collection_id'))
+    if owner is None:
+        return jsonify({"error": "Collection not found"}), 404
+    try:
+        recall_sample = max(0, min(int(request.args.get('recall_sample', 20)), 200))
+    except ValueError:
+        return jsonify({"error": "recall_sample must be a number"}), 400
+    return jsonify(get_user_embeddings(owner).stats(recall_sample=recall_sample))
 
-@app.route("/delete-document", methods=["DELETE"])
+@routes.route("/delete-document", methods=["DELETE"])
 def delete_document():
     data = request.get_json()
     user_id = data.get("user_id", "default")
     document_id = data.get("document_id")
+    owner = document_owner(user_id, data.get("collection_id"))
     
     logger.info(f"Delete document request from user {user_id}, doc_id: {document_id}")
     
     if not document_id:
         return jsonify({"error": "Document ID is required"}), 400
+    if owner is None:
+        return jsonify({"error": "Collection not found"}), 404
     
-    docs = get_user_documents(user_id)
-    doc_to_remove = None
-    
-    for i, doc in enumerate(docs):
-        if doc["id"] == document_id:
-            doc_to_remove = i
-            break
+    doc = remove_user_document(owner, document_id)
     
-    if doc_to_remove is not None:
-        doc = docs.pop(doc_to_remove)
-        
-        # Remove embeddings
-        embeddings = user_embeddings.get(user_id, {})
-        if document_id in embeddings:
-            del embeddings[document_id]
-            logger.info(f"Removed embeddings for document {document_id}")
+    if doc is not None:
+        logger.info(f"Removed embeddings for document {document_id}")
         
         # Clean up file
         try:
@@ -639,28 +4088,150 @@ def delete_document():
     else:
         return jsonify({"error": "Document not found"}), 404
 
+@routes.route("/collections", methods=["POST"])
+def create_collection():
+    """Create a shared collection. Its documents are uploaded with collection_id
+    and indexed once, however many users subscribe to it."""
+    data = request.get_json(silent=True) or {}
+    name = str(data.get("name", "")).strip()
+    if not name:
+        return jsonify({"error": "Collection name is required"}), 400
+
+    record = {
+        "collection_id": uuid.uuid4().hex,
+        "name": name,
+        "created_by": data.get("user_id", "default"),
+        "created": time.time()
+    }
+    state_backend.put_collection(record)
+    logger.info(f"Created collection {record['collection_id']} ({name})")
+    return jsonify(record), 201
+
+@routes.route("/collections", methods=["GET"])
+def list_collections():
+    user_id = request.args.get('user_id', 'default')
+    subscribed = set(state_backend.list_subscriptions(user_id))
+    subscribers = state_backend.count_subscribers()
+    collections = []
+    for record in state_backend.list_collections():
+        collection_id = record["collection_id"]
+        collections.append(dict(
+            record,
+            document_count=len(state_backend.list_documents(collection_owner(collection_id))),
+            subscribers=subscribers.get(collection_id, 0),
+            subscribed=collection_id in subscribed
+        ))
+    return jsonify({"collections": collections})
+
+@routes.route("/collections/<collection_id>", methods=["DELETE"])
+def delete_collection(collection_id):
+    """Delete a collection with its documents and embeddings, unsubscribing everyone"""
+    record = state_backend.delete_collection(collection_id)
+    if record is None:
+        return jsonify({"error": "Collection not found"}), 404
+
+    owner = collection_owner(collection_id)
+    for doc in state_backend.list_documents(owner):
+        removed = remove_user_document(owner, doc["id"])
+        if removed is not None and removed.get("file_path"):
+            try:
+                os.remove(removed["file_path"])
+            except FileNotFoundError:
+                pass
+    drop_user_state(owner)
+    forget_user_state_usage(owner)
+    shutil.rmtree(user_index_path(owner), ignore_errors=True)
+    logger.info(f"Deleted collection {collection_id} ({record['name']})")
+    return jsonify({"message": "Collection deleted successfully"})
+
+@routes.route("/collections/<collection_id>/subscribers", methods=["POST"])
+def subscribe_collection(collection_id):
+    """Add a collection to the documents a user's questions search"""
+    data = request.get_json(silent=True) or {}
+    user_id = data.get("user_id", "default")
+    if state_backend.get_collection(collection_id) is None:
+        return jsonify({"error": "Collection not found"}), 404
+    state_backend.set_subscription(user_id, collection_id, True)
+    response_cache.invalidate(user_id)
+    logger.info(f"User {user_id} subscribed to collection {collection_id}")
+    return jsonify({"user_id": user_id, "collections": state_backend.list_subscriptions(user_id)})
+
+@routes.route("/collections/<collection_id>/subscribers/<user_id>", methods=["DELETE"])
+def unsubscribe_collection(collection_id, user_id):
+    if not state_backend.set_subscription(user_id, collection_id, False):
+        return jsonify({"error": "Subscription not found"}), 404
+    response_cache.invalidate(user_id)
+    logger.info(f"User {user_id} unsubscribed from collection {collection_id}")
+    return jsonify({"user_id": user_id, "collections": state_backend.list_subscriptions(user_id)})
+
 # Debug endpoint to check document status
-@app.route("/debug/user-state", methods=["GET"])
+@routes.route("/debug/user-state", methods=["GET"])
 def debug_user_state():
     user_id = request.args.get('user_id', 'default')
-    docs = get_user_documents(user_id)
-    memory_msgs = get_memory(user_id)
+    summaries, _ = get_document_summaries(user_id)
+    summary, memory_msgs = get_conversation(user_id)
     embeddings = get_user_embeddings(user_id)
     
     return jsonify({
         "user_id": user_id,
-        "documents_count": len(docs),
-        "documents": [{"id": doc["id"], "filename": doc["filename"], "content_length": len(doc["content"]), "chunk_count": doc.get("chunk_count", 0)} for doc in docs],
+        "documents_count": len(summaries),
+        "documents": summaries[:DOCUMENTS_PAGE_SIZE],  # The rest through /documents
         "embeddings_count": len(embeddings),
+        "collections": state_backend.list_subscriptions(user_id),
         "memory_count": len(memory_msgs),
+        "memory_tokens": estimate_prompt_tokens(memory_msgs),
+        "memory_summary": summary,
         "memory": memory_msgs[-3:] if memory_msgs else []  # Last 3 messages
     })
 
+def preload_indexes():
+    """Load every shared collection's index. Run before gunicorn --preload forks,
+    the workers share these pages copy-on-write instead of each loading its own."""
+    started = time.perf_counter()
+    collections = state_backend.list_collections()
+    for record in collections:
+        get_user_embeddings(collection_owner(record["collection_id"]))
+    # Objects made so far are never collected, so GC passes in the workers do not write to (and copy) their pages
+    gc.freeze()
+    logger.info(f"Preloaded {len(collections)} collection indexes in {time.perf_counter() - started:.2f}s")
+
+def create_app():
+    """Build a Flask app. Servers use the module's `app`, built on first access;
+    call this directly for a separate app, e.g. in benchmarks.
+
+    Cheap to call: the Cohere SDK and the PDF and DOCX parsers are imported
+    on first use. With PRELOAD_INDEXES=true the collection indexes are loaded here.
+    """
+    for folder in (UPLOAD_FOLDER, INDEX_FOLDER, JOBS_FOLDER, UPLOAD_SESSIONS_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+    flask_app = Flask(__name__)
+    flask_app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    flask_app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+    CORS(flask_app)
+    flask_app.register_blueprint(routes)
+    if PRELOAD_INDEXES:
+        preload_indexes()
+    return flask_app
+
+app_lock = threading.Lock()
+
+def __getattr__(name):
+    """Build the module-level `app` for `gunicorn --preload src.app:app`, the ASGI
+    entry point and the benchmarks on first access, so importing this module
+    (e.g. from a pool process or a script) does not build one."""
+    global app
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with app_lock:
+        if "app" not in globals():
+            app = create_app()
+    return app
+
 if __name__ == "__main__":
     # For local development
     port = int(os.getenv('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
+    create_app().run(host='0.0.0.0', port=port, debug=True)
 else:
     # For Azure deployment
     # Azure will handle the WSGI server
-    pass
\ No newline at end of file
+    pass
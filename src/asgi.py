@@ -0,0 +1,333 @@
+"""ASGI entry point for serving many concurrent chats on a few workers.
+
+/chat and /chat-stream are served natively on the event loop with Cohere's
+AsyncClientV2, so a slow generation holds a coroutine instead of a worker
+thread. The query embed, conversation memory lookup and index refresh for a
+chat turn run concurrently. Every other route is the regular Flask app,
+run through asgiref's WSGI adapter.
+
+    uvicorn src.asgi:app --host 0.0.0.0 --port 8000 --workers 2
+"""
+import asyncio
+import json
+import random
+import time
+from urllib.parse import parse_qs
+
+import numpy as np
+from asgiref.wsgi import WsgiToAsgi
+
+from src import app as chatty
+
+logger = chatty.logger
+flask_app = WsgiToAsgi(chatty.app)
+async_co = None
+
+def get_async_client():
+    global async_co
+    if async_co is None:
+        # Imported on first use, like the sync client in src/app.py
+        import cohere
+        async_co = cohere.AsyncClientV2(api_key=chatty.COHERE_API_KEY)
+    return async_co
+
+async def embed_query_batch(texts):
+    """Embed search queries in one call, retrying transient failures like chatty.embed_batch"""
+    for attempt in range(chatty.EMBED_MAX_RETRIES + 1):
+        try:
+            async with chatty.model_scheduler.slot_async("interactive"):
+                response = await get_async_client().embed(
+                    texts=texts,
+                    model=chatty.EMBED_MODEL,
+                    input_type="search_query",
+                    embedding_types=["float"]
+                )
+            return response.embeddings.float_
+        except Exception as e:
+            if attempt == chatty.EMBED_MAX_RETRIES or not chatty.is_transient_error(e):
+                raise
+            await asyncio.sleep(chatty.EMBED_RETRY_BASE_DELAY * (2 ** attempt) * (1 + random.random()))
+
+class AsyncQueryEmbedBatcher:
+    """Event-loop counterpart of chatty.QueryEmbedBatcher: query embeds that arrive
+    within `window` seconds of each other share one embed call."""
+
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = []  # (text, asyncio.Future)
+        self.tasks = set()  # Running batches, referenced so they are not garbage collected
+        self.requests = 0
+        self.batches = 0
+
+    async def embed(self, text):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+        self.requests += 1
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif len(self.pending) == 1:
+            loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        try:
+            embeddings = dict(zip(texts, await embed_query_batch(texts)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, future in batch:
+            if not future.done():
+                future.set_result(np.asarray(embeddings[text], dtype=np.float32))
+
+query_embed_batcher = AsyncQueryEmbedBatcher(chatty.QUERY_BATCH_WINDOW, chatty.EMBED_BATCH_SIZE)
+
+async def embed_query(query):
+    """Async counterpart of chatty.embed_query, sharing its TTL cache"""
+    key = chatty.EmbeddingCache.make_key(chatty.EMBED_MODEL, "search_query", query)
+    with chatty.timed_stage("query_embed"):
+        embedding = chatty.query_embedding_cache.get(key)
+        if embedding is None:
+            embedding = await query_embed_batcher.embed(query)
+            chatty.query_embedding_cache.put(key, embedding)
+    return embedding
+
+async def lookup_cached_response(user_id, message, use_documents):
+    """Async counterpart of chatty.lookup_cached_response"""
+    try:
+        query_embedding = await embed_query(message)
+    except Exception as e:
+        logger.error(f"Response cache lookup failed: {str(e)}")
+        return None, None
+    version = await asyncio.to_thread(chatty.response_cache_version, user_id, use_documents)
+    answer = chatty.response_cache.get(user_id, version, use_documents, query_embedding)
+    if answer is not None:
+        logger.info(f"Answered from the response cache for user {user_id}")
+    return answer, (version, query_embedding)
+
+async def get_conversation(user_id, with_history):
+    if not with_history:
+        return "", []
+    return await asyncio.to_thread(chatty.get_conversation, user_id)
+
+async def build_chat_messages(user_id, message, use_documents, with_history=True):
+    """Same messages as chatty.build_chat_messages, with the independent lookups run concurrently"""
+    if not use_documents:
+        summary, history = await get_conversation(user_id, with_history)
+        return chatty.assemble_chat_messages(None, summary, history, message)
+
+    try:
+        query_embedding, (summary, history), _ = await asyncio.gather(
+            embed_query(message),
+            get_conversation(user_id, with_history),
+            asyncio.to_thread(chatty.searchable_indexes, user_id)
+        )
+    except Exception as e:
+        # Same as the sync path: a failed query embed falls back to whole-document context
+        logger.error(f"Error in semantic search: {str(e)}")
+        query_embedding = None
+        summary, history = await get_conversation(user_id, with_history)
+
+    system_message = await asyncio.to_thread(
+        chatty.document_system_message, message, user_id, query_embedding, query_embedding is not None
+    )
+    return chatty.assemble_chat_messages(system_message, summary, history, message)
+
+async def read_json(receive):
+    body = bytearray()
+    while True:
+        event = await receive()
+        body += event.get("body", b"")
+        if not event.get("more_body"):
+            break
+    try:
+        return json.loads(body or b"{}")
+    except ValueError:
+        return None
+
+def response_headers(content_type, extra=None):
+    headers = [
+        (b"content-type", content_type),
+        (b"access-control-allow-origin", b"*"),
+        (b"x-request-id", chatty.trace_id_var.get().encode())
+    ]
+    for name, value in (extra or {}).items():
+        headers.append((name.lower().encode(), value.encode()))
+    return headers
+
+async def send_json(send, status, payload):
+    await send({"type": "http.response.start", "status": status, "headers": response_headers(b"application/json")})
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+async def chat(scope, receive, send):
+    data = await read_json(receive)
+    if data is None:
+        return await send_json(send, 400, {"error": "Invalid JSON body"})
+    user_id = data.get("user_id", "default")
+    message = data.get("message", "").strip()
+    use_documents = data.get("use_documents", False)
+    use_cache = bool(data.get("use_cache", False)) and chatty.RESPONSE_CACHE_SIZE > 0
+
+    logger.info(f"Async chat request from user {user_id}, use_documents: {use_documents}")
+
+    if chatty.is_reserved_user_id(user_id):
+        return await send_json(send, 400, {"error": "user_id must not start with 'collection:'"})
+    if not message:
+        return await send_json(send, 400, {"error": "Message is required"})
+
+    cache_ticket = None
+    if use_cache:
+        cached_answer, cache_ticket = await lookup_cached_response(user_id, message, use_documents)
+        if cached_answer is not None:
+            await asyncio.to_thread(chatty.update_memory, user_id, message, cached_answer)
+            return await send_json(send, 200, {"response": cached_answer, "cached": True, "prompt_tokens": 0, "usage": None})
+
+    messages = await build_chat_messages(user_id, message, use_documents, with_history=not use_cache)
+    prompt_tokens = chatty.estimate_prompt_tokens(messages)
+    try:
+        async with chatty.model_scheduler.slot_async("interactive"):
+            with chatty.timed_stage("llm_total"):
+                response = await get_async_client().chat(model=chatty.CHAT_MODEL, messages=messages)
+        bot_response = response.message.content[0].text
+        await asyncio.to_thread(chatty.update_memory, user_id, message, bot_response)
+        chatty.store_cached_response(user_id, cache_ticket, use_documents, bot_response)
+        logger.info(f"Chat response generated ({len(bot_response)} chars)")
+        await send_json(send, 200, {
+            "response": bot_response,
+            "cached": False,
+            "prompt_tokens": prompt_tokens,
+            "usage": chatty.usage_to_dict(getattr(response, 'usage', None))
+        })
+    except Exception as e:
+        logger.error(f"Chat error: {str(e)}")
+        await send_json(send, 500, {"error": f"Chat failed: {str(e)}"})
+
+async def model_stream(messages):
+    """Chat stream chunks, holding a slot in the scheduler's stream lane until the last one"""
+    async with chatty.model_scheduler.slot_async("stream"):
+        async for chunk in get_async_client().chat_stream(model=chatty.CHAT_MODEL, messages=messages):
+            yield chunk
+
+async def chat_stream(scope, receive, send):
+    data = await read_json(receive)
+    if data is None:
+        return await send_json(send, 400, {"error": "Invalid JSON body"})
+    user_id = data.get("user_id", "default")
+    message = data.get("message", "").strip()
+    use_documents = data.get("use_documents", False)
+    use_cache = bool(data.get("use_cache", False)) and chatty.RESPONSE_CACHE_SIZE > 0
+    query = parse_qs(scope.get("query_string", b"").decode())
+    delta_mode = query.get("protocol", ["full"])[0] == "delta"
+
+    logger.info(f"Async stream chat request from user {user_id}, use_documents: {use_documents}")
+
+    if chatty.is_reserved_user_id(user_id):
+        return await send_json(send, 400, {"error": "user_id must not start with 'collection:'"})
+    if not message:
+        return await send_json(send, 400, {"error": "Message is required"})
+
+    async def start_stream():
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": response_headers(b"text/event-stream", chatty.SSE_HEADERS)
+        })
+
+    async def emit(text):
+        await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+    cache_ticket = None
+    if use_cache:
+        cached_answer, cache_ticket = await lookup_cached_response(user_id, message, use_documents)
+        if cached_answer is not None:
+            await asyncio.to_thread(chatty.update_memory, user_id, message, cached_answer)
+            encoder = chatty.ChatStreamEncoder(delta_mode=delta_mode, prompt_tokens=0)
+            await start_stream()
+            await emit(encoder.replay(cached_answer))
+            await emit(encoder.done())
+            return await send({"type": "http.response.body", "body": b""})
+
+    messages = await build_chat_messages(user_id, message, use_documents, with_history=not use_cache)
+    encoder = chatty.ChatStreamEncoder(delta_mode=delta_mode, prompt_tokens=chatty.estimate_prompt_tokens(messages))
+    await start_stream()
+
+    try:
+        # Waiting for a stream lane slot happens inside the first __anext__, so it gets keep-alives too
+        chunks = model_stream(messages).__aiter__()
+        next_chunk = asyncio.ensure_future(chunks.__anext__())
+        try:
+            while True:
+                done, _ = await asyncio.wait({next_chunk}, timeout=chatty.STREAM_KEEPALIVE_SECONDS)
+                if not done:
+                    await emit(chatty.SSE_KEEPALIVE)
+                    continue
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+                event = encoder.encode(chunk)
+                if event:
+                    await emit(event)
+        finally:
+            # Cancelling the pending step unwinds model_stream and frees its slot now, not at garbage collection
+            next_chunk.cancel()
+            await asyncio.gather(next_chunk, return_exceptions=True)
+
+        await asyncio.to_thread(chatty.update_memory, user_id, message, encoder.text)
+        chatty.store_cached_response(user_id, cache_ticket, use_documents, encoder.text)
+        await emit(encoder.done())
+        chatty.observe_chat_stream(encoder)
+        logger.info(f"Streaming chat completed ({len(encoder.text)} chars)")
+    except Exception as e:
+        logger.error(f"Streaming error: {str(e)}")
+        await emit(encoder.error(e))
+    await send({"type": "http.response.body", "body": b""})
+
+NATIVE_ROUTES = {
+    "/chat": chat,
+    "/chat-stream": chat_stream
+}
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    handler = NATIVE_ROUTES.get(scope.get("path"))
+    if scope["type"] == "http" and scope["method"] == "POST" and handler is not None:
+        headers = dict(scope.get("headers") or [])
+        chatty.trace_id_var.set(chatty.request_trace_id(headers.get(b"x-request-id", b"").decode("latin-1")))
+        started = time.perf_counter()
+        status = {}
+
+        async def send_and_record(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        await handler(scope, receive, send_and_record)
+        # Unlike the Flask hook this covers the whole stream
+        chatty.latency_metrics.observe("chatty_request_seconds", {
+            "endpoint": scope["path"],
+            "status": str(status.get("code", 500))
+        }, time.perf_counter() - started)
+        return
+    await flask_app(scope, receive, send)
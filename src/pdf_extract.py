@@ -0,0 +1,18 @@
+"""PDF page extraction, run in the extraction process pool of src/app.py.
+
+Kept apart from src/app.py so the spawned pool processes import only
+PyPDF2, not the whole app with its Flask app, clients and state.
+"""
+import PyPDF2
+
+
+def count_pdf_pages(file_path):
+    with open(file_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+
+def extract_pdf_pages(file_path, start, end):
+    """Extract the text of PDF pages [start, end)"""
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        return [pdf_reader.pages[i].extract_text() + "\n" for i in range(start, end)]
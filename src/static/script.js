@@ -33,8 +33,9 @@ const CONFIG = {
   },
 
   endpoints: {
-    chat: '/chat-stream',
+    chat: '/chat-stream?protocol=delta',
     upload: '/upload',
+    uploadStatus: '/upload-status',
     documents: '/documents',
     deleteDocument: '/delete-document',
     search: '/search',
@@ -48,6 +49,8 @@ const userId = 'user_' + Math.random().toString(36).substr(2, 9);
 // State
 let useDocuments = false;
 let isUploading = false;
+let documentsCursor = null;  // Where the next page of the document list starts; null when all are loaded
+let documentsLoading = false;
 
 // Utility function to build full URL
 function buildUrl(endpoint) {
@@ -76,6 +79,12 @@ function setupEventListeners() {
   uploadArea.addEventListener('drop', handleDrop);
   fileInput.addEventListener('change', handleFileSelect);
   useDocumentsCheckbox.addEventListener('change', handleDocumentToggle);
+  // Fetch the next page of documents when the list is scrolled near its end
+  documentsList.addEventListener('scroll', () => {
+    if (documentsList.scrollTop + documentsList.clientHeight >= documentsList.scrollHeight - 100) {
+      loadMoreDocuments();
+    }
+  });
 
   // Search functionality
   searchBtn.addEventListener('click', handleSearch);
@@ -149,13 +158,17 @@ async function sendMessage(message) {
     const reader = res.body.getReader();
     const decoder = new TextDecoder();
     let buffer = "";
+    let responseText = "";
+    let finished = false;
 
     typingIndicator.remove();
     let botMsg = document.createElement("div");
     botMsg.className = "message bot";
+    // Deltas are appended as plain text while streaming and formatted once at the end
+    botMsg.style.whiteSpace = "pre-wrap";
     chatBox.appendChild(botMsg);
 
-    while (true) {
+    while (!finished) {
       const { done, value } = await reader.read();
       if (done) break;
 
@@ -163,28 +176,35 @@ async function sendMessage(message) {
       const parts = buffer.split("\n\n");
       buffer = parts.pop();
 
-      for (let part of parts) {
-        if (part.startsWith("data: ")) {
-          const dataStr = part.slice(6);
-          if (dataStr === "[DONE]") {
-            break;
-          }
-
-          try {
-            const json = JSON.parse(dataStr);
-            if (json.response) {
-              botMsg.innerHTML = formatMessage(json.response);
-              chatBox.scrollTop = chatBox.scrollHeight;
-            } else if (json.error) {
-              botMsg.textContent = `Error: ${json.error}`;
-              botMsg.style.color = "#dc3545";
-            }
-          } catch (e) {
-            console.error("Error parsing JSON:", e);
+      for (const part of parts) {
+        const event = parseSseEvent(part);
+        if (!event) continue;
+
+        try {
+          const json = JSON.parse(event.data);
+          if (event.type === "delta") {
+            responseText += json.delta;
+            botMsg.appendChild(document.createTextNode(json.delta));
+            chatBox.scrollTop = chatBox.scrollHeight;
+          } else if (event.type === "done") {
+            console.log('Stream finished:', json);
+            finished = true;
+          } else if (json.error) {
+            botMsg.textContent = `Error: ${json.error}`;
+            botMsg.style.color = "#dc3545";
+            finished = true;
           }
+        } catch (e) {
+          console.error("Error parsing JSON:", e);
         }
       }
     }
+
+    if (responseText) {
+      botMsg.style.whiteSpace = "";
+      botMsg.innerHTML = formatMessage(responseText);
+      chatBox.scrollTop = chatBox.scrollHeight;
+    }
   } catch (error) {
     console.error('Chat error:', error);
     typingIndicator.remove();
@@ -194,6 +214,26 @@ async function sendMessage(message) {
   }
 }
 
+// Parse one server-sent event block into { id, type, data }; comments (keep-alives) return null
+function parseSseEvent(block) {
+  const event = { id: null, type: "message", data: "" };
+  const dataLines = [];
+
+  for (const line of block.split("\n")) {
+    if (!line || line.startsWith(":")) continue;
+    const separator = line.indexOf(":");
+    const field = separator === -1 ? line : line.slice(0, separator);
+    const value = separator === -1 ? "" : line.slice(separator + 1).replace(/^ /, "");
+    if (field === "id") event.id = value;
+    else if (field === "event") event.type = value;
+    else if (field === "data") dataLines.push(value);
+  }
+
+  if (dataLines.length === 0) return null;
+  event.data = dataLines.join("\n");
+  return event;
+}
+
 function formatMessage(text) {
   // Basic formatting for better readability
   return text
@@ -286,6 +326,7 @@ async function handleFiles(files) {
   if (files.length === 0) return;
 
   showUploadProgress(true);
+  uploadProgress.textContent = 'Processing...';
   let successCount = 0;
   let totalFiles = files.length;
 
@@ -327,22 +368,71 @@ async function uploadFile(file) {
     throw new Error(result.error || 'Upload failed');
   }
 
-  console.log('Upload successful:', result);
-  return result;
+  console.log('Upload accepted:', result);
+  const job = await waitForUploadJob(result.job_id, file.name);
+  console.log('Upload processed:', job);
+  return job;
 }
 
+// Poll the background ingestion job until the document is searchable
+async function waitForUploadJob(jobId, fileName) {
+  const url = buildUrl(`${CONFIG.endpoints.uploadStatus}/${jobId}`);
+
+  while (true) {
+    const response = await fetch(url);
+    const job = await response.json();
+
+    if (!response.ok) {
+      throw new Error(job.error || 'Upload status unavailable');
+    }
+    if (job.status === 'completed') {
+      return job;
+    }
+    if (job.status === 'failed') {
+      throw new Error(job.error || 'Upload failed');
+    }
+
+    let stageText = job.stage === 'queued' ? 'Queued' : `${job.stage.charAt(0).toUpperCase()}${job.stage.slice(1)}`;
+    if (job.stage === 'embedding' && job.progress.chunk_count) {
+      stageText += ` ${job.progress.chunks_embedded}/${job.progress.chunk_count} chunks`;
+    }
+    uploadProgress.textContent = `${fileName}: ${stageText}...`;
+
+    await new Promise(resolve => setTimeout(resolve, 1000));
+  }
+}
+
+// Load the first page of the document list; later pages load on scroll.
+// The server answers an unchanged page with 304 and the browser reuses its cached copy.
 async function loadDocuments() {
+  documentsCursor = null;
+  await loadDocumentsPage(true);
+}
+
+async function loadMoreDocuments() {
+  if (documentsCursor && !documentsLoading) {
+    await loadDocumentsPage(false);
+  }
+}
+
+async function loadDocumentsPage(reset) {
+  documentsLoading = true;
   try {
-    const url = buildUrl(`${CONFIG.endpoints.documents}?user_id=${userId}`);
+    const cursorParam = documentsCursor ? `&cursor=${encodeURIComponent(documentsCursor)}` : '';
+    const url = buildUrl(`${CONFIG.endpoints.documents}?user_id=${userId}${cursorParam}`);
     const response = await fetch(url);
     const result = await response.json();
 
-    documentsList.innerHTML = '';
+    if (reset) {
+      documentsList.innerHTML = '';
+    }
+    documentsCursor = result.next_cursor || null;
 
     if (result.documents && result.documents.length > 0) {
       result.documents.forEach(doc => {
         const docElement = document.createElement('div');
         docElement.className = 'document-item';
+        docElement.dataset.documentId = doc.id;
         docElement.innerHTML = `
           <div class="document-info">
             <div class="document-name">${escapeHtml(doc.filename)}</div>
@@ -357,13 +447,36 @@ async function loadDocuments() {
         documentsList.appendChild(docElement);
       });
 
-      console.log(`Loaded ${result.documents.length} documents`);
-    } else {
+      console.log(`Loaded ${result.documents.length} of ${result.total} documents`);
+    } else if (reset) {
       documentsList.innerHTML = '<div class="no-documents">No documents uploaded yet</div>';
     }
   } catch (error) {
     console.error('Error loading documents:', error);
-    documentsList.innerHTML = '<div class="no-documents">Error loading documents</div>';
+    if (reset) {
+      documentsList.innerHTML = '<div class="no-documents">Error loading documents</div>';
+    }
+  } finally {
+    documentsLoading = false;
+  }
+  // A short first page may not fill the list enough to scroll
+  if (documentsCursor && documentsList.scrollHeight <= documentsList.clientHeight) {
+    await loadMoreDocuments();
+  }
+}
+
+// Drop a deleted document from the list without fetching it again
+function removeDocumentElement(documentId) {
+  const docElement = documentsList.querySelector(`[data-document-id="${CSS.escape(documentId)}"]`);
+  if (docElement) {
+    docElement.remove();
+  }
+  if (!documentsList.querySelector('.document-item')) {
+    if (documentsCursor) {
+      loadDocuments();
+    } else {
+      documentsList.innerHTML = '<div class="no-documents">No documents uploaded yet</div>';
+    }
   }
 }
 
@@ -387,7 +500,7 @@ async function deleteDocument(documentId) {
 
     if (response.ok) {
       addMessage(result.message, 'system');
-      loadDocuments();
+      removeDocumentElement(documentId);
     } else {
       addMessage(`Error: ${result.error}`, 'system');
     }
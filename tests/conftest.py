@@ -0,0 +1,54 @@
+import atexit
+import io
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# src.app refuses to import without a key; the tests never call Cohere
+os.environ.setdefault("COHERE_API_KEY", "test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("MODEL_CALLS_PER_MINUTE", "0")
+sys.path.insert(0, ROOT)
+# UPLOAD_FOLDER and the state database are created under the working directory on import
+WORKDIR = tempfile.mkdtemp(prefix="chatty-tests-")
+os.chdir(WORKDIR)
+atexit.register(shutil.rmtree, WORKDIR, True)
+
+from benchmarks.fake_cohere import FakeClientV2
+from src import app as chatty
+
+
+@pytest.fixture
+def fake_cohere(monkeypatch):
+    fake = FakeClientV2(dims=64, embed_latency=0, per_text_latency=0, ttft=0, token_latency=0, tokens=8)
+    monkeypatch.setattr(chatty, "co", fake)
+    return fake
+
+
+@pytest.fixture
+def client(fake_cohere):
+    return chatty.app.test_client()
+
+
+@pytest.fixture
+def user_id():
+    """A user no other test has touched"""
+    return f"test-{uuid.uuid4().hex[:12]}"
+
+
+@pytest.fixture
+def upload(client):
+    """Upload a text document and wait for it to be processed; returns the response"""
+    def upload(user_id, text, filename="notes.txt", **form):
+        return client.post("/upload", data={
+            "user_id": user_id,
+            "wait": "true",
+            "file": (io.BytesIO(text.encode("utf-8")), filename),
+            **form
+        })
+    return upload
@@ -0,0 +1,89 @@
+"""Tests for the native async routes in src/asgi.py"""
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+from benchmarks.fake_cohere import FakeAsyncClientV2
+from src import app as chatty
+from src import asgi
+
+
+@pytest.fixture
+def async_cohere(fake_cohere, monkeypatch):
+    monkeypatch.setattr(asgi, "async_co", FakeAsyncClientV2(fake_cohere))
+    return fake_cohere
+
+
+def call_asgi(method, path, body=b"", query=b""):
+    """Run one request through asgi.app; returns (status, headers, body)"""
+    sent = []
+    scope = {"type": "http", "method": method, "path": path, "query_string": query, "headers": [],
+             "http_version": "1.1", "scheme": "http", "root_path": "", "raw_path": path.encode(),
+             "server": ("testserver", 80), "client": ("127.0.0.1", 1234)}
+
+    async def receive():
+        return {"type": "http.request", "body": body}
+
+    async def send(event):
+        sent.append(event)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    start = next(event for event in sent if event["type"] == "http.response.start")
+    headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    return start["status"], headers, b"".join(event.get("body", b"") for event in sent[1:])
+
+
+def post_json(path, payload):
+    status, headers, body = call_asgi("POST", path, json.dumps(payload).encode())
+    return status, json.loads(body)
+
+
+def test_chat_is_answered_on_the_event_loop(async_cohere, user_id):
+    status, reply = post_json("/chat", {"user_id": user_id, "message": "hello there"})
+    assert status == 200
+    assert reply["response"] == "hello there " * 4
+    assert reply["usage"]["output_tokens"] == 8
+    assert async_cohere.calls["chat"] == 1
+    assert chatty.get_conversation(user_id)[1] == [
+        {"role": "user", "content": "hello there"},
+        {"role": "chatbot", "content": reply["response"]}
+    ]
+
+
+def test_chat_with_documents_embeds_the_query_asynchronously(async_cohere, upload, user_id):
+    upload(user_id, "The office is closed on public holidays. " * 20, "handbook.txt")
+    embeds = async_cohere.calls["embed"]
+    status, _ = post_json("/chat", {"user_id": user_id, "message": "when is the office closed?",
+                                        "use_documents": True})
+    assert status == 200
+    assert async_cohere.calls["embed"] == embeds + 1
+
+
+def test_chat_rejects_bad_requests(async_cohere):
+    status, _, body = call_asgi("POST", "/chat", b"not json")
+    assert (status, json.loads(body)) == (400, {"error": "Invalid JSON body"})
+    assert post_json("/chat", {"user_id": "collection:shared", "message": "hi"})[0] == 400
+    assert post_json("/chat", {"user_id": "someone", "message": " "})[0] == 400
+
+
+def test_other_routes_are_served_by_the_flask_app(async_cohere, upload, user_id):
+    upload(user_id, "Some notes. " * 20)
+    status, _, body = call_asgi("GET", "/documents", query=f"user_id={user_id}".encode())
+    assert status == 200
+    assert [document["filename"] for document in json.loads(body)["documents"]] == ["notes.txt"]
+
+
+def test_concurrent_async_query_embeds_share_one_call(async_cohere):
+    batcher = asgi.AsyncQueryEmbedBatcher(window=0.01, max_batch=96)
+    queries = [f"question {i % 3}" for i in range(6)]
+
+    async def main():
+        return await asyncio.gather(*(batcher.embed(query) for query in queries))
+
+    results = asyncio.run(main())
+    assert async_cohere.calls["embed"] == 1
+    assert async_cohere.calls["embedded_texts"] == 3
+    for query, embedding in zip(queries, results):
+        np.testing.assert_allclose(embedding, async_cohere.vector(query))
@@ -0,0 +1,123 @@
+"""Tests for the chat routes: streaming protocols, memory and the response cache"""
+import json
+
+from src import app as chatty
+
+
+def sse_events(text):
+    """(event, id, data) of every event in an SSE body, skipping comments"""
+    events = []
+    for block in text.split("\n\n"):
+        fields = {}
+        for line in block.splitlines():
+            if line and not line.startswith(":"):
+                name, _, value = line.partition(": ")
+                fields[name] = value
+        if "data" in fields:
+            events.append((fields.get("event"), fields.get("id"), fields["data"]))
+    return events
+
+
+def stream_chat(client, protocol, **payload):
+    response = client.post(f"/chat-stream?protocol={protocol}", json={"message": "hello there", **payload})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    return sse_events(response.get_data(as_text=True))
+
+
+def test_delta_stream_sends_only_new_text(client, user_id):
+    events = stream_chat(client, "delta", user_id=user_id)
+    deltas, done = events[:-1], events[-1]
+    assert {event for event, _, _ in deltas} == {"delta"}
+    assert [int(event_id) for _, event_id, _ in events] == list(range(1, len(events) + 1))
+    answer = "".join(json.loads(data)["delta"] for _, _, data in deltas)
+    assert answer == "hello there " * 4
+
+    assert done[0] == "done"
+    summary = json.loads(done[2])
+    assert summary["length"] == len(answer)
+    assert summary["usage"]["output_tokens"] == 8
+    assert summary["cached"] is False
+
+
+def test_full_stream_resends_the_answer_so_far(client, user_id):
+    events = stream_chat(client, "full", user_id=user_id)
+    assert events[-1] == (None, None, "[DONE]")
+    answers = [json.loads(data)["response"] for _, _, data in events[:-1]]
+    assert len(answers) == 8
+    for shorter, longer in zip(answers, answers[1:]):
+        assert longer.startswith(shorter) and len(longer) > len(shorter)
+    assert answers[-1] == "hello there " * 4
+
+
+def test_stream_requires_a_message(client, user_id):
+    response = client.post("/chat-stream?protocol=delta", json={"user_id": user_id, "message": "  "})
+    assert response.status_code == 400
+
+
+def test_history_is_cut_to_the_token_budget(user_id, monkeypatch):
+    monkeypatch.setattr(chatty, "schedule_memory_summary", lambda user_id: None)
+    for turn in range(5):
+        chatty.update_memory(user_id, f"question {turn} " + "x" * 400, f"answer {turn} " + "y" * 400)
+    monkeypatch.setattr(chatty, "MEMORY_TOKEN_BUDGET", 250)
+    summary, history = chatty.get_conversation(user_id)
+    assert summary == ""
+    assert [message["content"].split()[:2] for message in history] == [["question", "4"], ["answer", "4"]]
+
+    # A single message over the budget is clipped rather than dropped
+    monkeypatch.setattr(chatty, "MEMORY_TOKEN_BUDGET", 20)
+    _, history = chatty.get_conversation(user_id)
+    assert len(history) == 1
+    assert history[0]["content"].startswith("answer 4") and history[0]["content"].endswith(" [...]")
+
+
+def test_older_turns_are_folded_into_the_summary(fake_cohere, user_id, monkeypatch):
+    monkeypatch.setattr(chatty, "schedule_memory_summary", lambda user_id: None)
+    for turn in range(4):
+        chatty.update_memory(user_id, f"question {turn} " + "x" * 400, f"answer {turn} " + "y" * 400)
+    monkeypatch.setattr(chatty, "MEMORY_RECENT_TOKENS", 250)
+    chatty.summarize_memory(user_id)
+
+    summary, messages = chatty.state_backend.get_memory(user_id)
+    assert fake_cohere.calls["chat"] == 1
+    assert summary
+    assert [message["content"].split()[:2] for message in messages] == [["question", "3"], ["answer", "3"]]
+
+    chat_messages = chatty.build_chat_messages(user_id, "and now?", use_documents=False)
+    assert chat_messages[0] == {"role": "system",
+                                "content": f"Summary of the earlier conversation with this user:\n{summary}"}
+    assert chat_messages[-1] == {"role": "user", "content": "and now?"}
+
+
+def test_repeated_questions_are_answered_from_the_cache(client, fake_cohere, upload, user_id):
+    upload(user_id, "Refunds are paid within thirty days of a return. " * 20, "policy.txt")
+
+    def ask(message):
+        response = client.post("/chat", json={"user_id": user_id, "message": message,
+                                              "use_documents": True, "use_cache": True})
+        assert response.status_code == 200
+        return response.get_json()
+
+    first = ask("What is the refund policy?")
+    assert first["cached"] is False
+    again = ask("what is the refund policy")
+    assert again["cached"] is True and again["response"] == first["response"]
+    assert fake_cohere.calls["chat"] == 1
+
+    events = stream_chat(client, "delta", user_id=user_id, use_documents=True, use_cache=True,
+                         message="What is the refund policy?")
+    assert json.loads(events[0][2])["delta"] == first["response"]
+    assert json.loads(events[-1][2])["cached"] is True
+    assert fake_cohere.calls["chat_stream"] == 0
+
+    # A new document changes the answer's inputs, so the cached answer is retired
+    upload(user_id, "Store credit never expires. " * 20, "credit.txt")
+    assert ask("What is the refund policy?")["cached"] is False
+    assert fake_cohere.calls["chat"] == 2
+
+
+def test_answers_are_cached_per_user(client, fake_cohere, user_id):
+    for asker in (user_id, f"{user_id}-other"):
+        response = client.post("/chat", json={"user_id": asker, "message": "Tell me a fact", "use_cache": True})
+        assert response.get_json()["cached"] is False
+    assert fake_cohere.calls["chat"] == 2
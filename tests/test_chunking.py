@@ -0,0 +1,101 @@
+"""Tests for text extraction and chunking"""
+import random
+
+import pytest
+
+from src import app as chatty
+
+
+def make_pdf(pages):
+    """A minimal PDF with one line of Helvetica text per page"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>")
+    font = 3 + 2 * len(pages)
+    for i, text in enumerate(pages):
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 {font} 0 R >> >> /Contents {4 + 2 * i} 0 R >>")
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    pdf = "%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n"
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF"
+    return pdf.encode("latin-1")
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_streamed_chunks_match_whole_text(seed):
+    rng = random.Random(seed)
+    text = "".join(rng.choice("abc de.\n!?  ") for _ in range(rng.choice([0, 40, 499, 501, 3000, 20000])))
+    chunk_size, overlap = rng.choice([(500, 50), (200, 10), (120, 30)])
+
+    chunker = chatty.StreamingChunker(chunk_size, overlap)
+    streamed = []
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, 700)
+        streamed += chunker.feed(text[position:position + size])
+        position += size
+    streamed += chunker.finish()
+
+    assert streamed == chatty.chunk_text_spans(text, chunk_size, overlap)
+    for start, end, chunk in streamed:
+        assert text[start:end] == chunk
+
+
+def test_pdf_pages_come_out_in_order_from_the_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatty, "PDF_PAGES_PER_TASK", 2)
+    path = tmp_path / "report.pdf"
+    path.write_bytes(make_pdf([f"Page number {i}" for i in range(7)]))
+
+    pages = list(chatty.iter_document_pages(str(path), "report.pdf"))
+    assert [page.strip() for page in pages] == [f"Page number {i}" for i in range(7)]
+
+
+def test_unsupported_file_types_are_refused(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"\x89PNG")
+    with pytest.raises(ValueError):
+        list(chatty.iter_document_pages(str(path), "image.png"))
+
+
+def sample_document(seed, sentences=300):
+    rng = random.Random(seed)
+    words = ["alpha", "beta", "gamma", "delta", "omega", "sigma", "kappa", "theta", "lambda", "zeta"]
+    return " ".join(" ".join(rng.choice(words) for _ in range(rng.randint(4, 14))).capitalize() + "."
+                    for _ in range(sentences))
+
+
+def test_an_edit_only_moves_the_chunks_around_it():
+    text = sample_document(0)
+    middle = len(text) // 2
+    edited = text[:middle] + " An inserted sentence about something new. " + text[middle:]
+    before = [chunk for _, _, chunk in chatty.chunk_text_spans(text)]
+    after = [chunk for _, _, chunk in chatty.chunk_text_spans(edited)]
+    # The chunk holding the edit and the neighbours overlapping it change; the other dozens do not
+    assert len(after) > 20
+    assert len(set(after) - set(before)) <= 4
+
+
+def test_reuploading_an_edited_document_reuses_unchanged_chunks(fake_cohere, upload, user_id, monkeypatch):
+    text = sample_document(1)
+    first = upload(user_id, text, "report.txt").get_json()
+    # With the embedding cache disabled, only re-indexing can avoid re-embedding
+    monkeypatch.setattr(chatty, "embedding_cache", chatty.EmbeddingCache(0))
+    embedded = fake_cohere.calls["embedded_texts"]
+
+    edited = upload(user_id, text + " A closing sentence was added later.", "report.txt").get_json()
+    assert edited["document_id"] == first["document_id"]
+    assert edited["version"] == 2
+    assert edited["chunks_reused"] >= edited["chunk_count"] - 2
+    assert fake_cohere.calls["embedded_texts"] - embedded == edited["chunk_count"] - edited["chunks_reused"]
+    [record] = chatty.get_user_documents(user_id)
+    assert record["version"] == 2
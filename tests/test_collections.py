@@ -0,0 +1,73 @@
+"""Tests for shared document collections"""
+import os
+
+from src import app as chatty
+
+
+def create_collection(client, name="Handbook"):
+    response = client.post("/collections", json={"name": name, "user_id": "admin"})
+    assert response.status_code == 201
+    return response.get_json()["collection_id"]
+
+
+def batch_matches(client, user_id, query):
+    response = client.post("/search/batch", json={"queries": [query], "user_id": user_id, "threshold": 0.3})
+    assert response.status_code == 200
+    return response.get_json()["results"][0]["matches"]
+
+
+def test_subscribers_search_a_collection_indexed_once(client, fake_cohere, upload, user_id):
+    collection_id = create_collection(client)
+    response = upload(user_id, "Expense reports are due on the fifth of each month. " * 30,
+                      "expenses.txt", collection_id=collection_id)
+    assert response.status_code == 200
+    embedded = fake_cohere.calls["embedded_texts"]
+
+    readers = [f"{user_id}-{n}" for n in range(3)]
+    for reader in readers[:2]:
+        response = client.post(f"/collections/{collection_id}/subscribers", json={"user_id": reader})
+        assert response.get_json()["collections"] == [collection_id]
+    for reader in readers[:2]:
+        matches = batch_matches(client, reader, "expense reports due")
+        assert matches and {match["collection_id"] for match in matches} == {collection_id}
+    assert batch_matches(client, readers[2], "expense reports due") == []
+    assert fake_cohere.calls["embedded_texts"] == embedded + 1  # Just the query
+
+    listed = {record["collection_id"]: record for record in
+              client.get(f"/collections?user_id={readers[0]}").get_json()["collections"]}
+    assert listed[collection_id]["subscribed"] is True
+    assert (listed[collection_id]["subscribers"], listed[collection_id]["document_count"]) == (2, 1)
+
+
+def test_unsubscribing_stops_the_collection_being_searched(client, upload, user_id):
+    collection_id = create_collection(client)
+    upload(user_id, "Parking permits are issued at reception. " * 30, "parking.txt", collection_id=collection_id)
+    client.post(f"/collections/{collection_id}/subscribers", json={"user_id": user_id})
+    assert batch_matches(client, user_id, "parking permits reception")
+
+    response = client.delete(f"/collections/{collection_id}/subscribers/{user_id}")
+    assert response.get_json()["collections"] == []
+    assert batch_matches(client, user_id, "parking permits reception") == []
+    assert client.delete(f"/collections/{collection_id}/subscribers/{user_id}").status_code == 404
+
+
+def test_deleting_a_collection_removes_its_index(client, upload, user_id):
+    collection_id = create_collection(client)
+    upload(user_id, "Fire drills happen every quarter. " * 30, "safety.txt", collection_id=collection_id)
+    client.post(f"/collections/{collection_id}/subscribers", json={"user_id": user_id})
+    index_path = chatty.user_index_path(chatty.collection_owner(collection_id))
+    assert os.path.isdir(index_path)
+
+    assert client.delete(f"/collections/{collection_id}").status_code == 200
+    assert not os.path.exists(index_path)
+    assert batch_matches(client, user_id, "fire drills quarter") == []
+    assert client.delete(f"/collections/{collection_id}").status_code == 404
+    assert upload(user_id, "Too late. " * 30, collection_id=collection_id).status_code == 404
+
+
+def test_collection_keys_are_not_user_ids(client):
+    collection_id = create_collection(client)
+    owner = chatty.collection_owner(collection_id)
+    assert client.get(f"/documents?user_id={owner}").status_code == 400
+    assert client.post("/search", json={"user_id": owner, "query": "anything"}).status_code == 400
+    assert client.post(f"/collections/{collection_id}/subscribers", json={"user_id": owner}).status_code == 400
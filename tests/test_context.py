@@ -0,0 +1,43 @@
+"""Tests for building the document context sent with a chat"""
+from src import app as chatty
+
+
+def test_merge_chunk_spans_drops_the_repeated_overlap():
+    content = "".join(chr(ord("a") + i % 26) for i in range(300))
+    chunks = [
+        {"doc_id": "d", "start": 100, "end": 200, "text": content[100:200], "similarity": 0.5},
+        {"doc_id": "d", "start": 0, "end": 120, "text": content[0:120], "similarity": 0.9},
+        {"doc_id": "d", "start": 250, "end": 300, "text": content[250:300], "similarity": 0.7},
+    ]
+    passages = chatty.merge_chunk_spans(chunks)
+    assert [(p["start"], p["end"], p["similarity"], p["chunk_count"]) for p in passages] == [
+        (0, 200, 0.9, 2), (250, 300, 0.7, 1)
+    ]
+    assert passages[0]["text"] == content[0:200]
+
+
+def test_fallback_ranks_the_chunks_sharing_query_words(upload, user_id):
+    filler = "Nothing of note happens in this part of the report. " * 40
+    upload(user_id, filler + "The refund policy allows returns within thirty days. " + filler, "report.txt")
+    passages, postings = chatty.fallback_passages(user_id)
+    best = next(chatty.lexical_passages(passages, postings, "what is the refund policy?"))
+    assert "refund policy" in best["text"]
+    assert best["score"][0] > 0
+
+
+def test_fallback_passages_are_cached_until_the_documents_change(upload, user_id, monkeypatch):
+    upload(user_id, "Cats sleep for most of the day. " * 20, "cats.txt")
+    loads = []
+    load_fallback_documents = chatty.load_fallback_documents
+    monkeypatch.setattr(chatty, "load_fallback_documents",
+                        lambda user_id: loads.append(user_id) or load_fallback_documents(user_id))
+
+    for _ in range(2):
+        message = chatty.document_system_message("do cats sleep?", user_id, semantic=False)
+        assert "cats.txt" in message["content"]
+    assert len(loads) == 1
+
+    upload(user_id, "Dogs dig holes in the garden. " * 20, "dogs.txt")
+    message = chatty.document_system_message("where do dogs dig?", user_id, semantic=False)
+    assert len(loads) == 2
+    assert "dogs.txt" in message["content"]
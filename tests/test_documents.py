@@ -0,0 +1,71 @@
+"""Tests for the /documents listing"""
+import gzip
+import json
+
+from src import app as chatty
+
+
+def upload_documents(upload, user_id, count):
+    return [upload(user_id, f"Document {i} says something. " * 20, f"doc-{i}.txt").get_json()["document_id"]
+            for i in range(count)]
+
+
+def list_page(client, user_id, **params):
+    query = "&".join(f"{key}={value}" for key, value in dict(user_id=user_id, **params).items())
+    response = client.get(f"/documents?{query}")
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_cursor_pages_cover_every_document_in_upload_order(client, upload, user_id):
+    doc_ids = upload_documents(upload, user_id, 5)
+    seen = []
+    page = list_page(client, user_id, limit=2)
+    while True:
+        assert page["total"] == 5 and len(page["documents"]) <= 2
+        seen += [document["id"] for document in page["documents"]]
+        if page["next_cursor"] is None:
+            break
+        page = list_page(client, user_id, limit=2, cursor=page["next_cursor"])
+    assert seen == doc_ids
+
+
+def test_cursor_survives_deleting_its_document(client, upload, user_id):
+    doc_ids = upload_documents(upload, user_id, 4)
+    page = list_page(client, user_id, limit=2)
+    client.delete("/delete-document", json={"user_id": user_id, "document_id": doc_ids[1]})
+    page = list_page(client, user_id, limit=2, cursor=page["next_cursor"])
+    assert [document["id"] for document in page["documents"]] == doc_ids[2:]
+
+
+def test_bad_listing_parameters_are_rejected(client, user_id):
+    assert client.get(f"/documents?user_id={user_id}&cursor=!!!").status_code == 400
+    assert client.get(f"/documents?user_id={user_id}&limit=ten").status_code == 400
+
+
+def test_unchanged_listings_revalidate_with_a_304(client, upload, user_id):
+    upload_documents(upload, user_id, 1)
+    response = client.get(f"/documents?user_id={user_id}")
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+    response = client.get(f"/documents?user_id={user_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+
+    upload(user_id, "Another document. " * 20, "another.txt")
+    response = client.get(f"/documents?user_id={user_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_large_listings_are_gzipped_for_clients_that_accept_it(client, upload, user_id, monkeypatch):
+    monkeypatch.setattr(chatty, "COMPRESS_MIN_BYTES", 100)
+    upload_documents(upload, user_id, 2)
+    plain = client.get(f"/documents?user_id={user_id}")
+    assert "Content-Encoding" not in plain.headers
+
+    response = client.get(f"/documents?user_id={user_id}", headers={"Accept-Encoding": "gzip, deflate"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert json.loads(gzip.decompress(response.get_data())) == plain.get_json()
@@ -0,0 +1,127 @@
+"""Tests for embedding texts: caching, batching and retries"""
+import threading
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+from src import app as chatty
+
+
+def unique_text(words):
+    return f"{words} {uuid.uuid4().hex}"
+
+
+def test_embedding_cache_evicts_the_least_recently_used():
+    cache = chatty.EmbeddingCache(2)
+    keys = [chatty.EmbeddingCache.make_key("model", "search_document", text) for text in ("a", "b", "c")]
+    cache.put(keys[0], 1)
+    cache.put(keys[1], 2)
+    assert cache.get(keys[0]) == 1
+    cache.put(keys[2], 3)
+    assert cache.get(keys[1]) is None
+    assert (cache.get(keys[0]), cache.get(keys[2])) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_keys_ignore_whitespace_but_not_input_type():
+    make_key = chatty.EmbeddingCache.make_key
+    assert make_key("m", "search_document", "some  text\n") == make_key("m", "search_document", "some text")
+    assert make_key("m", "search_document", "some text") != make_key("m", "search_query", "some text")
+
+
+def test_embed_texts_sends_each_uncached_text_once(fake_cohere):
+    texts = [unique_text("first"), unique_text("second")]
+    embeddings = chatty.embed_texts([texts[0], texts[1], texts[0]])
+    assert fake_cohere.calls["embedded_texts"] == 2
+    np.testing.assert_array_equal(embeddings[0], embeddings[2])
+
+    chatty.embed_texts(texts)
+    assert fake_cohere.calls["embedded_texts"] == 2
+
+
+def test_reuploading_a_document_embeds_nothing(fake_cohere, upload, user_id):
+    text = unique_text("A report on quarterly results and the plans for next year.") * 30
+    assert upload(user_id, text, "report.txt").status_code == 200
+    embedded = fake_cohere.calls["embedded_texts"]
+    assert embedded > 0
+
+    assert upload(f"{user_id}-other", text, "copy.txt").status_code == 200
+    assert fake_cohere.calls["embedded_texts"] == embedded
+
+
+def test_embed_batched_keeps_input_order_across_batches(fake_cohere, monkeypatch):
+    monkeypatch.setattr(chatty, "EMBED_BATCH_SIZE", 3)
+    texts = [f"text number {i}" for i in range(10)]
+    progress = []
+    embeddings = chatty.embed_batched(texts, "search_document", progress=lambda done, total: progress.append(done))
+    assert fake_cohere.calls["embed"] == 4
+    assert progress == [3, 6, 9, 10]
+    for text, embedding in zip(texts, embeddings):
+        np.testing.assert_allclose(embedding, fake_cohere.vector(text))
+
+
+def test_embed_batch_retries_transient_errors(fake_cohere, monkeypatch):
+    monkeypatch.setattr(chatty, "EMBED_RETRY_BASE_DELAY", 0)
+    embed = fake_cohere.embed
+    failures = [ConnectionError("reset"), TimeoutError("slow")]
+
+    def flaky_embed(**kwargs):
+        if failures:
+            raise failures.pop(0)
+        return embed(**kwargs)
+
+    monkeypatch.setattr(fake_cohere, "embed", flaky_embed)
+    assert len(chatty.embed_batch(["hello"], "search_document")) == 1
+    assert not failures
+
+
+def test_embed_batch_gives_up_on_other_errors(fake_cohere, monkeypatch):
+    calls = []
+
+    def broken_embed(**kwargs):
+        calls.append(kwargs)
+        raise ValueError("bad request")
+
+    monkeypatch.setattr(fake_cohere, "embed", broken_embed)
+    with pytest.raises(ValueError):
+        chatty.embed_batch(["hello"], "search_document")
+    assert len(calls) == 1
+
+
+def test_cached_query_embeddings_expire():
+    cache = chatty.EmbeddingCache(10, ttl=0)
+    key = chatty.EmbeddingCache.make_key("model", "search_query", "question")
+    cache.put(key, 1)
+    time.sleep(0.001)
+    assert cache.get(key) is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_embed_query_reuses_the_cached_embedding(fake_cohere):
+    query = unique_text("how many holidays do I get")
+    first = chatty.embed_query(query)
+    second = chatty.embed_query(f"  {query} ")
+    assert fake_cohere.calls["embed"] == 1
+    np.testing.assert_array_equal(first, second)
+
+
+def test_concurrent_query_embeds_share_one_call(fake_cohere):
+    batcher = chatty.QueryEmbedBatcher(window=0.05, max_batch=96)
+    queries = [f"question {i % 5}" for i in range(10)]
+    results = [None] * len(queries)
+
+    def embed(i):
+        results[i] = batcher.embed(queries[i])
+
+    threads = [threading.Thread(target=embed, args=(i,)) for i in range(len(queries))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fake_cohere.calls["embed"] == 1
+    assert fake_cohere.calls["embedded_texts"] == 5
+    for query, embedding in zip(queries, results):
+        np.testing.assert_allclose(embedding, fake_cohere.vector(query))
+    assert batcher.stats() == {"requests": 10, "batches": 1, "queries_per_batch": 10.0}
@@ -0,0 +1,60 @@
+"""Tests for the disk-backed EmbeddingStore"""
+import os
+
+import numpy as np
+
+from src import app as chatty
+from tests.test_vector_index import chunk_metadata, random_vectors
+
+
+def test_segments_survive_a_restart(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = random_vectors(rng, 4)
+    chatty.EmbeddingStore(str(tmp_path)).add_segment("a", "a.txt", vectors, chunk_metadata("a", 4))
+
+    # Another worker, or the same one after a restart, opens the directory afresh
+    store = chatty.EmbeddingStore(str(tmp_path))
+    loaded, metadata = store.load_document_rows("a")
+    np.testing.assert_array_equal(loaded, vectors)
+    assert isinstance(loaded, np.memmap)
+    assert [meta["chunk_index"] for meta in metadata] == [0, 1, 2, 3]
+    assert store.load_document_rows("missing") == (None, [])
+
+
+def test_compaction_merges_segments_and_keeps_every_document(tmp_path):
+    rng = np.random.default_rng(1)
+    store = chatty.EmbeddingStore(str(tmp_path))
+    vectors = {}
+    for doc in range(chatty.STORE_MAX_SEGMENTS + 1):
+        doc_id = f"doc-{doc}"
+        vectors[doc_id] = random_vectors(rng, 3)
+        store.add_segment(doc_id, f"{doc_id}.txt", vectors[doc_id], chunk_metadata(doc_id, 3))
+
+    manifest = store.load_manifest()
+    assert manifest["segments"] == []
+    assert manifest["base"]["rows"] == 3 * len(vectors)
+    # Only the base and the manifest are left on disk
+    assert sorted(name.rsplit(".", 1)[1] for name in os.listdir(tmp_path) if not name.startswith(".")) == [
+        "json", "json", "npy"
+    ]
+    for doc_id, doc_vectors in vectors.items():
+        np.testing.assert_array_equal(store.load_document_rows(doc_id)[0], doc_vectors)
+
+
+def test_removed_documents_are_gone_for_other_workers(tmp_path):
+    rng = np.random.default_rng(2)
+    store = chatty.EmbeddingStore(str(tmp_path))
+    for doc_id in ("a", "b"):
+        store.add_segment(doc_id, f"{doc_id}.txt", random_vectors(rng, 5), chunk_metadata(doc_id, 5))
+    index = chatty.UserVectorIndex(storage="float")
+    index.sync(store)
+    assert index.live_count == 10
+
+    other_worker = chatty.EmbeddingStore(str(tmp_path))
+    other_worker.remove_document("a")
+    assert other_worker.load_document_rows("a") == (None, [])
+    assert not any(name.startswith("seg-a-") for name in os.listdir(tmp_path))
+
+    index.sync(store)
+    assert index.live_count == 5
+    assert set(index.doc_rows) == {"b"}
@@ -0,0 +1,37 @@
+"""Tests for request tracing and the /metrics endpoint"""
+from src import app as chatty
+
+
+def test_histograms_render_cumulative_buckets():
+    histograms = chatty.LatencyHistograms(buckets=(0.1, 1.0))
+    for seconds in (0.05, 0.5, 0.7, 3.0):
+        histograms.observe("latency_seconds", {"stage": "embed"}, seconds)
+    assert histograms.render() == [
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{stage="embed",le="0.1"} 1',
+        'latency_seconds_bucket{stage="embed",le="1.0"} 3',
+        'latency_seconds_bucket{stage="embed",le="+Inf"} 4',
+        'latency_seconds_sum{stage="embed"} 4.250000',
+        'latency_seconds_count{stage="embed"} 4',
+    ]
+
+
+def test_request_ids_are_echoed_or_replaced(client):
+    response = client.get("/health", headers={"X-Request-ID": "abc-123.x"})
+    assert response.headers["X-Request-ID"] == "abc-123.x"
+    response = client.get("/health", headers={"X-Request-ID": "not a valid id!"})
+    assert response.headers["X-Request-ID"] != "not a valid id!"
+    assert len(response.headers["X-Request-ID"]) == 16
+
+
+def test_metrics_report_requests_and_stages(client, upload, user_id):
+    upload(user_id, "Some notes to index. " * 20)
+    client.get("/health")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    lines = response.get_data(as_text=True).splitlines()
+    assert any(line.startswith('chatty_request_seconds_count{endpoint="/health",status="200"} ') for line in lines)
+    assert any(line.startswith('chatty_stage_seconds_count{stage="document_embed"} ') for line in lines)
+    assert 'chatty_cache_entries{cache="document_embedding"}' in {line.split()[0] for line in lines}
+    assert "# TYPE chatty_model_calls_total counter" in lines
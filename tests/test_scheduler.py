@@ -0,0 +1,216 @@
+"""Tests for ModelCallScheduler and the chat streams that hold its stream lane"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from benchmarks.fake_cohere import FakeAsyncClientV2
+from src import app as chatty
+
+
+def test_scheduler_caps_concurrent_calls_per_lane():
+    scheduler = chatty.ModelCallScheduler(0, 1, (("interactive", 8), ("bulk", 2)))
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def call():
+        with scheduler.slot("bulk"):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2
+    assert scheduler.stats()["lanes"]["bulk"]["calls"] == 8
+
+
+def test_scheduler_serves_higher_priority_lanes_first():
+    # One token every 50ms, so every call below waits for a refill
+    scheduler = chatty.ModelCallScheduler(20, 1, (("interactive", 8), ("bulk", 8)))
+    with scheduler.slot("bulk"):
+        pass
+    lock = threading.Lock()
+    order = []
+
+    def call(lane):
+        with scheduler.slot(lane):
+            with lock:
+                order.append(lane)
+
+    bulk = [threading.Thread(target=call, args=("bulk",)) for _ in range(3)]
+    interactive = [threading.Thread(target=call, args=("interactive",)) for _ in range(3)]
+    for thread in bulk:
+        thread.start()
+    time.sleep(0.01)
+    for thread in interactive:
+        thread.start()
+    for thread in bulk + interactive:
+        thread.join()
+    assert order == ["interactive"] * 3 + ["bulk"] * 3
+
+
+def test_open_streams_do_not_hold_up_interactive_calls():
+    scheduler = chatty.ModelCallScheduler(0, 1, chatty.MODEL_LANES)
+    limit = dict(chatty.MODEL_LANES)["stream"]
+    release = threading.Event()
+
+    def stream():
+        with scheduler.slot("stream"):
+            release.wait()
+
+    streams = [threading.Thread(target=stream) for _ in range(limit + 2)]
+    for thread in streams:
+        thread.start()
+    while scheduler.stats()["lanes"]["stream"]["running"] < limit:
+        time.sleep(0.001)
+
+    def chat():
+        with scheduler.slot("interactive"):
+            pass
+
+    chat = threading.Thread(target=chat)
+    chat.start()
+    chat.join(timeout=1)
+    try:
+        assert not chat.is_alive()
+        assert scheduler.stats()["lanes"]["stream"]["queued"] == 2
+    finally:
+        release.set()
+        for thread in streams:
+            thread.join()
+
+
+def test_cancelled_async_call_leaves_the_queue():
+    scheduler = chatty.ModelCallScheduler(0, 1, (("interactive", 1),))
+
+    async def hold(seconds):
+        async with scheduler.slot_async("interactive"):
+            await asyncio.sleep(seconds)
+
+    async def main():
+        running = asyncio.ensure_future(hold(0.1))
+        await asyncio.sleep(0.01)
+        waiting = asyncio.ensure_future(hold(0))
+        await asyncio.sleep(0.02)
+        assert scheduler.stats()["lanes"]["interactive"]["queued"] == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        await running
+
+    asyncio.run(main())
+    lane = scheduler.stats()["lanes"]["interactive"]
+    assert (lane["queued"], lane["running"], lane["calls"]) == (0, 0, 1)
+
+
+def stream_lanes(slots):
+    return tuple((name, slots if name == "stream" else limit) for name, limit in chatty.MODEL_LANES)
+
+
+def test_stream_lane_size_comes_from_the_environment(tmp_path):
+    env = dict(os.environ, MODEL_STREAM_SLOTS="7", PYTHONPATH=os.path.join(os.path.dirname(__file__), ".."))
+    result = subprocess.run([sys.executable, "-c", "from src import app; print(dict(app.MODEL_LANES)['stream'])"],
+                            cwd=tmp_path, env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "7"
+
+
+def test_stream_waiting_for_its_lane_gets_keepalives(client, user_id, monkeypatch):
+    scheduler = chatty.ModelCallScheduler(0, 1, stream_lanes(1))
+    monkeypatch.setattr(chatty, "model_scheduler", scheduler)
+    monkeypatch.setattr(chatty, "STREAM_KEEPALIVE_SECONDS", 0.02)
+    release = threading.Event()
+
+    def other_stream():
+        with scheduler.slot("stream"):
+            release.wait()
+
+    holder = threading.Thread(target=other_stream)
+    holder.start()
+    try:
+        while scheduler.stats()["lanes"]["stream"]["running"] < 1:
+            time.sleep(0.001)
+        response = client.post("/chat-stream?protocol=delta", buffered=False,
+                               json={"user_id": user_id, "message": "hello there"})
+        pieces = (piece.decode() if isinstance(piece, bytes) else piece for piece in response.response)
+        assert next(pieces) == chatty.SSE_KEEPALIVE
+        assert scheduler.stats()["lanes"]["stream"]["queued"] == 1
+    finally:
+        release.set()
+        holder.join()
+    rest = "".join(pieces)
+    assert "event: delta" in rest
+    assert "event: done" in rest
+
+
+def run_asgi_stream(scheduler, user_id, waiting):
+    """Call asgi.chat_stream; waiting runs while the stream task is in progress. Returns the body."""
+    from src import asgi
+    sent = []
+    body = json.dumps({"user_id": user_id, "message": "hello there"}).encode()
+
+    async def receive():
+        return {"type": "http.request", "body": body}
+
+    async def send(event):
+        sent.append(event)
+
+    async def main():
+        task = asyncio.ensure_future(asgi.chat_stream({"type": "http", "query_string": b"protocol=delta"}, receive, send))
+        await waiting(task, sent)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    return b"".join(event.get("body", b"") for event in sent if event["type"] == "http.response.body").decode()
+
+
+def test_async_stream_waiting_for_its_lane_gets_keepalives(fake_cohere, user_id, monkeypatch):
+    from src import asgi
+    scheduler = chatty.ModelCallScheduler(0, 1, stream_lanes(1))
+    monkeypatch.setattr(chatty, "model_scheduler", scheduler)
+    monkeypatch.setattr(chatty, "STREAM_KEEPALIVE_SECONDS", 0.02)
+    monkeypatch.setattr(asgi, "async_co", FakeAsyncClientV2(fake_cohere))
+
+    async def waiting(task, sent):
+        async with scheduler.slot_async("stream"):
+            await asyncio.sleep(0.1)
+            bodies = [event["body"] for event in sent if event["type"] == "http.response.body"]
+            assert bodies and set(bodies) == {chatty.SSE_KEEPALIVE.encode()}
+
+    text = run_asgi_stream(scheduler, user_id, waiting)
+    assert "event: delta" in text
+    assert "event: done" in text
+    assert scheduler.stats()["lanes"]["stream"]["running"] == 0
+
+
+def test_cancelled_async_stream_frees_its_slot(fake_cohere, user_id, monkeypatch):
+    from src import asgi
+    scheduler = chatty.ModelCallScheduler(0, 1, stream_lanes(1))
+    monkeypatch.setattr(chatty, "model_scheduler", scheduler)
+    monkeypatch.setattr(fake_cohere, "token_latency", 0.05)
+    monkeypatch.setattr(asgi, "async_co", FakeAsyncClientV2(fake_cohere))
+
+    async def waiting(task, sent):
+        # The client goes away mid-answer
+        while not any(b"event: delta" in event.get("body", b"") for event in sent):
+            await asyncio.sleep(0.005)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert scheduler.stats()["lanes"]["stream"]["running"] == 0
+
+    run_asgi_stream(scheduler, user_id, waiting)
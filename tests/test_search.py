@@ -0,0 +1,53 @@
+"""Tests for the /search and /search/batch routes"""
+import pytest
+
+from src import app as chatty
+
+
+@pytest.mark.parametrize("payload", [
+    {"queries": []},
+    {"queries": ["fine", "  "]},
+    {"queries": "not a list"},
+    {"queries": ["fine"], "user_ids": "someone"},
+    {"queries": ["fine"], "top_k": "many"},
+])
+def test_batch_search_rejects_bad_requests(client, payload):
+    assert client.post("/search/batch", json=payload).status_code == 400
+
+
+def test_batch_search_caps_the_query_count(client, monkeypatch):
+    monkeypatch.setattr(chatty, "SEARCH_BATCH_MAX_QUERIES", 2)
+    response = client.post("/search/batch", json={"queries": ["a", "b", "c"]})
+    assert response.status_code == 400
+
+
+def test_batch_search_merges_the_best_matches_of_every_user(client, upload, user_id):
+    boats, trains = f"{user_id}-boats", f"{user_id}-trains"
+    upload(boats, "Sailing boats need wind and a good keel. " * 30, "boats.txt")
+    upload(trains, "Steam trains need coal and long rails. " * 30, "trains.txt")
+
+    response = client.post("/search/batch", json={
+        "queries": ["sailing boats wind keel", "steam trains coal rails", "sailing boats wind keel"],
+        "user_ids": [boats, trains],
+        "top_k": 2,
+        "threshold": 0.3
+    })
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [result["query"] for result in results] == [
+        "sailing boats wind keel", "steam trains coal rails", "sailing boats wind keel"]
+    assert {match["user_id"] for match in results[0]["matches"]} == {boats}
+    assert {match["user_id"] for match in results[1]["matches"]} == {trains}
+    assert results[0]["matches"] == results[2]["matches"]
+    for result in results[:2]:
+        similarities = [match["similarity"] for match in result["matches"]]
+        assert 0 < len(similarities) <= 2 and similarities == sorted(similarities, reverse=True)
+        assert all("text" in match for match in result["matches"])
+
+
+def test_batch_search_can_leave_out_the_text(client, upload, user_id):
+    upload(user_id, "Sailing boats need wind and a good keel. " * 30, "boats.txt")
+    response = client.post("/search/batch", json={"queries": ["boats"], "user_id": user_id,
+                                                  "threshold": -1, "include_text": False})
+    matches = response.get_json()["results"][0]["matches"]
+    assert matches and not any("text" in match for match in matches)
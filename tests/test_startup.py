@@ -0,0 +1,31 @@
+"""Tests that importing src.app stays cheap"""
+import json
+import os
+import subprocess
+import sys
+
+from src import app as chatty
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHECK_IMPORT = """
+import json, sys
+from src import app
+print(json.dumps({
+    "app_built": "app" in vars(app),
+    "heavy_modules": [name for name in ("cohere", "PyPDF2", "docx", "sklearn") if name in sys.modules],
+}))
+"""
+
+
+def test_import_builds_no_app_and_loads_no_sdk(tmp_path):
+    env = dict(os.environ, COHERE_API_KEY="test", PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, "-c", CHECK_IMPORT], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, check=True)
+    assert json.loads(result.stdout) == {"app_built": False, "heavy_modules": []}
+
+
+def test_create_app_builds_independent_apps():
+    first, second = chatty.create_app(), chatty.create_app()
+    assert first is not second and first is not chatty.app
+    assert second.test_client().get("/health").status_code == 200
@@ -0,0 +1,112 @@
+"""Tests for the state backends.
+
+Run from the repository root with ``python -m pytest -q``.
+"""
+import os
+import signal
+import threading
+import warnings
+
+import pytest
+
+from src import app as chatty
+
+
+def messages(*contents):
+    return [{"role": "user", "content": content} for content in contents]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return chatty.InMemoryStateBackend()
+    return chatty.SQLiteStateBackend(str(tmp_path / "state.db"))
+
+
+def test_append_memory_keeps_the_last_messages(backend):
+    backend.append_memory("u", messages("a", "b"), keep=3)
+    backend.append_memory("u", messages("c", "d"), keep=3)
+    assert backend.get_memory("u") == ("", messages("b", "c", "d"))
+    assert backend.get_memory("other") == ("", [])
+
+
+def test_fold_memory_replaces_the_folded_messages(backend):
+    backend.append_memory("u", messages("a", "b", "c"), keep=10)
+    assert backend.fold_memory("u", messages("a", "b"), "summary of a and b")
+    assert backend.get_memory("u") == ("summary of a and b", messages("c"))
+
+
+def test_fold_memory_refuses_messages_that_changed(backend):
+    backend.append_memory("u", messages("a", "b"), keep=2)
+    folded = backend.get_memory("u")[1]
+    # A reply lands while the summary is being written and pushes "a" out
+    backend.append_memory("u", messages("c"), keep=2)
+    assert not backend.fold_memory("u", folded, "stale summary")
+    assert backend.get_memory("u") == ("", messages("b", "c"))
+
+
+def test_document_records_bump_the_documents_version(backend):
+    first = {"id": "a", "filename": "a.txt"}
+    backend.put_document("u", first)
+    backend.put_document("u", {"id": "b", "filename": "b.txt"})
+    assert [record["id"] for record in backend.list_documents("u")] == ["a", "b"]
+    assert backend.get_document("u", "a") == first
+    version = backend.documents_version("u")
+
+    assert backend.delete_document("u", "a") == first
+    assert backend.delete_document("u", "a") is None
+    assert backend.documents_version("u") == version + 1
+    assert backend.get_document("u", "a") is None
+    assert backend.documents_version("other") == 0
+
+
+def test_sqlite_writer_thread_commits_concurrent_appends(tmp_path):
+    path = str(tmp_path / "state.db")
+    backend = chatty.SQLiteStateBackend(path)
+
+    def append(user_id):
+        for i in range(20):
+            backend.append_memory(user_id, messages(str(i)), keep=100)
+
+    threads = [threading.Thread(target=append, args=(f"user-{n}",)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    backend.flush()
+
+    # A fresh backend reads the database like another worker process would
+    other_worker = chatty.SQLiteStateBackend(path)
+    for n in range(4):
+        assert other_worker.get_memory(f"user-{n}") == ("", messages(*(str(i) for i in range(20))))
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_sqlite_backend_reopens_after_fork(tmp_path):
+    path = str(tmp_path / "state.db")
+    backend = chatty.SQLiteStateBackend(path)
+    backend.append_memory("parent", messages("before fork"), keep=10)
+    backend.flush()
+
+    with warnings.catch_warnings():
+        # Forking with the writer thread running is the point of the test
+        warnings.simplefilter("ignore", DeprecationWarning)
+        pid = os.fork()
+    if pid == 0:
+        # The parent's writer thread is gone here; a flush would hang if the backend kept using its queue
+        signal.alarm(10)
+        try:
+            backend.append_memory("child", messages("from child"), keep=10)
+            backend.flush()
+            ok = backend.get_memory("parent") == ("", messages("before fork"))
+        except BaseException:
+            ok = False
+        os._exit(0 if ok else 1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    backend.append_memory("parent", messages("after fork"), keep=10)
+    backend.flush()
+    other_worker = chatty.SQLiteStateBackend(path)
+    assert other_worker.get_memory("child") == ("", messages("from child"))
+    assert other_worker.get_memory("parent") == ("", messages("before fork", "after fork"))
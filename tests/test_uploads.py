@@ -0,0 +1,144 @@
+"""Tests for document ingestion: background jobs, resumable and batch uploads"""
+import hashlib
+import io
+import os
+import time
+
+from src import app as chatty
+
+
+def wait_for_job(client, status_url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(status_url).get_json()
+        if job["status"] in ("completed", "failed") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.01)
+
+
+def test_upload_returns_a_job_to_poll(client, user_id):
+    response = client.post("/upload", data={
+        "user_id": user_id,
+        "file": (io.BytesIO(b"Background ingestion keeps uploads fast. " * 50), "notes.txt")
+    })
+    assert response.status_code == 202
+    status_url = response.get_json()["status_url"]
+
+    job = wait_for_job(client, status_url)
+    assert job["status"] == "completed"
+    assert {stage: info["status"] for stage, info in job["stages"].items()} == {
+        "extracting": "done", "chunking": "done", "embedding": "done", "indexing": "done"
+    }
+    assert job["progress"]["chunks_embedded"] == job["progress"]["chunk_count"] == job["chunk_count"] > 0
+    documents = client.get(f"/documents?user_id={user_id}").get_json()["documents"]
+    assert [document["id"] for document in documents] == [job["document_id"]]
+
+
+def test_failed_jobs_report_the_failing_stage(client, upload, user_id):
+    response = upload(user_id, "", "empty.txt")
+    assert response.status_code == 400
+    job = response.get_json()
+    assert job["status"] == "failed"
+    assert job["error"] == "No text content found in file"
+    assert job["stages"]["chunking"]["status"] == "failed"
+    assert job["stages"]["embedding"]["status"] == "pending"
+    assert client.get(f"/upload-status/{job['job_id']}").get_json()["status"] == "failed"
+
+
+def test_unknown_jobs_are_not_found(client):
+    assert client.get("/upload-status/no-such-job").status_code == 404
+
+
+def test_finished_jobs_expire(client, upload, user_id):
+    job_id = upload(user_id, "A short note. " * 20).get_json()["job_id"]
+    stale = time.time() - chatty.INGESTION_JOB_TTL - 1
+    chatty.ingestion_jobs[job_id]["updated"] = stale
+    os.utime(chatty.job_file_path(job_id), (stale, stale))
+
+    chatty.expire_ingestion_jobs()
+    assert chatty.get_ingestion_job(job_id) is None
+    assert client.get(f"/upload-status/{job_id}").status_code == 404
+
+
+def start_resumable_upload(client, user_id, data, **fields):
+    response = client.post("/uploads", json={"user_id": user_id, "filename": "notes.txt", "size": len(data),
+                                             "sha256": hashlib.sha256(data).hexdigest(), **fields})
+    assert response.status_code == 201
+    return response.get_json()["upload_url"]
+
+
+def send_chunk(client, upload_url, offset, data):
+    return client.patch(upload_url, data=data, headers={"Upload-Offset": str(offset)})
+
+
+def test_resumable_upload_resumes_from_the_stored_offset(client, user_id):
+    data = b"Resumable uploads survive dropped connections. " * 40
+    upload_url = start_resumable_upload(client, user_id, data)
+
+    assert send_chunk(client, upload_url, 0, data[:500]).get_json()["offset"] == 500
+    # A retried chunk for an offset already passed tells the client where to resume
+    response = send_chunk(client, upload_url, 0, data[:500])
+    assert response.status_code == 409
+    assert response.get_json()["offset"] == 500
+    assert client.get(upload_url).get_json()["status"] == "uploading"
+
+    session = send_chunk(client, upload_url, 500, data[500:]).get_json()
+    assert session["status"] == "processing"
+    assert session["sha256"] == hashlib.sha256(data).hexdigest()
+    job = wait_for_job(client, session["status_url"])
+    assert job["status"] == "completed"
+    assert job["content_length"] == len(data)
+
+
+def test_resumable_upload_checks_size_and_checksum(client, user_id):
+    data = b"The bytes that arrive must be the bytes that were announced. " * 10
+    upload_url = start_resumable_upload(client, user_id, data)
+    assert send_chunk(client, upload_url, 0, data + b"extra").status_code == 400
+    assert client.get(upload_url).get_json()["offset"] == 0
+
+    tampered = data[:-1] + b"!"
+    response = send_chunk(client, upload_url, 0, tampered)
+    assert response.status_code == 400
+    assert response.get_json()["status"] == "failed"
+
+    assert client.post("/uploads", json={"user_id": user_id, "filename": "notes.exe", "size": 10}).status_code == 400
+    assert client.post("/uploads", json={"user_id": user_id, "filename": "notes.txt", "size": 0}).status_code == 400
+
+
+def test_aborted_uploads_are_removed(client, user_id):
+    upload_url = start_resumable_upload(client, user_id, b"never finished")
+    assert client.delete(upload_url).status_code == 200
+    assert client.get(upload_url).status_code == 404
+    assert send_chunk(client, upload_url, 0, b"never").status_code == 404
+
+
+def test_batch_upload_ingests_files_and_deferred_uploads(client, user_id):
+    deferred = b"A deferred upload waits for the batch. " * 30
+    upload_url = start_resumable_upload(client, user_id, deferred, filename="deferred.txt", defer=True)
+    assert send_chunk(client, upload_url, 0, deferred).get_json()["status"] == "uploaded"
+
+    response = client.post("/upload-batch", data={
+        "user_id": user_id,
+        "wait": "true",
+        "files": [(io.BytesIO(f"File number {i} of the batch. ".encode() * 30), f"file-{i}.txt") for i in range(3)]
+    })
+    assert response.status_code == 200
+    assert [job["status"] for job in response.get_json()["jobs"]] == ["completed"] * 3
+
+    upload_id = upload_url.rsplit("/", 1)[1]
+    response = client.post("/upload-batch", json={"user_id": user_id, "upload_ids": [upload_id], "wait": True})
+    assert response.status_code == 200
+    assert client.get(upload_url).get_json()["status"] == "processing"
+
+    filenames = [document["filename"] for document in client.get(f"/documents?user_id={user_id}").get_json()["documents"]]
+    assert sorted(filenames) == ["deferred.txt", "file-0.txt", "file-1.txt", "file-2.txt"]
+
+
+def test_batch_upload_refuses_unfinished_uploads(client, user_id):
+    upload_url = start_resumable_upload(client, user_id, b"only half of this arrives", defer=True)
+    upload_id = upload_url.rsplit("/", 1)[1]
+    send_chunk(client, upload_url, 0, b"only half")
+    response = client.post("/upload-batch", json={"user_id": user_id, "upload_ids": [upload_id]})
+    assert response.status_code == 409
+    response = client.post("/upload-batch", json={"user_id": f"{user_id}-other", "upload_ids": [upload_id]})
+    assert response.status_code == 404
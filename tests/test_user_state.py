@@ -0,0 +1,48 @@
+"""Tests for the per-user state each worker keeps in memory"""
+from src import app as chatty
+
+
+def search(client, user_id, query):
+    response = client.post("/search", json={"user_id": user_id, "query": query})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_document_records_do_not_hold_the_text(upload, user_id):
+    text = "Every paragraph of this report is kept on disk only. " * 40
+    upload(user_id, text, "report.txt")
+    [record] = chatty.get_user_documents(user_id)
+    assert "content" not in record
+    assert record["content_length"] == len(text)
+    assert chatty.get_user_store(user_id).load_document_content(record) == text
+
+
+def test_running_total_matches_the_users_loaded(client, upload, user_id):
+    for suffix in ("a", "b"):
+        upload(f"{user_id}-{suffix}", "Notes worth indexing. " * 40)
+        search(client, f"{user_id}-{suffix}", "notes")
+    stats = chatty.user_state_stats()
+    assert stats["bytes"] == sum(chatty.user_state_usage.values())
+
+    size = chatty.user_state_usage[f"{user_id}-a"]
+    assert size > 0
+    chatty.forget_user_state_usage(f"{user_id}-a")
+    assert chatty.user_state_stats()["bytes"] == stats["bytes"] - size
+
+
+def test_idle_users_are_evicted_and_reload(client, upload, user_id, monkeypatch):
+    idle, active = f"{user_id}-idle", f"{user_id}-active"
+    upload(idle, "The idle user wrote about lighthouses. " * 40)
+    search(client, idle, "lighthouses")
+    assert idle in chatty.user_embeddings
+
+    monkeypatch.setattr(chatty, "USER_STATE_MEMORY_MB", 0)
+    evictions = chatty.user_state_stats()["evictions"]
+    upload(active, "The active user wrote about gardens. " * 40)
+    search(client, active, "gardens")
+    assert idle not in chatty.user_embeddings and idle not in chatty.user_documents
+    assert list(chatty.user_state_usage) == [active]
+    assert chatty.user_state_stats()["evictions"] > evictions
+
+    assert "lighthouses" in search(client, idle, "lighthouses")["context"]
+    assert list(chatty.user_state_usage) == [idle]
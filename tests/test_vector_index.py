@@ -0,0 +1,125 @@
+"""Tests for UserVectorIndex search over rows loaded from an EmbeddingStore"""
+import numpy as np
+import pytest
+
+from src import app as chatty
+
+
+def chunk_metadata(doc_id, count):
+    return [{"doc_id": doc_id, "chunk_index": i, "text": f"{doc_id} chunk {i}", "filename": f"{doc_id}.txt"}
+            for i in range(count)]
+
+
+def compacted_store(path, documents=chatty.STORE_MAX_SEGMENTS + 1, rows=20, dims=32, seed=0):
+    """A store whose last segment write merged every document into the base file"""
+    rng = np.random.default_rng(seed)
+    store = chatty.EmbeddingStore(str(path))
+    for doc in range(documents):
+        vectors = chatty.normalize_embeddings(rng.standard_normal((rows, dims)))
+        store.add_segment(f"doc-{doc}", f"doc-{doc}.txt", vectors, chunk_metadata(f"doc-{doc}", rows))
+    return store
+
+
+def random_vectors(rng, rows, dims=32):
+    return chatty.normalize_embeddings(rng.standard_normal((rows, dims)))
+
+
+def test_removed_documents_drop_out_of_search_and_get_compacted():
+    rng = np.random.default_rng(1)
+    index = chatty.UserVectorIndex(storage="float")
+    vectors = {doc_id: random_vectors(rng, 10) for doc_id in ("a", "b", "c")}
+    for doc_id, doc_vectors in vectors.items():
+        index.add_vectors(doc_id, doc_vectors, chunk_metadata(doc_id, 10))
+    assert len(index) == 3 and index.live_count == 30
+
+    top = index.search(vectors["b"][4], top_k=1, threshold=-1.0)[0]
+    assert (top["doc_id"], top["chunk_index"]) == ("b", 4)
+    assert top["similarity"] == pytest.approx(1.0, abs=1e-5)
+
+    assert index.remove_document("b")
+    assert not index.remove_document("b")
+    assert all(hit["doc_id"] != "b" for hit in index.search(vectors["b"][4], top_k=30, threshold=-1.0))
+    # A third of the rows were dead, more than INDEX_COMPACT_RATIO allows
+    assert index.size == index.live_count == 20 and index.dead_count == 0
+    top = index.search(vectors["c"][7], top_k=1, threshold=-1.0)[0]
+    assert (top["doc_id"], top["chunk_index"]) == ("c", 7)
+
+
+def test_adding_a_document_again_replaces_its_rows():
+    rng = np.random.default_rng(2)
+    index = chatty.UserVectorIndex(storage="float")
+    index.add_vectors("a", random_vectors(rng, 5), chunk_metadata("a", 5))
+    replacement = random_vectors(rng, 3)
+    index.add_vectors("a", replacement, chunk_metadata("a", 3))
+    assert index.live_count == 3
+    hits = index.search(replacement[2], top_k=10, threshold=-1.0)
+    assert len(hits) == 3 and hits[0]["chunk_index"] == 2
+
+
+@pytest.mark.parametrize("storage", ["int8", "binary"])
+def test_quantized_search_rescores_to_the_float_results(storage):
+    rng = np.random.default_rng(3)
+    vectors = random_vectors(rng, 2000, dims=256)
+    indexes = {}
+    for name in ("float", storage):
+        indexes[name] = chatty.UserVectorIndex(storage=name)
+        for start in range(0, len(vectors), 500):
+            doc_id = f"doc-{start}"
+            indexes[name].add_vectors(doc_id, vectors[start:start + 500], chunk_metadata(doc_id, 500))
+
+    queries = chatty.normalize_embeddings(vectors[::100] + 0.5 * random_vectors(rng, 20, dims=256))
+    for query in queries:
+        exact = indexes["float"].search(query, top_k=5, threshold=-1.0)
+        found = indexes[storage].search(query, top_k=5, threshold=-1.0)
+        assert [(hit["doc_id"], hit["chunk_index"]) for hit in found[:1]] == [
+            (hit["doc_id"], hit["chunk_index"]) for hit in exact[:1]]
+        # Shortlisted rows are rescored against the float32 vectors
+        assert found[0]["similarity"] == pytest.approx(exact[0]["similarity"], abs=1e-5)
+
+    stats = indexes[storage].stats(recall_sample=50)
+    assert stats["memory_bytes"] <= stats["float32_bytes"] / (3 if storage == "int8" else 25)
+    # Random vectors have no clusters, the hard case for sign bits; real embeddings do better
+    assert stats["recall_at_k"] >= (0.95 if storage == "int8" else 0.6)
+
+
+@pytest.mark.parametrize("storage", ["float", "int8", "binary"])
+def test_ivf_search_over_a_compacted_store(tmp_path, monkeypatch, storage):
+    monkeypatch.setattr(chatty, "ANN_MIN_CHUNKS", 0)
+    store = compacted_store(tmp_path)
+    index = chatty.UserVectorIndex(storage=storage)
+    index.sync(store)
+    # Every row is in the memory-mapped base; there is no tail matrix at all
+    assert index.matrix is None
+    assert index.base_size == (chatty.STORE_MAX_SEGMENTS + 1) * 20
+
+    query = np.asarray(store.load_document_rows("doc-3")[0][5])
+    info = {}
+    results = index.search(query, top_k=3, threshold=-1.0, search_info=info)
+    assert info["mode"] == "ivf"
+    assert (results[0]["doc_id"], results[0]["chunk_index"]) == ("doc-3", 5)
+    batch = index.search_batch([query], top_k=3, threshold=-1.0)
+    assert (batch[0][0]["doc_id"], batch[0][0]["chunk_index"]) == ("doc-3", 5)
+
+    stats = index.stats(recall_sample=10)
+    assert stats["recall_queries"] == 10
+    assert stats["recall_at_k"] > 0.5
+
+
+def test_index_stats_after_the_store_compacts(client, upload, user_id, monkeypatch):
+    for i in range(chatty.STORE_MAX_SEGMENTS + 1):
+        response = upload(user_id, f"Document {i} covers topic{i} and a few shared words. " * 5, f"doc-{i}.txt")
+        assert response.status_code == 200
+    assert chatty.get_user_embeddings(user_id).matrix is None
+
+    response = client.get(f"/debug/index-stats?user_id={user_id}")
+    assert response.status_code == 200
+    stats = response.get_json()
+    assert stats["live_rows"] == stats["rows"] > 0
+    assert stats["recall_queries"] > 0
+
+    # prepare_semantic_context turns search errors into an empty context, so check that IVF really ran
+    monkeypatch.setattr(chatty, "ANN_MIN_CHUNKS", 0)
+    response = client.post("/search", json={"user_id": user_id, "query": "topic7 shared words"})
+    assert response.status_code == 200
+    assert response.get_json()["search_mode"] == "ivf"
+    assert "topic7" in response.get_json()["context"]